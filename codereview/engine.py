@@ -15,11 +15,12 @@
 """Diff rendering in HTML for Rietveld."""
 
 import cgi
-import difflib
+import hashlib
 import logging
 import re
 import urlparse
 
+from google.appengine.api import memcache
 from google.appengine.api import urlfetch
 from google.appengine.api import users
 from google.appengine.ext import db
@@ -27,6 +28,8 @@ from google.appengine.ext import db
 from django.template import loader, RequestContext
 
 import intra_region_diff
+import library
+import linediff
 import models
 import patching
 
@@ -38,6 +41,18 @@ class FetchError(Exception):
     pass
 
 
+def _IterLines(data):
+    """Iterate over the lines of the data retaining the line endings, without splitting it all at once.
+
+    Lines are split on LF only, which is the only line break of the diffs produced by the vcs helpers.
+    """
+    start = 0
+    while start < len(data):
+        end = data.find('\n', start) + 1 or len(data)
+        yield data[start:end]
+        start = end
+
+
 # NOTE: The SplitPatch function is duplicated in upload.py, keep them in sync.
 def SplitPatch(data):
     """Split a patch into separate pieces for each file.
@@ -46,14 +61,21 @@ def SplitPatch(data):
       data: A string containing the output of svn diff.
 
     Returns:
-      A list of 2-tuple (filename, text) where text is the svn diff output
-        pertaining to filename.
+      A list of 4-tuple (filename, old_filename, text, is_binary) where text is
+        the svn diff output pertaining to filename.
+    """
+    return list(IterSplitPatch(data))
+
+
+def IterSplitPatch(data):
+    """Iterate over the pieces of a patch for each file, see SplitPatch.
+
+    The pieces are produced one at a time, so the caller doesn't have to keep all of them.
     """
-    patches = []
     filename = old_filename = None
     is_binary = False
     diff = []
-    for line in data.splitlines(True):
+    for line in _IterLines(data):
         new_filename = None
         line_old_filename = None
         if line.startswith('Index:'):
@@ -76,8 +98,7 @@ def SplitPatch(data):
                 new_filename = temp_filename
         if new_filename:
             if filename and diff:
-                patches.append(
-                    (filename, old_filename, ''.join(diff), is_binary))
+                yield filename, old_filename, ''.join(diff), is_binary
             filename = new_filename
             old_filename = None
             is_binary = False
@@ -87,8 +108,7 @@ def SplitPatch(data):
             old_filename = line_old_filename
         diff.append(line)
     if filename and diff:
-        patches.append((filename, old_filename, ''.join(diff), is_binary))
-    return patches
+        yield filename, old_filename, ''.join(diff), is_binary
 
 
 def ParsePatchSet(patchset):
@@ -101,9 +121,11 @@ def ParsePatchSet(patchset):
       A list of models.Patch instances.
     """
     patches = []
-    for filename, old_filename, text, is_binary in SplitPatch(patchset.data):
-        patches.append(models.Patch(patchset=patchset, text=ToText(text),
-                                    filename=filename, old_filename=old_filename, parent=patchset, is_binary=is_binary))
+    for filename, old_filename, text, is_binary in IterSplitPatch(patchset.data):
+        patch = models.Patch(patchset=patchset, text=ToText(text),
+                             filename=filename, old_filename=old_filename, parent=patchset, is_binary=is_binary)
+        patch.update_stats()
+        patches.append(patch)
     return patches
 
 
@@ -202,6 +224,17 @@ MIN_COLUMN_WIDTH = 3
 MAX_COLUMN_WIDTH = 2000
 
 
+# Rendered code rows don't depend on the comments, they are cached and the comments are merged in
+# when the page is served. Increase the version when the rendering changes.
+ROWS_CACHE_VERSION = 2
+ROWS_CACHE_TIMEOUT = 7 * 24 * 60 * 60
+# Bigger renderings are not cached, memcache doesn't store values of 1MB and more.
+ROWS_CACHE_MAX_SIZE = 900 * 1024
+# The opcodes of the diffs between two patches are cached too, so the skipped rows are expanded from the
+# same opcodes as the page was rendered. Timed out diffs are cached shorter, they are retried later.
+DIFF_TIMEOUT_CACHE_TIMEOUT = 60 * 60
+
+
 def RenderDiffTableRows(request, old_lines, chunks, patch,
                         colwidth=DEFAULT_COLUMN_WIDTH, debug=False,
                         context=DEFAULT_CONTEXT):
@@ -221,11 +254,78 @@ def RenderDiffTableRows(request, old_lines, chunks, patch,
       pair of lines of the side-by-side diff, possibly including comments.
       Each yielded string may consist of several <tr> elements.
     """
-    rows = _RenderDiffTableRows(request, old_lines, chunks, patch,
-                                colwidth, debug)
+    code_rows = RenderDiffCodeRows(old_lines, chunks, patch, colwidth, debug)
+    return RenderDiffCommentRows(request, code_rows, patch, context)
+
+
+def RenderDiffCodeRows(old_lines, chunks, patch,
+                       colwidth=DEFAULT_COLUMN_WIDTH, debug=False):
+    """Render the comment independent rows of a side-by-side diff for a patch.
+
+    Args:
+      The same as for RenderDiffTableRows.
+
+    Yields:
+      Code rows as yielded by _CodeRowGenerator.
+    """
+    old_max, new_max = _ComputeLineCounts(old_lines, chunks)
+    return _CodeRowGenerator(patch, old_max, patch, new_max,
+                             patching.PatchChunks(old_lines, chunks),
+                             colwidth, debug)
+
+
+def RenderDiffCommentRows(request, code_rows, patch, context=DEFAULT_CONTEXT):
+    """Merge the comments of a patch into the code rows of its side-by-side diff.
+
+    Args:
+      request: Django Request object.
+      code_rows: Code rows as returned by RenderDiffCodeRows().
+      patch: A models.Patch instance.
+      context: Maximum number of rows surrounding a change (default CONTEXT).
+
+    Yields:
+      The same as RenderDiffTableRows.
+    """
+    old_dict = {}
+    new_dict = {}
+    if patch:
+        old_dict, new_dict = _GetComments(request)
+    rows = _CommentRowGenerator(code_rows, patch, old_dict, 'old',
+                                patch, new_dict, 'new', request)
     return _CleanupTableRowsGenerator(rows, context)
 
 
+def RenderDiffRowRange(request, old_lines, chunks, patch, first, last,
+                       colwidth=DEFAULT_COLUMN_WIDTH):
+    """Render the rows of a side-by-side diff for a patch in a range of row ids.
+
+    Only the rows in the range are rendered, the lines of the diff before it
+    are just counted and the diff isn't processed after it.
+
+    Args:
+      request: Django Request object.
+      old_lines: List of lines representing the original file.
+      chunks: List of chunks as returned by patching.ParsePatchToChunks().
+      patch: A models.Patch instance.
+      first: Id of the first row to render, as in the "pair-<id>" row ids.
+      last: Id of the last row to render.
+      colwidth: Optional column width (default 80).
+
+    Returns:
+      A list of table rows as returned by _StructuredRows().
+
+    Raises:
+      FetchError if the patch doesn't apply to the original file.
+    """
+    old_max, new_max = _ComputeLineCounts(old_lines, chunks)
+    cell_rows = _CodeCellGenerator(patch, old_max, patch, new_max,
+                                   patching.PatchChunks(old_lines, chunks),
+                                   colwidth, row_range=(first, last))
+    old_dict, new_dict = _GetComments(request)
+    return _StructuredRows(cell_rows, patch, old_dict, 'old',
+                           patch, new_dict, 'new', request)
+
+
 def RenderDiff2TableRows(request, old_lines, old_patch, new_lines, new_patch,
                          colwidth=DEFAULT_COLUMN_WIDTH, debug=False,
                          context=DEFAULT_CONTEXT):
@@ -246,13 +346,147 @@ def RenderDiff2TableRows(request, old_lines, old_patch, new_lines, new_patch,
       pair of lines of the side-by-side diff, possibly including comments.
       Each yielded string may consist of several <tr> elements.
     """
-    rows = _RenderDiff2TableRows(request, old_lines, old_patch,
-                                 new_lines, new_patch, colwidth, debug)
+    code_rows = RenderDiff2CodeRows(old_lines, old_patch, new_lines, new_patch,
+                                    colwidth, debug)
+    return RenderDiff2CommentRows(request, code_rows, old_patch, new_patch,
+                                  context)
+
+
+def RenderDiff2CodeRows(old_lines, old_patch, new_lines, new_patch,
+                        colwidth=DEFAULT_COLUMN_WIDTH, debug=False,
+                        diff_key=None):
+    """Render the comment independent rows of a diff between two patches.
+
+    Args:
+      The same as for RenderDiff2TableRows, and:
+      diff_key: Optional key of the cached diff, as for GetCachedDiff().
+
+    Yields:
+      Code rows as yielded by _CodeRowGenerator.
+    """
+    return _CodeRowGenerator(old_patch, len(old_lines) + 1,
+                             new_patch, len(new_lines) + 1,
+                             _GenerateTriples(old_lines, new_lines, diff_key),
+                             colwidth, debug)
+
+
+def RenderDiff2CommentRows(request, code_rows, old_patch, new_patch,
+                           context=DEFAULT_CONTEXT):
+    """Merge the comments of two patches into the code rows of their diff.
+
+    Args:
+      request: Django Request object.
+      code_rows: Code rows as returned by RenderDiff2CodeRows().
+      old_patch: The models.Patch instance on the left.
+      new_patch: The models.Patch instance on the right.
+      context: Maximum number of visible context lines (default DEFAULT_CONTEXT).
+
+    Yields:
+      The same as RenderDiff2TableRows.
+    """
+    old_dict, new_dict = _GetDiff2Comments(request, old_patch, new_patch)
+    rows = _CommentRowGenerator(code_rows, old_patch, old_dict, 'new',
+                                new_patch, new_dict, 'new', request)
     return _CleanupTableRowsGenerator(rows, context)
 
 
+def RenderDiff2RowRange(request, old_lines, old_patch, new_lines, new_patch,
+                        first, last, colwidth=DEFAULT_COLUMN_WIDTH,
+                        diff_key=None):
+    """Render the rows of a diff between two patches in a range of row ids.
+
+    Args:
+      request: Django Request object.
+      old_lines: List of lines representing the patched file on the left.
+      old_patch: The models.Patch instance corresponding to old_lines.
+      new_lines: List of lines representing the patched file on the right.
+      new_patch: The models.Patch instance corresponding to new_lines.
+      first: Id of the first row to render, as in the "pair-<id>" row ids.
+      last: Id of the last row to render.
+      colwidth: Optional column width (default 80).
+      diff_key: Optional key of the cached diff, as for GetCachedDiff(). The
+        rows are rendered from the same diff as the rows of the page then.
+
+    Returns:
+      A list of table rows as returned by _StructuredRows().
+    """
+    cell_rows = _CodeCellGenerator(old_patch, len(old_lines) + 1,
+                                   new_patch, len(new_lines) + 1,
+                                   _GenerateTriples(old_lines, new_lines,
+                                                    diff_key),
+                                   colwidth, row_range=(first, last))
+    old_dict, new_dict = _GetDiff2Comments(request, old_patch, new_patch)
+    return _StructuredRows(cell_rows, old_patch, old_dict, 'new',
+                           new_patch, new_dict, 'new', request)
+
+
+def GetCachedCodeRows(key, render):
+    """Get the code rows from memcache, render and cache them if needed.
+
+    Args:
+      key: A tuple identifying the rendering, e.g. the patch ids, their text
+        checksums and the column width.
+      render: Callable returning the code rows, called on a cache miss.
+
+    Returns:
+      A list of the cached code rows, or on a cache miss an iterator over the
+      rendered code rows, caching them once they are all consumed.
+    """
+    cache_key = 'code_rows:%s' % hashlib.md5(
+        repr((ROWS_CACHE_VERSION,) + tuple(key))).hexdigest()
+    rows = memcache.get(cache_key)
+    if rows is not None:
+        return rows
+    return _CachingRowsGenerator(cache_key, render())
+
+
+def GetCachedDiff(key, old_lines, new_lines):
+    """Get the diff of two files from memcache, diff and cache them if needed.
+
+    Args:
+      key: A tuple identifying the files, e.g. the patch ids and their text
+        checksums.
+      old_lines: List of lines representing the file on the left.
+      new_lines: List of lines representing the file on the right.
+
+    Returns:
+      A tuple (opcodes, timed_out) as returned by linediff.Diff().
+    """
+    cache_key = 'diff:%s' % hashlib.md5(
+        repr((ROWS_CACHE_VERSION,) + tuple(key))).hexdigest()
+    diff = memcache.get(cache_key)
+    if diff is None:
+        diff = linediff.Diff(old_lines, new_lines)
+        memcache.set(cache_key, diff,
+                     DIFF_TIMEOUT_CACHE_TIMEOUT if diff[1] else
+                     ROWS_CACHE_TIMEOUT)
+    return diff
+
+
+def _CachingRowsGenerator(cache_key, code_rows):
+    """Helper for GetCachedCodeRows() yielding and caching the code rows.
+
+    The rows are kept only up to the size that can be cached, so the rows of
+    big files are rendered without holding them all.
+    """
+    rows = []
+    size = 0
+    for row in code_rows:
+        if rows is not None:
+            size += len(row[1])
+            # Errors and timed out diffs are not cached, the base file is
+            # fetched and the files are diffed again the next time.
+            if row[0] in ('error', 'timeout') or size > ROWS_CACHE_MAX_SIZE:
+                rows = None
+            else:
+                rows.append(row)
+        yield row
+    if rows is not None:
+        memcache.set(cache_key, rows, ROWS_CACHE_TIMEOUT)
+
+
 def _CleanupTableRowsGenerator(rows, context):
-    """Cleanup rows returned by _TableRowGenerator for output.
+    """Cleanup rows returned by _CommentRowGenerator for output.
 
     Args:
       rows: List of tuples (tag, text)
@@ -335,47 +569,29 @@ def _ShortenBuffer(buffer, context):
             yield t
 
 
-def _RenderDiff2TableRows(request, old_lines, old_patch, new_lines, new_patch,
-                          colwidth=DEFAULT_COLUMN_WIDTH, debug=False):
-    """Internal version of RenderDiff2TableRows().
-
-    Args:
-      The same as for RenderDiff2TableRows.
-
-    Yields:
-      Tuples (tag, row) where tag is an indication of the row type.
-    """
-    old_dict = {}
-    new_dict = {}
-    for patch, dct in [(old_patch, old_dict), (new_patch, new_dict)]:
-        # XXX GQL doesn't support OR yet...  Otherwise we'd be using that.
-        for comment in models.Comment.gql(
-                'WHERE patch = :1 AND left = FALSE ORDER BY date', patch):
-            if comment.draft and comment.author != request.user:
-                continue  # Only show your own drafts
-            comment.complete()
-            lst = dct.setdefault(comment.lineno, [])
-            lst.append(comment)
-    return _TableRowGenerator(old_patch, old_dict, len(old_lines) + 1, 'new',
-                              new_patch, new_dict, len(new_lines) + 1, 'new',
-                              _GenerateTriples(old_lines, new_lines),
-                              colwidth, debug, request)
-
-
-def _GenerateTriples(old_lines, new_lines):
-    """Helper for _RenderDiff2TableRows yielding input for _TableRowGenerator.
+def _GenerateTriples(old_lines, new_lines, diff_key=None):
+    """Helper for RenderDiff2CodeRows yielding input for _CodeRowGenerator.
 
     Args:
       old_lines: List of lines representing the patched file on the left.
       new_lines: List of lines representing the patched file on the right.
+      diff_key: Optional key of the cached diff, as for GetCachedDiff(). The
+        lines are diffed without the cache if it's None.
 
     Yields:
       Tuples (tag, old_slice, new_slice) where tag is a tag as returned by
-      difflib.SequenceMatchser.get_opcodes(), and old_slice and new_slice
-      are lists of lines taken from old_lines and new_lines.
+      difflib.SequenceMatcher.get_opcodes(), and old_slice and new_slice
+      are lists of lines taken from old_lines and new_lines.  The lines are
+      diffed by the configured linediff algorithm.  If the diff timed out, the
+      first tuple is ('timeout', [], []).
     """
-    sm = difflib.SequenceMatcher(None, old_lines, new_lines)
-    for tag, i1, i2, j1, j2 in sm.get_opcodes():
+    if diff_key is None:
+        opcodes, timed_out = linediff.Diff(old_lines, new_lines)
+    else:
+        opcodes, timed_out = GetCachedDiff(diff_key, old_lines, new_lines)
+    if timed_out:
+        yield 'timeout', [], []
+    for tag, i1, i2, j1, j2 in opcodes:
         yield tag, old_lines[i1:i2], new_lines[j1:j2]
 
 
@@ -399,6 +615,7 @@ def _GetComments(request):
         if comment.draft and comment.author != request.user:
             continue  # Only show your own drafts
         comment.complete()
+        _ResolveAuthor(request, comment)
         if comment.left:
             dct = old_dict
         else:
@@ -407,50 +624,93 @@ def _GetComments(request):
     return old_dict, new_dict
 
 
-def _RenderDiffTableRows(request, old_lines, chunks, patch,
-                         colwidth=DEFAULT_COLUMN_WIDTH, debug=False):
-    """Internal version of RenderDiffTableRows().
+def _ResolveAuthor(request, comment):
+    """Helper that loads the author of a comment and caches their nickname.
+
+    The rows of the comments are rendered while the response is streamed,
+    after the database connection is closed, so the author is loaded on the
+    comment and the nickname is cached in the request before.
+    """
+    if comment.author is not None:
+        library.get_nickname(comment.author, True, request)
+
+
+def _GetDiff2Comments(request, old_patch, new_patch):
+    """Helper that returns the comments on the right side of two patches.
 
     Args:
-      The same as for RenderDiffTableRows.
+      request: Django Request object.
+      old_patch: The models.Patch instance on the left.
+      new_patch: The models.Patch instance on the right.
 
-    Yields:
-      Tuples (tag, row) where tag is an indication of the row type.
+    Returns:
+      A 2-tuple of (old, new) dictionaries as returned by _GetComments().
     """
     old_dict = {}
     new_dict = {}
-    if patch:
-        old_dict, new_dict = _GetComments(request)
-    old_max, new_max = _ComputeLineCounts(old_lines, chunks)
-    return _TableRowGenerator(patch, old_dict, old_max, 'old',
-                              patch, new_dict, new_max, 'new',
-                              patching.PatchChunks(old_lines, chunks),
-                              colwidth, debug, request)
+    for patch, dct in [(old_patch, old_dict), (new_patch, new_dict)]:
+        # XXX GQL doesn't support OR yet...  Otherwise we'd be using that.
+        for comment in models.Comment.gql(
+                'WHERE patch = :1 AND left = FALSE ORDER BY date', patch):
+            if comment.draft and comment.author != request.user:
+                continue  # Only show your own drafts
+            comment.complete()
+            _ResolveAuthor(request, comment)
+            lst = dct.setdefault(comment.lineno, [])
+            lst.append(comment)
+    return old_dict, new_dict
+
+
+def _CodeRowGenerator(old_patch, old_max, new_patch, new_max,
+                      triple_iterator, colwidth=DEFAULT_COLUMN_WIDTH,
+                      debug=False):
+    """Helper function to render side-by-side table rows without comments.
+
+    Args:
+      The same as for _CodeCellGenerator, without row_range.
+
+    Yields:
+      Tuples (tag, row, old_lineno, new_lineno) where tag is an indication of
+      the row type, row is an HTML fragment representing one or more <tr>
+      elements and old_lineno and new_lineno are the line numbers of the row,
+      or None when the side has no line.
+    """
+    for tag, table_rows, old_lineno, new_lineno in _CodeCellGenerator(
+            old_patch, old_max, new_patch, new_max, triple_iterator,
+            colwidth, debug):
+        yield (tag, ''.join(_FormatTableRow(attrs, cells)
+                            for attrs, cells in table_rows),
+               old_lineno, new_lineno)
 
 
-def _TableRowGenerator(old_patch, old_dict, old_max, old_snapshot,
-                       new_patch, new_dict, new_max, new_snapshot,
+def _CodeCellGenerator(old_patch, old_max, new_patch, new_max,
                        triple_iterator, colwidth=DEFAULT_COLUMN_WIDTH,
-                       debug=False, request=None):
-    """Helper function to render side-by-side table rows.
+                       debug=False, row_range=None):
+    """Helper function to render the cells of side-by-side table rows.
 
     Args:
       old_patch: First models.Patch instance.
-      old_dict: Dictionary with line numbers as keys and comments as values (left)
       old_max: Line count of the patch on the left.
-      old_snapshot: A tag used in the comments form.
       new_patch: Second models.Patch instance.
-      new_dict: Same as old_dict, but for the right side.
       new_max: Line count of the patch on the right.
-      new_snapshot: A tag used in the comments form.
       triple_iterator: Iterator that yields (tag, old, new) triples.
       colwidth: Optional column width (default 80).
       debug: Optional debugging flag (default False).
+      row_range: Optional tuple (first, last) of the ids of the rows to render.
+        The other rows, the info rows included, are skipped without being
+        rendered and an error raises FetchError instead of being yielded.
 
     Yields:
-      Tuples (tag, row) where tag is an indication of the row type and
-      row is an HTML fragment representing one or more <td> elements.
+      Tuples (tag, table_rows, old_lineno, new_lineno) where tag is an
+      indication of the row type, table_rows is a list of tuples
+      (attrs, cells) of the <tr> elements, with cells a list of tuples
+      (attrs, html) of their <td> elements, and old_lineno and new_lineno are
+      the line numbers of the row, or None when the side has no line.
     """
+    if row_range is None:
+        first = last = None
+    else:
+        first, last = row_range
     diff_params = intra_region_diff.GetDiffParams(dbg=debug)
     ndigits = 1 + max(len(str(old_max)), len(str(new_max)))
     indent = 1 + ndigits
@@ -458,7 +718,9 @@ def _TableRowGenerator(old_patch, old_dict, old_max, old_snapshot,
     row_count = 0
 
     # Render a row with a message if a side is empty or both sides are equal.
-    if old_patch == new_patch and (old_max == 0 or new_max == 0):
+    if row_range is not None:
+        pass
+    elif old_patch == new_patch and (old_max == 0 or new_max == 0):
         if old_max == 0:
             msg_old = '(Empty)'
         else:
@@ -467,49 +729,85 @@ def _TableRowGenerator(old_patch, old_dict, old_max, old_snapshot,
             msg_new = '(Empty)'
         else:
             msg_new = ''
-        yield '', ('<tr><td class="info">%s</td>'
-                   '<td class="info">%s</td></tr>' % (msg_old, msg_new))
+        yield '', [([], [([('class', 'info')], msg_old),
+                         ([('class', 'info')], msg_new)])], None, None
     elif old_patch is None or new_patch is None:
         msg_old = msg_new = ''
         if old_patch is None:
             msg_old = '(no file at all)'
         if new_patch is None:
             msg_new = '(no file at all)'
-        yield '', ('<tr><td class="info">%s</td>'
-                   '<td class="info">%s</td></tr>' % (msg_old, msg_new))
+        yield '', [([], [([('class', 'info')], msg_old),
+                         ([('class', 'info')], msg_new)])], None, None
     elif old_patch != new_patch and old_patch.lines == new_patch.lines:
-        yield '', ('<tr><td class="info" colspan="2">'
-                   '(Both sides are equal)</td></tr>')
-
-    for tag, old, new in triple_iterator:
+        yield '', [([], [([('class', 'info'), ('colspan', '2')],
+                          '(Both sides are equal)')])], None, None
+
+    ir_diffs = {}
+    if row_range is None:
+        # All the replace regions of the file are diffed at once, a row range
+        # diffs only the regions it overlaps.
+        triple_iterator = list(triple_iterator)
+        ir_indexes = [index
+                      for index, (tag, old, new) in enumerate(triple_iterator)
+                      if tag == 'replace' and
+                      intra_region_diff.CanDoIRDiff(old, new)]
+        regions = [_IntraRegion(*triple_iterator[index][1:])
+                   for index in ir_indexes]
+        ir_diffs = dict(zip(ir_indexes, intra_region_diff.IntraRegionDiffs(
+            regions, diff_params)))
+
+    for index, (tag, old, new) in enumerate(triple_iterator):
+        if tag == 'timeout':
+            if row_range is None:
+                yield 'timeout', [([], [([('class', 'info'), ('colspan', '2')],
+                                         '(Comparing the files took too long, '
+                                         'the lines not compared are shown as '
+                                         'changed)')])], None, None
+            continue
         if tag.startswith('error'):
-            yield 'error', '<tr><td><h3>%s</h3></td></tr>\n' % cgi.escape(tag)
+            if row_range is not None:
+                raise FetchError(tag)
+            yield 'error', [([], [([], '<h3>%s</h3>' % cgi.escape(tag))])], None, None
             return
         old1 = old_offset
         old_offset = old2 = old1 + len(old)
         new1 = new_offset
         new_offset = new2 = new1 + len(new)
+        block_start = row_count
+        row_count += max(len(old), len(new))
         old_buff = []
         new_buff = []
-        frag_list = []
+        attrs_list = []
         do_ir_diff = tag == 'replace' and intra_region_diff.CanDoIRDiff(
             old, new)
 
-        for i in xrange(max(len(old), len(new))):
-            row_count += 1
+        indexes = xrange(row_count - block_start)
+        if row_range is not None:
+            if block_start >= last:
+                return
+            if row_count < first:
+                # The block ends before the range, don't diff its region.
+                continue
+            if not do_ir_diff:
+                # Only the lines in the range are rendered, the others are
+                # skipped. A region is diffed as a whole, it is filtered
+                # after the intra region diff.
+                indexes = xrange(max(first - block_start - 1, 0),
+                                 min(last, row_count) - block_start)
+
+        for i in indexes:
             old_lineno = old1 + i + 1
             new_lineno = new1 + i + 1
             old_valid = old1 + i < old2
             new_valid = new1 + i < new2
 
             # Start rendering the first row
-            frags = []
+            attrs = []
             if i == 0 and tag != 'equal':
                 # Mark the first row of each non-equal chunk as a 'hook'.
-                frags.append('<tr name="hook"')
-            else:
-                frags.append('<tr')
-            frags.append(' id="pair-%d">' % row_count)
+                attrs.append(('name', 'hook'))
+            attrs.append(('id', 'pair-%d' % (block_start + i + 1)))
 
             old_intra_diff = ''
             new_intra_diff = ''
@@ -518,7 +816,7 @@ def _TableRowGenerator(old_patch, old_dict, old_max, old_snapshot,
             if new_valid:
                 new_intra_diff = new[i]
 
-            frag_list.append(frags)
+            attrs_list.append(attrs)
             if do_ir_diff:
                 # Don't render yet. Keep saving state necessary to render the whole
                 # region until we have encountered all the lines in the region.
@@ -534,23 +832,21 @@ def _TableRowGenerator(old_patch, old_dict, old_max, old_snapshot,
                                  (old_intra_diff, True, None)]]
                 new_buff_out = [[new_valid, new_lineno,
                                  (new_intra_diff, True, None)]]
-                for tg, frag in _RenderDiffInternal(old_buff_out, new_buff_out,
-                                                    ndigits, tag, frag_list,
-                                                    do_ir_diff,
-                                                    old_dict, new_dict,
-                                                    old_patch, new_patch,
-                                                    old_snapshot, new_snapshot,
-                                                    debug, request):
-                    yield tg, frag
-                frag_list = []
+                for row in _RenderDiffInternal(old_buff_out, new_buff_out,
+                                               ndigits, tag, attrs_list,
+                                               do_ir_diff, debug):
+                    yield row
+                attrs_list = []
 
         if do_ir_diff:
             # So this was a replace block which means that the whole region still
             # needs to be rendered.
             old_lines = [b[2] for b in old_buff]
             new_lines = [b[2] for b in new_buff]
-            ret = intra_region_diff.IntraRegionDiff(old_lines, new_lines,
-                                                    diff_params)
+            ret = ir_diffs.get(index)
+            if ret is None:
+                ret = intra_region_diff.IntraRegionDiff(old_lines, new_lines,
+                                                        diff_params)
             old_chunks, new_chunks, ratio = ret
             old_tag = 'old'
             new_tag = 'new'
@@ -568,91 +864,151 @@ def _TableRowGenerator(old_patch, old_dict, old_max, old_snapshot,
             for (i, b) in enumerate(new_buff):
                 b[2] = new_diff_out[i]
 
-            for tg, frag in _RenderDiffInternal(old_buff, new_buff,
-                                                ndigits, tag, frag_list,
-                                                do_ir_diff,
-                                                old_dict, new_dict,
-                                                old_patch, new_patch,
-                                                old_snapshot, new_snapshot,
-                                                debug, request):
-                yield tg, frag
+            if row_range is not None:
+                start = max(first - block_start - 1, 0)
+                end = last - block_start
+                old_buff = old_buff[start:end]
+                new_buff = new_buff[start:end]
+                attrs_list = attrs_list[start:end]
+            for row in _RenderDiffInternal(old_buff, new_buff,
+                                           ndigits, tag, attrs_list,
+                                           do_ir_diff, debug):
+                yield row
             old_buff = []
             new_buff = []
 
 
-def _RenderDiffInternal(old_buff, new_buff, ndigits, tag, frag_list,
-                        do_ir_diff, old_dict, new_dict,
-                        old_patch, new_patch,
-                        old_snapshot, new_snapshot,
-                        debug, request):
-    """Helper for _TableRowGenerator()."""
+def _IntraRegion(old, new):
+    """Helper for _CodeCellGenerator() returning the lines of a region.
+
+    Args:
+      old: List of the lines on the left.
+      new: List of the lines on the right.
+
+    Returns:
+      A tuple (old_lines, new_lines) of the lines as diffed by
+      intra_region_diff.IntraRegionDiff(), the shorter side padded with
+      empty lines.
+    """
+    size = max(len(old), len(new))
+    return (list(old) + [''] * (size - len(old)),
+            list(new) + [''] * (size - len(new)))
+
+
+def _RenderDiffInternal(old_buff, new_buff, ndigits, tag, attrs_list,
+                        do_ir_diff, debug):
+    """Helper for _CodeCellGenerator()."""
     obegin = (intra_region_diff.BEGIN_TAG %
               intra_region_diff.COLOR_SCHEME['old']['match'])
     nbegin = (intra_region_diff.BEGIN_TAG %
               intra_region_diff.COLOR_SCHEME['new']['match'])
     oend = intra_region_diff.END_TAG
     nend = oend
-    user = users.get_current_user()
 
     for i in xrange(len(old_buff)):
-        tg = tag
         old_valid, old_lineno, old_out = old_buff[i]
         new_valid, new_lineno, new_out = new_buff[i]
         old_intra_diff, old_has_newline, old_debug_info = old_out
         new_intra_diff, new_has_newline, new_debug_info = new_out
 
-        frags = frag_list[i]
-        # Render left text column
-        frags.append(_RenderDiffColumn(old_valid, tag, ndigits,
-                                       old_lineno, obegin, oend, old_intra_diff,
-                                       do_ir_diff, old_has_newline, 'old'))
+        # Render left and right text columns of the first row
+        table_rows = [(attrs_list[i], [
+            _RenderDiffColumn(old_valid, tag, ndigits,
+                              old_lineno, obegin, oend, old_intra_diff,
+                              do_ir_diff, old_has_newline, 'old'),
+            _RenderDiffColumn(new_valid, tag, ndigits,
+                              new_lineno, nbegin, nend, new_intra_diff,
+                              do_ir_diff, new_has_newline, 'new'),
+        ])]
 
-        # Render right text column
-        frags.append(_RenderDiffColumn(new_valid, tag, ndigits,
-                                       new_lineno, nbegin, nend, new_intra_diff,
-                                       do_ir_diff, new_has_newline, 'new'))
+        if debug:
+            cells = []
+            for debug_info in (old_debug_info, new_debug_info):
+                if debug_info:
+                    cells.append(([('class', 'debug-info')],
+                                  debug_info.replace('\n', '<br>')))
+                else:
+                    cells.append(([], ''))
+            table_rows.append(([], cells))
 
-        # End rendering the first row
-        frags.append('</tr>\n')
+        yield (tag, table_rows, old_lineno if old_valid else None,
+               new_lineno if new_valid else None)
 
-        if debug:
-            frags.append('<tr>')
-            if old_debug_info:
-                frags.append('<td class="debug-info">%s</td>' %
-                             old_debug_info.replace('\n', '<br>'))
-            else:
-                frags.append('<td></td>')
-            if new_debug_info:
-                frags.append('<td class="debug-info">%s</td>' %
-                             new_debug_info.replace('\n', '<br>'))
-            else:
-                frags.append('<td></td>')
-            frags.append('</tr>\n')
-
-        if old_patch or new_patch:
-            # Start rendering the second row
-            if ((old_valid and old_lineno in old_dict) or
-                    (new_valid and new_lineno in new_dict)):
-                tg += '_comment'
-                frags.append('<tr class="inline-comments" name="hook">')
-            else:
-                frags.append('<tr class="inline-comments">')
 
-            # Render left inline comments
-            frags.append(_RenderInlineComments(old_valid, old_lineno, old_dict,
-                                               user, old_patch, old_snapshot, 'old',
-                                               request))
+def _CommentRowGenerator(code_rows, old_patch, old_dict, old_snapshot,
+                         new_patch, new_dict, new_snapshot, request):
+    """Add the inline comments rows to the code rows.
 
-            # Render right inline comments
-            frags.append(_RenderInlineComments(new_valid, new_lineno, new_dict,
-                                               user, new_patch, new_snapshot, 'new',
-                                               request))
+    Args:
+      code_rows: Code rows as yielded by _CodeRowGenerator().
+      old_patch: First models.Patch instance.
+      old_dict: Dictionary with line numbers as keys and comments as values (left)
+      old_snapshot: A tag used in the comments form.
+      new_patch: Second models.Patch instance.
+      new_dict: Same as old_dict, but for the right side.
+      new_snapshot: A tag used in the comments form.
+      request: Django Request object.
+
+    Yields:
+      Tuples (tag, row) where tag is an indication of the row type and
+      row is an HTML fragment representing one or more <tr> elements.
+    """
+    user = users.get_current_user()
+    for tag, row, old_lineno, new_lineno in code_rows:
+        if tag in ('', 'error', 'timeout') or not (old_patch or new_patch):
+            yield tag, row
+            continue
+        has_comments, attrs, cells = _RenderInlineCommentsRow(
+            old_lineno, old_patch, old_dict, old_snapshot,
+            new_lineno, new_patch, new_dict, new_snapshot, user, request)
+        if has_comments:
+            tag += '_comment'
+        yield tag, row + _FormatTableRow(attrs, cells)
 
-            # End rendering the second row
-            frags.append('</tr>\n')
 
-        # Yield the combined fragments
-        yield tg, ''.join(frags)
+def _StructuredRows(cell_rows, old_patch, old_dict, old_snapshot,
+                    new_patch, new_dict, new_snapshot, request):
+    """Add the inline comments rows to the code cell rows, without rendering HTML.
+
+    Args:
+      cell_rows: Code cell rows as yielded by _CodeCellGenerator().
+      The others are the same as for _CommentRowGenerator().
+
+    Returns:
+      A list of [attrs, cells] lists of the <tr> elements, where attrs is a
+      list of (name, value) attribute tuples and cells is a list of
+      [attrs, html] lists of the <td> elements, as used by M_expandSkipped()
+      in static/script.js.
+    """
+    user = users.get_current_user()
+    rows = []
+    for tag, table_rows, old_lineno, new_lineno in cell_rows:
+        table_rows = table_rows + [_RenderInlineCommentsRow(
+            old_lineno, old_patch, old_dict, old_snapshot,
+            new_lineno, new_patch, new_dict, new_snapshot, user, request)[1:]]
+        for attrs, cells in table_rows:
+            rows.append([attrs, [list(cell) for cell in cells]])
+    return rows
+
+
+def _FormatAttributes(attrs):
+    """Format the (name, value) tuples of HTML element attributes."""
+    return ''.join(' %s="%s"' % attr for attr in attrs)
+
+
+def _FormatTableRow(attrs, cells):
+    """Render the HTML of a table row.
+
+    Args:
+      attrs: List of (name, value) attribute tuples of the <tr> element.
+      cells: List of (attrs, html) tuples of its <td> elements.
+
+    Returns:
+      A string with the <tr> element.
+    """
+    return '<tr%s>%s</tr>\n' % (_FormatAttributes(attrs), ''.join(
+        '<td%s>%s</td>' % (_FormatAttributes(cell_attrs), html)
+        for cell_attrs, html in cells))
 
 
 def _RenderDiffColumn(line_valid, tag, ndigits, lineno, begin, end,
@@ -660,7 +1016,7 @@ def _RenderDiffColumn(line_valid, tag, ndigits, lineno, begin, end,
     """Helper function for _RenderDiffInternal().
 
     Returns:
-      A rendered column.
+      A tuple (attrs, html) of the rendered column.
     """
     if line_valid:
         cls_attr = '%s%s' % (prefix, tag)
@@ -672,39 +1028,75 @@ def _RenderDiffColumn(line_valid, tag, ndigits, lineno, begin, end,
                 cls_attr = cls_attr + '1'
         else:
             col_content = intra_diff
-        return '<td class="%s" id="%scode%d"><code class="prettyprint linenums:%s">%s</code></td>' % (
-            cls_attr, prefix, lineno, lineno, col_content)
+        return ([('class', cls_attr), ('id', '%scode%d' % (prefix, lineno))],
+                '<code class="prettyprint linenums:%s">%s</code>' % (lineno, col_content))
     else:
-        return '<td class="%sblank"></td>' % prefix
+        return [('class', '%sblank' % prefix)], ''
+
+
+def _RenderInlineCommentsRow(old_lineno, old_patch, old_dict, old_snapshot,
+                             new_lineno, new_patch, new_dict, new_snapshot,
+                             user, request):
+    """Helper function rendering the inline comments row of a code row.
+
+    Returns:
+      A tuple (has_comments, attrs, cells) where has_comments tells whether
+      any of the lines is commented, attrs and cells are as expected by
+      _FormatTableRow().
+    """
+    old_valid = old_lineno is not None
+    new_valid = new_lineno is not None
+    attrs = [('class', 'inline-comments')]
+    has_comments = ((old_valid and old_lineno in old_dict) or
+                    (new_valid and new_lineno in new_dict))
+    if has_comments:
+        attrs.append(('name', 'hook'))
+    cells = [
+        _RenderInlineCommentsCell(old_valid, old_lineno, old_dict,
+                                  user, old_patch, old_snapshot, 'old',
+                                  request),
+        _RenderInlineCommentsCell(new_valid, new_lineno, new_dict,
+                                  user, new_patch, new_snapshot, 'new',
+                                  request),
+    ]
+    return has_comments, attrs, cells
 
 
 def _RenderInlineComments(line_valid, lineno, data, user,
                           patch, snapshot, prefix, request):
-    """Helper function for _RenderDiffInternal().
+    """Helper function for RenderUnifiedTableRows().
 
     Returns:
       Rendered comments.
     """
-    comments = []
-    if line_valid:
-        comments.append('<td id="%s-line-%s">' % (prefix, lineno))
-        if lineno in data:
-            comments.append(
-                _ExpandTemplate('inline_comment.html',
-                                request,
-                                user=user,
-                                patch=patch,
-                                patchset=patch.patchset,
-                                issue=patch.patchset.issue,
-                                snapshot=snapshot,
-                                side='a' if prefix == 'old' else 'b',
-                                comments=data[lineno],
-                                lineno=lineno,
-                                ))
-        comments.append('</td>')
-    else:
-        comments.append('<td></td>')
-    return ''.join(comments)
+    attrs, html = _RenderInlineCommentsCell(line_valid, lineno, data, user,
+                                            patch, snapshot, prefix, request)
+    return '<td%s>%s</td>' % (_FormatAttributes(attrs), html)
+
+
+def _RenderInlineCommentsCell(line_valid, lineno, data, user,
+                              patch, snapshot, prefix, request):
+    """Helper function for _RenderInlineCommentsRow().
+
+    Returns:
+      A tuple (attrs, html) of the rendered comments cell.
+    """
+    if not line_valid:
+        return [], ''
+    html = ''
+    if lineno in data:
+        html = _ExpandTemplate('inline_comment.html',
+                               request,
+                               user=user,
+                               patch=patch,
+                               patchset=patch.patchset,
+                               issue=patch.patchset.issue,
+                               snapshot=snapshot,
+                               side='a' if prefix == 'old' else 'b',
+                               comments=data[lineno],
+                               lineno=lineno,
+                               )
+    return [('id', '%s-line-%s' % (prefix, lineno))], html
 
 
 def RenderUnifiedTableRows(request, parsed_lines):
@@ -716,11 +1108,14 @@ def RenderUnifiedTableRows(request, parsed_lines):
         if they exist, for the old and new file.
 
     Returns:
-      A list of html table rows.
+      An iterator over the html table rows, the comments are fetched up front.
     """
     old_dict, new_dict = _GetComments(request)
+    return _UnifiedRowGenerator(request, parsed_lines, old_dict, new_dict)
 
-    rows = []
+
+def _UnifiedRowGenerator(request, parsed_lines, old_dict, new_dict):
+    """Helper for RenderUnifiedTableRows() yielding the html table rows."""
     for old_line_no, new_line_no, line_text in parsed_lines:
         row1_id = row2_id = ''
         # When a line is unchanged (i.e. both old_line_no and new_line_no aren't 0)
@@ -739,8 +1134,8 @@ def RenderUnifiedTableRows(request, parsed_lines):
         else:
             style = ''
 
-        rows.append('<tr><td class="udiff %s" %s>%s</td></tr>' %
-                    (style, row1_id, cgi.escape(line_text)))
+        yield ('<tr><td class="udiff %s" %s>%s</td></tr>' %
+               (style, row1_id, cgi.escape(line_text)))
 
         frags = []
         if old_line_no in old_dict or new_line_no in new_dict:
@@ -760,8 +1155,7 @@ def RenderUnifiedTableRows(request, parsed_lines):
             frags.append('<tr class="inline-comments">')
             frags.append('<td ' + row2_id + '></td>')
         frags.append('</tr>')
-        rows.append(''.join(frags))
-    return rows
+        yield ''.join(frags)
 
 
 def _ComputeLineCounts(old_lines, chunks):
@@ -780,7 +1174,7 @@ def _ComputeLineCounts(old_lines, chunks):
     old_len = len(old_lines)
     new_len = old_len
     if chunks:
-        (_, old_b), (_, new_b), old_lines, _ = chunks[-1]
+        (_, old_b), (_, new_b) = chunks[-1][:2]
         new_len += new_b - old_b
     return old_len, new_len
 
@@ -43,8 +43,12 @@ the end of the sequence and retain it.
 """
 
 import cgi
+import collections
 import difflib
+import functools
+import hashlib
 import re
+import threading
 
 # Tag to begin a diff chunk.
 BEGIN_TAG = "<span class=\"%s\">"
@@ -83,10 +87,58 @@ EXPRS = {
     'c': r'([A-Za-z0-9_]+|[^A-Za-z0-9_])',
     'd': r'([^\W_]+|[\W_])',
 }
+# Regular expressions which words never span a newline, so the words of a
+# region are the words of its lines.
+LINE_EXPRS = frozenset(['b', 'c', 'd'])
 # Maximum total characters in old and new lines for doing intra-region diffs.
 # Intra-region diff for larger regions is hard to comprehend and wastes CPU
 # time.
 MAX_TOTAL_LEN = 10000
+# Number of the most recently used tokenized lines and intra-region diffs kept
+# in memory, identical regions are common between the diff views and users.
+TOKEN_CACHE_SIZE = 10000
+DIFF_CACHE_SIZE = 5000
+
+
+class LRUCache(object):
+
+    """Thread safe mapping keeping the most recently used items."""
+
+    def __init__(self, size):
+        self.size = size
+        self.items = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the item of the key or None, marks it as used."""
+        with self.lock:
+            value = self.items.pop(key, None)
+            if value is not None:
+                self.items[key] = value
+            return value
+
+    def set(self, key, value):
+        """Stores the item, removes the least recently used one if full."""
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = value
+            if len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+    def clear(self):
+        """Removes all the items."""
+        with self.lock:
+            self.items.clear()
+
+
+_token_cache = LRUCache(TOKEN_CACHE_SIZE)
+_diff_cache = LRUCache(DIFF_CACHE_SIZE)
+
+
+def ClearCaches():
+    """Forgets the tokenized lines and the intra-region diffs."""
+    _token_cache.clear()
+    _diff_cache.clear()
 
 
 def _ExpandTabs(text, column, tabsize, mark_tabs=False):
@@ -262,13 +314,66 @@ def CanDoIRDiff(old_lines, new_lines):
     return total_chars <= MAX_TOTAL_LEN
 
 
-def WordDiff(line1, line2, diff_params):
+def _Decode(line):
+    """Decodes the string from UTF-8, it may have been left undecoded."""
+    try:
+        return unicode(line, "utf8")
+    except:
+        return line
+
+
+def Tokenize(line, expr):
+    """Returns the words of a line, the tokenized lines are cached.
+
+    Args:
+      line: string to split into words
+      expr: regular expression id of the words
+    """
+    key = (expr, isinstance(line, unicode), line)
+    tokens = _token_cache.get(key)
+    if tokens is None:
+        tokens = re.findall(EXPRS[expr], line, re.U)
+        _token_cache.set(key, tokens)
+    return tokens
+
+
+def _TokenizeRegion(lines, expr):
+    """Returns the words of the region joined by ConvertToSingleLine.
+
+    The words are the words of the individual lines, so the lines repeated
+    in the regions are tokenized once.
+
+    Args:
+      lines: array of strings
+      expr: regular expression id of the words
+
+    Returns:
+      The list of the words, or None if they can't be taken from the lines
+      because a word could span two lines.
+    """
+    lines = [line for line in lines if line]
+    if expr not in LINE_EXPRS or not all(line.endswith('\n')
+                                         for line in lines[:-1]):
+        return None
+    decoded = [_Decode(line) for line in lines]
+    # A line which can't be decoded leaves the whole region undecoded.
+    if not all(isinstance(line, unicode) for line in decoded):
+        decoded = lines
+    tokens = []
+    for line in decoded:
+        tokens.extend(Tokenize(line, expr))
+    return tokens
+
+
+def WordDiff(line1, line2, diff_params, tokens=None):
     """Returns blocks with positions indiciating word level diffs.
 
     Args:
       line1: string representing the left part of the diff
       line2: string representing the right part of the diff
       diff_params: return value of GetDiffParams
+      tokens: optional tuple of the words of line1 and line2, they are
+              computed if not given
 
     Returns:
       A tuple (blocks, ratio) where:
@@ -278,19 +383,13 @@ def WordDiff(line1, line2, diff_params):
         ratio: a float giving the diff ratio computed by SequenceMatcher.
     """
     match_expr, min_match_ratio, min_match_size, _ = diff_params
-    exp = EXPRS[match_expr]
     # Strings may have been left undecoded up to now. Assume UTF-8.
-    try:
-        line1 = unicode(line1, "utf8")
-    except:
-        pass
-    try:
-        line2 = unicode(line2, "utf8")
-    except:
-        pass
+    line1 = _Decode(line1)
+    line2 = _Decode(line2)
 
-    a = re.findall(exp, line1, re.U)
-    b = re.findall(exp, line2, re.U)
+    if tokens is None:
+        tokens = Tokenize(line1, match_expr), Tokenize(line2, match_expr)
+    a, b = tokens
     s = difflib.SequenceMatcher(None, a, b)
     matching_blocks = s.get_matching_blocks()
     ratio = s.ratio()
@@ -573,9 +672,23 @@ def GetBlocks(state):
     return result
 
 
+def _RegionHash(lines):
+    """Returns the hash identifying the lines of a region."""
+    region_hash = hashlib.sha1()
+    for line in lines:
+        if isinstance(line, unicode):
+            line = line.encode('utf-8')
+        region_hash.update('%d:' % len(line))
+        region_hash.update(line)
+    return region_hash.digest()
+
+
 def IntraRegionDiff(old_lines, new_lines, diff_params):
     """Computes intra region diff.
 
+    The diffs of the most recently diffed regions are cached, the returned
+    blocks must not be modified.
+
     Args:
       old_lines: array of strings
       new_lines: array of strings
@@ -585,10 +698,47 @@ def IntraRegionDiff(old_lines, new_lines, diff_params):
       A tuple (old_blocks, new_blocks) containing matching blocks for old and new
       lines.
     """
+    return IntraRegionDiffs([(old_lines, new_lines)], diff_params)[0]
+
+
+def IntraRegionDiffs(regions, diff_params):
+    """Computes the intra region diffs of all the regions of a file at once.
+
+    Identical regions are diffed once and the diffs of the most recently
+    diffed regions are cached.
+
+    Args:
+      regions: list of (old_lines, new_lines) tuples as passed to
+               IntraRegionDiff
+      diff_params: return value of GetDiffParams
+
+    Returns:
+      A list of the IntraRegionDiff results of the regions.
+    """
+    results = []
+    diffs = {}
+    for old_lines, new_lines in regions:
+        key = (_RegionHash(old_lines), _RegionHash(new_lines), diff_params)
+        result = diffs.get(key) or _diff_cache.get(key)
+        if result is None:
+            result = _IntraRegionDiff(old_lines, new_lines, diff_params)
+            _diff_cache.set(key, result)
+        diffs[key] = result
+        results.append(result)
+    return results
+
+
+def _IntraRegionDiff(old_lines, new_lines, diff_params):
+    """Computes intra region diff, without caching."""
     old_line, old_state = ConvertToSingleLine(old_lines)
     new_line, new_state = ConvertToSingleLine(new_lines)
+    diff_func = WordDiff
+    old_tokens = _TokenizeRegion(old_lines, diff_params[0])
+    new_tokens = _TokenizeRegion(new_lines, diff_params[0])
+    if old_tokens is not None and new_tokens is not None:
+        diff_func = functools.partial(WordDiff, tokens=(old_tokens, new_tokens))
     old_blocks, new_blocks, ratio = IntraLineDiff(
-        old_line, new_line, diff_params)
+        old_line, new_line, diff_params, diff_func)
     for begin, length in old_blocks:
         MarkBlock(old_state, begin, begin + length)
     old_blocks = GetBlocks(old_state)
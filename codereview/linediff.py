@@ -0,0 +1,339 @@
+"""Line diff algorithms used to compare whole files.
+
+The lines are replaced by integers, equal lines by the same integer, and
+diffed by one of the ALGORITHMS:
+
+  difflib: difflib.SequenceMatcher, the historical algorithm.
+  myers: Myers' O(ND) algorithm in linear space, a minimal diff.
+  histogram: the histogram diff of git, anchoring the diff on the least
+    frequent common lines and using myers where there are none. It
+    follows the structure of the file better on lines repeated a lot.
+
+Myers and histogram stop refining the diff when the time limit is
+reached, the parts not diffed yet are reported as replaced.
+"""
+
+import bisect
+import difflib
+import logging
+import time
+
+from django.conf import settings as django_settings
+
+
+# Lines occurring more often than this in a region are not used as anchors
+# by the histogram diff.
+MAX_CHAIN_LENGTH = 64
+
+
+class _Deadline(object):
+
+    """Time limit of a diff."""
+
+    def __init__(self, timeout):
+        self.end = None if timeout is None else time.time() + timeout
+        self.reached = False
+
+    def Check(self):
+        """Returns True if the time limit is reached."""
+        if not self.reached and self.end is not None and time.time() > self.end:
+            self.reached = True
+        return self.reached
+
+
+def _Intern(old_lines, new_lines):
+    """Replace the lines by integers, the same ones for equal lines."""
+    ids = {}
+    old = [ids.setdefault(line, len(ids)) for line in old_lines]
+    new = [ids.setdefault(line, len(ids)) for line in new_lines]
+    return old, new
+
+
+def _Trim(a, a_lo, a_hi, b, b_lo, b_hi, matches):
+    """Strip the common prefix and suffix of a region, appending the prefix
+    to the matches.
+
+    Returns:
+      A tuple (a_lo, a_hi, b_lo, b_hi, suffix) of the remaining region and
+      the matching block of the suffix or None.
+    """
+    start = a_lo
+    while a_lo < a_hi and b_lo < b_hi and a[a_lo] == b[b_lo]:
+        a_lo += 1
+        b_lo += 1
+    if a_lo > start:
+        matches.append((start, b_lo - (a_lo - start), a_lo - start))
+    end = a_hi
+    while a_lo < a_hi and b_lo < b_hi and a[a_hi - 1] == b[b_hi - 1]:
+        a_hi -= 1
+        b_hi -= 1
+    suffix = (a_hi, b_hi, end - a_hi) if a_hi < end else None
+    return a_lo, a_hi, b_lo, b_hi, suffix
+
+
+def _MiddleSnake(a, a_lo, a_hi, b, b_lo, b_hi, deadline):
+    """Find the middle snake of the shortest edit script of a region.
+
+    Returns:
+      A tuple (x, y, u, v): the snake goes from a[x], b[y] to a[u], b[v],
+      relative to the region start.  None if the time limit is reached.
+    """
+    n = a_hi - a_lo
+    m = b_hi - b_lo
+    delta = n - m
+    odd = delta % 2 != 0
+    forward = {1: 0}
+    backward = {1: 0}
+    for d in xrange((n + m + 1) // 2 + 1):
+        if deadline.Check():
+            return None
+        for k in xrange(-d, d + 1, 2):
+            if k == -d or (k != d and forward[k - 1] < forward[k + 1]):
+                x = forward[k + 1]
+            else:
+                x = forward[k - 1] + 1
+            y = x - k
+            x0, y0 = x, y
+            while x < n and y < m and a[a_lo + x] == b[b_lo + y]:
+                x += 1
+                y += 1
+            forward[k] = x
+            if odd and -(d - 1) <= delta - k <= d - 1 and x + backward[delta - k] >= n:
+                return x0, y0, x, y
+        for k in xrange(-d, d + 1, 2):
+            if k == -d or (k != d and backward[k - 1] < backward[k + 1]):
+                x = backward[k + 1]
+            else:
+                x = backward[k - 1] + 1
+            y = x - k
+            x0, y0 = x, y
+            while x < n and y < m and a[a_hi - 1 - x] == b[b_hi - 1 - y]:
+                x += 1
+                y += 1
+            backward[k] = x
+            if not odd and -d <= delta - k <= d and x + forward[delta - k] >= n:
+                return n - x, m - y, n - x0, m - y0
+    raise AssertionError('No middle snake found')
+
+
+def _MyersMatches(a, a_lo, a_hi, b, b_lo, b_hi, matches, deadline):
+    """Append the matching blocks of a region by Myers' algorithm."""
+    a_lo, a_hi, b_lo, b_hi, suffix = _Trim(a, a_lo, a_hi, b, b_lo, b_hi,
+                                           matches)
+    snake = None
+    if a_lo < a_hi and b_lo < b_hi:
+        snake = _MiddleSnake(a, a_lo, a_hi, b, b_lo, b_hi, deadline)
+    if snake:
+        x, y, u, v = snake
+        _MyersMatches(a, a_lo, a_lo + x, b, b_lo, b_lo + y, matches, deadline)
+        if u > x:
+            matches.append((a_lo + x, b_lo + y, u - x))
+        _MyersMatches(a, a_lo + u, a_hi, b, b_lo + v, b_hi, matches, deadline)
+    if suffix:
+        matches.append(suffix)
+
+
+def _FindAnchors(a, a_lo, a_hi, b, b_lo, b_hi):
+    """Find the anchors of the histogram diff of a region.
+
+    An anchor is a common block of the lowest occurrence count, the count in
+    a of its least frequent line.  If some lines are unique, all the blocks of
+    count 1 that keep their order in both sides are anchors.  Otherwise the
+    anchor is the longest block of the lowest count.
+
+    Returns:
+      A list of matching block tuples (i, j, size), empty if no line is common
+      and frequent less than MAX_CHAIN_LENGTH times.
+    """
+    positions = {}
+    for i in xrange(a_lo, a_hi):
+        positions.setdefault(a[i], []).append(i)
+    best = None
+    best_count = None
+    unique = []
+    j = b_lo
+    while j < b_hi:
+        next_j = j + 1
+        chain = positions.get(b[j])
+        if chain is not None and len(chain) <= MAX_CHAIN_LENGTH:
+            for i in chain:
+                count = len(chain)
+                start_i, start_j = i, j
+                while (start_i > a_lo and start_j > b_lo and
+                       a[start_i - 1] == b[start_j - 1]):
+                    start_i -= 1
+                    start_j -= 1
+                    count = min(count, len(positions[a[start_i]]))
+                end_i, end_j = i + 1, j + 1
+                while end_i < a_hi and end_j < b_hi and a[end_i] == b[end_j]:
+                    count = min(count, len(positions[a[end_i]]))
+                    end_i += 1
+                    end_j += 1
+                if count == 1:
+                    unique.append((start_i, start_j, end_i - start_i))
+                if (best is None or count < best_count or
+                        (count == best_count and end_i - start_i > best[2])):
+                    best = (start_i, start_j, end_i - start_i)
+                    best_count = count
+                next_j = max(next_j, end_j)
+        j = next_j
+    if unique:
+        return _IncreasingBlocks(sorted(unique, key=lambda block: block[1]))
+    return [best] if best else []
+
+
+def _IncreasingBlocks(blocks):
+    """Select the longest sequence of blocks ordered in both sides.
+
+    Args:
+      blocks: List of matching blocks (i, j, size), ordered by j.
+
+    Returns:
+      A list of matching blocks not overlapping each other.
+    """
+    # Patience sorting: tails[k] is the smallest start in a of the last block
+    # of a sequence of k + 1 blocks, ends[k] the index of that block.
+    tails = []
+    ends = []
+    previous = []
+    for index, (i, j, size) in enumerate(blocks):
+        k = bisect.bisect_left(tails, i)
+        previous.append(ends[k - 1] if k else None)
+        if k == len(tails):
+            tails.append(i)
+            ends.append(index)
+        else:
+            tails[k] = i
+            ends[k] = index
+    selected = []
+    index = ends[-1]
+    while index is not None:
+        selected.append(blocks[index])
+        index = previous[index]
+    selected.reverse()
+    result = []
+    for block in selected:
+        if (not result or (block[0] >= result[-1][0] + result[-1][2] and
+                           block[1] >= result[-1][1] + result[-1][2])):
+            result.append(block)
+    return result
+
+
+def _HistogramMatches(a, a_lo, a_hi, b, b_lo, b_hi, matches, deadline):
+    """Append the matching blocks of a region by the histogram diff."""
+    # Regions to diff and matching blocks, in the reverse order.
+    stack = [(a_lo, a_hi, b_lo, b_hi)]
+    while stack:
+        item = stack.pop()
+        if len(item) == 3:
+            matches.append(item)
+            continue
+        a_lo, a_hi, b_lo, b_hi, suffix = _Trim(a, item[0], item[1], b,
+                                               item[2], item[3], matches)
+        if suffix:
+            stack.append(suffix)
+        if a_lo == a_hi or b_lo == b_hi or deadline.Check():
+            continue
+        anchors = _FindAnchors(a, a_lo, a_hi, b, b_lo, b_hi)
+        if not anchors:
+            _MyersMatches(a, a_lo, a_hi, b, b_lo, b_hi, matches, deadline)
+            continue
+        for i, j, size in reversed(anchors):
+            stack.append((i + size, a_hi, j + size, b_hi))
+            stack.append((i, j, size))
+            a_hi, b_hi = i, j
+        stack.append((a_lo, a_hi, b_lo, b_hi))
+
+
+def _OpcodesFromMatches(matches, n, m):
+    """Convert ordered matching blocks into difflib opcodes."""
+    opcodes = []
+    i = j = 0
+    for match_i, match_j, size in matches + [(n, m, 0)]:
+        if i < match_i and j < match_j:
+            opcodes.append(('replace', i, match_i, j, match_j))
+        elif i < match_i:
+            opcodes.append(('delete', i, match_i, j, match_j))
+        elif j < match_j:
+            opcodes.append(('insert', i, match_i, j, match_j))
+        if size:
+            if opcodes and opcodes[-1][0] == 'equal':
+                _, i1, _, j1, _ = opcodes.pop()
+            else:
+                i1, j1 = match_i, match_j
+            opcodes.append(('equal', i1, match_i + size, j1, match_j + size))
+        i, j = match_i + size, match_j + size
+    return opcodes
+
+
+def _DifflibOpcodes(a, b, deadline):
+    """Diff by difflib.SequenceMatcher, the time limit is not applied."""
+    return difflib.SequenceMatcher(None, a, b).get_opcodes()
+
+
+def _MyersOpcodes(a, b, deadline):
+    """Diff by Myers' algorithm."""
+    matches = []
+    _MyersMatches(a, 0, len(a), b, 0, len(b), matches, deadline)
+    return _OpcodesFromMatches(matches, len(a), len(b))
+
+
+def _HistogramOpcodes(a, b, deadline):
+    """Diff by the histogram diff."""
+    matches = []
+    _HistogramMatches(a, 0, len(a), b, 0, len(b), matches, deadline)
+    return _OpcodesFromMatches(matches, len(a), len(b))
+
+
+# Functions (a, b, deadline) returning the opcodes of the integer lists.
+ALGORITHMS = {
+    'difflib': _DifflibOpcodes,
+    'myers': _MyersOpcodes,
+    'histogram': _HistogramOpcodes,
+}
+
+
+def GetAlgorithm():
+    """Returns the name of the configured algorithm."""
+    return django_settings.CODEREVIEW_DIFF_ALGORITHM
+
+
+def GetOpcodes(old_lines, new_lines, algorithm=None, timeout=None):
+    """Diff two lists of lines.
+
+    Args:
+      old_lines: List of lines on the left.
+      new_lines: List of lines on the right.
+      algorithm: Optional name of one of the ALGORITHMS, the
+        CODEREVIEW_DIFF_ALGORITHM setting by default.
+      timeout: Optional number of seconds after which the diff isn't refined
+        anymore, the CODEREVIEW_DIFF_TIMEOUT setting by default.
+
+    Returns:
+      A list of (tag, i1, i2, j1, j2) tuples as returned by
+      difflib.SequenceMatcher.get_opcodes().
+    """
+    return Diff(old_lines, new_lines, algorithm, timeout)[0]
+
+
+def Diff(old_lines, new_lines, algorithm=None, timeout=None):
+    """Diff two lists of lines, telling if the time limit was reached.
+
+    Args:
+      The same as for GetOpcodes.
+
+    Returns:
+      A tuple (opcodes, timed_out) of the opcodes as returned by GetOpcodes()
+      and True if they are not refined completely.
+    """
+    if algorithm is None:
+        algorithm = GetAlgorithm()
+    if timeout is None:
+        timeout = django_settings.CODEREVIEW_DIFF_TIMEOUT
+    a, b = _Intern(old_lines, new_lines)
+    deadline = _Deadline(timeout)
+    opcodes = ALGORITHMS[algorithm](a, b, deadline)
+    if deadline.reached:
+        logging.warn('%s diff of %d and %d lines timed out after %s seconds',
+                     algorithm, len(a), len(b), timeout)
+    return opcodes, deadline.reached
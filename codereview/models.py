@@ -15,7 +15,7 @@
 """App Engine data model (schema) definition for Rietveld."""
 
 import logging
-from hashlib import md5
+from hashlib import md5, sha1
 import os
 import re
 import time
@@ -24,6 +24,8 @@ from google.appengine.ext import db
 from google.appengine.api import memcache
 from google.appengine.api import users
 
+from django import db as django_db
+from django.utils import simplejson
 from django.utils.encoding import force_unicode
 
 import engine
@@ -59,6 +61,108 @@ def gql(cls, clause, *args, **kwds):
     return query
 
 
+# Header queries ###
+
+
+def patchset_headers(issue):
+    """Return the patch sets of an issue in order, without their diffs.
+
+    The data of a patch set is loaded from the database when it's accessed,
+    listing the patch sets only needs their other columns.
+
+    Args:
+      issue: an Issue instance.
+
+    Returns:
+      A query of the PatchSet instances ordered by creation.
+    """
+    return PatchSet.objects.filter(issue=issue).order_by('created').defer('data')
+
+
+def patch_headers(patchset):
+    """Return the patches of a patch set ordered by filename, without their text.
+
+    The text of a patch is loaded from the database when it's accessed, the
+    filenames, the statistics and the contents are loaded up front.
+
+    Args:
+      patchset: a PatchSet instance.
+
+    Returns:
+      A query of the Patch instances ordered by filename.
+    """
+    return Patch.objects.filter(patchset=patchset).order_by('filename').defer('text')
+
+
+def _unused_content_condition(except_patch_id=None):
+    """Return the SQL condition of the contents not used by any patch.
+
+    Args:
+      except_patch_id: Optional id of a patch whose content doesn't count.
+
+    Returns:
+      A tuple (sql, params).
+    """
+    content_column = Patch._meta.get_field('content').column
+    patched_content_column = Patch._meta.get_field('patched_content').column
+    sql = ('id NOT IN (SELECT {1} FROM {0} WHERE {1} IS NOT NULL AND id != %s) AND '
+           'id NOT IN (SELECT {2} FROM {0} WHERE {2} IS NOT NULL)').format(
+        Patch._meta.db_table, content_column, patched_content_column)
+    # ids start at 1
+    return sql, [except_patch_id or 0]
+
+
+def delete_unused_contents(content_ids):
+    """Delete the given contents which are not used by any patch.
+
+    Contents are shared by checksum, so a content can get used again while
+    it's being deleted. The contents are deleted by a single statement
+    checking that they are not used. Unlike QuerySet.delete(), it never
+    deletes the patches referencing a content: a patch which starts to use
+    one meanwhile makes the statement fail on its foreign key.
+
+    Args:
+      content_ids: List of the ids of the contents to delete.
+
+    Returns:
+      The number of the deleted contents.
+    """
+    if not content_ids:
+        return 0
+    condition, params = _unused_content_condition()
+    cursor = django_db.connection.cursor()
+    cursor.execute('DELETE FROM {0} WHERE id IN ({1}) AND {2}'.format(
+        Content._meta.db_table, ', '.join(['%s'] * len(content_ids)), condition),
+        list(content_ids) + params)
+    django_db.transaction.commit_unless_managed()
+    return cursor.rowcount
+
+
+def mark_content_bad(content, patch):
+    """Mark the content bad and drop its text, unless other patches use it.
+
+    The check and the update are a single statement, so a content which gets
+    used by another patch meanwhile is never marked bad.
+
+    Args:
+      content: The Content instance.
+      patch: The Patch instance it doesn't apply to.
+
+    Returns:
+      True if the content was marked bad.
+    """
+    condition, params = _unused_content_condition(patch.id)
+    cursor = django_db.connection.cursor()
+    cursor.execute('UPDATE {0} SET is_bad = %s, text = NULL WHERE id = %s AND {1}'.format(
+        Content._meta.db_table, condition), [True, content.id] + params)
+    django_db.transaction.commit_unless_managed()
+    if not cursor.rowcount:
+        return False
+    content.is_bad = True
+    content.text = None
+    return True
+
+
 # Issues, PatchSets, Patches, Contents, Comments, Messages ###
 
 
@@ -169,8 +273,8 @@ class Issue(db.Model):
 
     @property
     def patchsets(self):
-        """Get issue patchsets in order."""
-        return self.patchset_set.order('created')
+        """Get issue patchsets in order, their data is loaded on access."""
+        return patchset_headers(self)
 
     @property
     def latest_patchset(self):
@@ -206,6 +310,35 @@ class Issue(db.Model):
             return None
 
 
+class ManifestFile(object):
+
+    """A file of the manifest of a patch set.
+
+    It stands for the patch of the file in the lists of files, without
+    loading the patch, and has the columns needed to compare it with the
+    same file in the other patch sets.
+    """
+
+    FIELDS = ('id', 'filename', 'status', 'is_binary', 'text_checksum',
+              'added_count', 'removed_count', 'chunk_count')
+
+    def __init__(self, values):
+        for name, value in zip(self.FIELDS, values):
+            setattr(self, name, value)
+        self.num_comments = self.num_drafts = 0
+
+    @classmethod
+    def from_patch(cls, patch):
+        """Create the manifest file of a Patch instance, computing its statistics if needed."""
+        if patch.added_count is None:
+            patch.update_stats()
+        return cls([getattr(patch, name) for name in cls.FIELDS])
+
+    def to_list(self):
+        """Return the values of the FIELDS, as they are stored."""
+        return [getattr(self, name) for name in self.FIELDS]
+
+
 class PatchSet(db.Model):
 
     """A set of patchset uploaded together.
@@ -221,12 +354,69 @@ class PatchSet(db.Model):
     modified = db.DateTimeProperty(auto_now=True)
     n_comments = db.IntegerProperty(default=0)
     revision = db.StringProperty(required=False)
+    # JSON list of the files of the patches ordered by filename, see
+    # ManifestFile. Written when the patches are created, so the files can
+    # be listed and compared without loading the patches. None for the patch
+    # sets created before and the ones uploaded patch by patch, it's built
+    # from the patches when it's first accessed.
+    manifest = db.TextProperty()
 
     class Meta:
         permissions = (
             ("approve_patchset", "Approve patchset"),
         )
 
+    _files = None
+    _files_by_name = None
+
+    def update_manifest(self, patches):
+        """Write the manifest of the patches, stored when the patch set is put.
+
+        Args:
+          patches: all the Patch instances of the patch set, already put.
+        """
+        files = sorted((ManifestFile.from_patch(patch) for patch in patches),
+                       key=lambda manifest_file: manifest_file.filename)
+        self.manifest = simplejson.dumps(
+            [manifest_file.to_list() for manifest_file in files], separators=(',', ':'))
+        self._files = files
+        self._files_by_name = None
+
+    def clear_manifest(self):
+        """Drop the stored manifest when a patch is added or changed, it's built again on access."""
+        PatchSet.objects.filter(id=self.id).update(manifest=None)
+        self.manifest = None
+        self._files = self._files_by_name = None
+
+    def store_manifest(self):
+        """Build the missing manifest from the patches and store it, without writing the other columns.
+
+        The patches must not be changed meanwhile, a patch added or changed
+        after they were read would be missing in the stored manifest.
+        """
+        self.update_manifest(patch_headers(self))
+        PatchSet.objects.filter(id=self.id, manifest=None).update(manifest=self.manifest)
+
+    @property
+    def files(self):
+        """The ManifestFile instances of the patches, ordered by filename.
+
+        The missing manifest is built from the patches, but not stored: a
+        patch can be uploaded meanwhile, see store_manifest().
+        """
+        if self._files is None:
+            if self.manifest is None:
+                self.update_manifest(patch_headers(self))
+            else:
+                self._files = [ManifestFile(values) for values in simplejson.loads(self.manifest)]
+        return self._files
+
+    def get_file(self, filename):
+        """Return the ManifestFile of the filename, or None if it's not in the patch set."""
+        if self._files_by_name is None:
+            self._files_by_name = dict((manifest_file.filename, manifest_file) for manifest_file in self.files)
+        return self._files_by_name.get(filename)
+
     def update_comment_count(self, n):
         """Increment the n_comments property by n."""
         self.n_comments = self.num_comments + n
@@ -242,6 +432,65 @@ class PatchSet(db.Model):
         return self.n_comments or 0
 
 
+class ProcessingJob(db.Model):
+
+    """A queued job creating the patch set of an issue out of the Fogbugz case branches.
+
+    Jobs are run by the process_codereview_jobs management command.
+    """
+
+    STATUSES = ('queued', 'running', 'done', 'failed')
+
+    issue = db.ReferenceProperty(Issue)
+    original_branch = db.StringProperty()
+    feature_branch = db.StringProperty()
+    status = db.StringProperty(default='queued', choices=STATUSES)
+    #: human readable description of the current processing step
+    progress = db.StringProperty()
+    error = db.TextProperty()
+    #: host and process id of the worker running the job
+    worker = db.StringProperty()
+    #: when the worker claimed the job
+    started = db.DateTimeProperty()
+    #: last time the worker running the job was seen alive, the job is queued again when it's too old
+    heartbeat = db.DateTimeProperty()
+    #: number of times the worker running the job stopped
+    attempts = db.IntegerProperty(default=0)
+    created = db.DateTimeProperty(auto_now_add=True)
+    modified = db.DateTimeProperty(auto_now=True)
+
+
+class FogBugzOperation(db.Model):
+
+    """A queued FogBugz API write of a case, recorded in the same transaction as the changes causing it.
+
+    Operations are run by the process_codereview_jobs management command, in the order of their creation
+    per case, and are retried with a backoff when they fail.
+    """
+
+    STATUSES = ('queued', 'running', 'done', 'failed')
+
+    case_id = db.IntegerProperty()
+    #: FogBugz API token of the user who made the change
+    token = db.StringProperty()
+    #: FogBugz API command, e.g. assign or edit
+    command = db.StringProperty()
+    #: JSON encoded keyword arguments of the command
+    params = db.TextProperty()
+    status = db.StringProperty(default='queued', choices=STATUSES)
+    attempts = db.IntegerProperty(default=0)
+    next_attempt = db.DateTimeProperty(auto_now_add=True)
+    error = db.TextProperty()
+    #: host and process id of the worker running the operation
+    worker = db.StringProperty()
+    #: when the worker claimed the operation
+    started = db.DateTimeProperty()
+    #: last time the worker running the operation was seen alive, the operation is retried when it's too old
+    heartbeat = db.DateTimeProperty()
+    created = db.DateTimeProperty(auto_now_add=True)
+    modified = db.DateTimeProperty(auto_now=True)
+
+
 class Message(db.Model):
 
     """A copy of a message sent out in email.
@@ -283,6 +532,8 @@ class Content(db.Model):
     text = db.TextProperty()
     data = db.TextProperty()  # blob
     # Checksum over text or data depending on the type of this content.
+    # Contents created from the repositories are shared by checksum (sha1)
+    # between the patches with identical files.
     checksum = db.TextProperty()
     is_uploaded = db.BooleanProperty(default=False)
     is_bad = db.BooleanProperty(default=False)
@@ -315,6 +566,14 @@ class Patch(db.Model):
     # Ids of patchsets that have a different version of this file.
     delta = db.ListProperty(int)
     delta_calculated = db.BooleanProperty(default=False)
+    # Statistics of the text, set by update_stats() when the patch is created,
+    # so the lists of patches don't need the text. None for the patches
+    # created before they were stored.
+    added_count = db.IntegerProperty()
+    removed_count = db.IntegerProperty()
+    chunk_count = db.IntegerProperty()
+    # Checksum (sha1) of the text.
+    text_checksum = db.StringProperty()
 
     _lines = None
 
@@ -351,31 +610,41 @@ class Patch(db.Model):
             self._property_changes = self.text[match.end():].splitlines()
         return self._property_changes
 
-    _num_added = None
+    def update_stats(self):
+        """Compute the statistics of the text, stored when the patch is put."""
+        added = removed = chunks = 0
+        for line in self.lines:
+            if line.startswith('+'):
+                added += 1
+            elif line.startswith('-'):
+                removed += 1
+            elif line.startswith('@@'):
+                chunks += 1
+        # Not counting the '+++' and '---' header lines.
+        self.added_count = added - 1
+        self.removed_count = removed - 1
+        self.chunk_count = chunks
+        self.text_checksum = sha1((self.text or u'').encode('utf-8')).hexdigest()
 
     @property
     def num_added(self):
         """The number of line additions in this patch.
 
-        The value is cached.
+        The value is stored, it's computed for the patches created before.
         """
-        if self._num_added is None:
-            self._num_added = self.count_startswith('+') - 1
-        return self._num_added
-
-    _num_removed = None
+        if self.added_count is None:
+            self.update_stats()
+        return self.added_count
 
     @property
     def num_removed(self):
         """The number of line removals in this patch.
 
-        The value is cached.
+        The value is stored, it's computed for the patches created before.
         """
-        if self._num_removed is None:
-            self._num_removed = self.count_startswith('-') - 1
-        return self._num_removed
-
-    _num_chunks = None
+        if self.removed_count is None:
+            self.update_stats()
+        return self.removed_count
 
     @property
     def num_chunks(self):
@@ -383,11 +652,11 @@ class Patch(db.Model):
 
         A chunk is a block of lines starting with '@@'.
 
-        The value is cached.
+        The value is stored, it's computed for the patches created before.
         """
-        if self._num_chunks is None:
-            self._num_chunks = self.count_startswith('@@')
-        return self._num_chunks
+        if self.chunk_count is None:
+            self.update_stats()
+        return self.chunk_count
 
     _num_comments = None
 
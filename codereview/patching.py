@@ -18,7 +18,7 @@ For a discussion of the unified diff format, see my blog on Artima:
 http://www.artima.com/weblogs/viewpost.jsp?thread=164293
 """
 
-import difflib
+import itertools
 import logging
 import re
 import sys
@@ -61,6 +61,8 @@ def PatchChunks(old_lines, chunks):
     "insert", "delete", "replace".  After "error" is yielded, no more
     tuples are yielded.  It is possible that consecutive "equal" tuples
     are yielded.
+
+    The opcodes of a chunk are taken from its lines as marked in the patch.
     """
     if not chunks:
         # The patch is a no-op
@@ -68,7 +70,7 @@ def PatchChunks(old_lines, chunks):
         return
 
     old_pos = 0
-    for (old_i, old_j), _, old_chunk, new_chunk in chunks:
+    for (old_i, old_j), _, old_chunk, new_chunk, opcodes in chunks:
         eq = old_lines[old_pos:old_i]
         if eq:
             yield "equal", eq, eq
@@ -78,10 +80,7 @@ def PatchChunks(old_lines, chunks):
         #   logging.warn("mismatch:%s.%s.", old_lines[old_i:old_j], old_chunk)
         #   yield ("error: old chunk mismatch", repr(old_lines[old_i:old_j]), repr(old_chunk))
         #   return
-        # TODO(guido): ParsePatch knows the diff details, but throws the info
-        # away
-        sm = difflib.SequenceMatcher(None, old_chunk, new_chunk)
-        for tag, i1, i2, j1, j2 in sm.get_opcodes():
+        for tag, i1, i2, j1, j2 in opcodes:
             yield tag, old_chunk[i1:i2], new_chunk[j1:j2]
         old_pos = old_j
 
@@ -108,12 +107,47 @@ def ParseRevision(lines):
 _NO_NEWLINE_MESSAGE = "\\ No newline at end of file"
 
 
+def _ParseRawChunk(raw_chunk):
+    """Splits the (tag, line) tuples of a chunk into its old and new lines.
+
+    Returns a tuple (old_lines, new_lines, opcodes) where opcodes is a list of
+    (tag, i1, i2, j1, j2) tuples like difflib.SequenceMatcher.get_opcodes()
+    returns.  The removed and added lines between two context lines make a
+    single "delete", "insert" or "replace" opcode.
+    """
+    old_chunk = []
+    new_chunk = []
+    opcodes = []
+    for is_context, group in itertools.groupby(
+            raw_chunk, lambda item: item[0] == " "):
+        i1, j1 = len(old_chunk), len(new_chunk)
+        for tag, rest in group:
+            if tag in (" ", "-"):
+                old_chunk.append(rest)
+            if tag in (" ", "+"):
+                new_chunk.append(rest)
+        i2, j2 = len(old_chunk), len(new_chunk)
+        if is_context:
+            tag = "equal"
+        elif i1 == i2:
+            tag = "insert"
+        elif j1 == j2:
+            tag = "delete"
+        else:
+            tag = "replace"
+        opcodes.append((tag, i1, i2, j1, j2))
+    return old_chunk, new_chunk, opcodes
+
+
 def ParsePatchToChunks(lines, name="<patch>"):
     """Parses a patch from a list of lines.
 
     Return a list of chunks, where each chunk is a tuple:
 
-      old_range, new_range, old_lines, new_lines
+      old_range, new_range, old_lines, new_lines, opcodes
+
+    where opcodes are the difflib opcodes of the change of old_lines into
+    new_lines, as marked in the patch.
 
     Returns a list of chunks (possibly empty); or None if there's a problem.
     """
@@ -134,13 +168,7 @@ def ParsePatchToChunks(lines, name="<patch>"):
         if match:
             if raw_chunk:
                 # Process the lines in the previous chunk
-                old_chunk = []
-                new_chunk = []
-                for tag, rest in raw_chunk:
-                    if tag in (" ", "-"):
-                        old_chunk.append(rest)
-                    if tag in (" ", "+"):
-                        new_chunk.append(rest)
+                old_chunk, new_chunk, opcodes = _ParseRawChunk(raw_chunk)
                 # Check consistency
                 old_i, old_j = old_range
                 new_i, new_j = new_range
@@ -148,7 +176,8 @@ def ParsePatchToChunks(lines, name="<patch>"):
                     logging.warn("%s:%s: previous chunk has incorrect length",
                                  name, lineno)
                     return None
-                chunks.append((old_range, new_range, old_chunk, new_chunk))
+                chunks.append((old_range, new_range, old_chunk, new_chunk,
+                               opcodes))
                 raw_chunk = []
             # Parse the @@ header
             old_ln, old_n, new_ln, new_n = match.groups()
@@ -200,13 +229,7 @@ def ParsePatchToChunks(lines, name="<patch>"):
                 return None
     if raw_chunk:
         # Process the lines in the last chunk
-        old_chunk = []
-        new_chunk = []
-        for tag, rest in raw_chunk:
-            if tag in (" ", "-"):
-                old_chunk.append(rest)
-            if tag in (" ", "+"):
-                new_chunk.append(rest)
+        old_chunk, new_chunk, opcodes = _ParseRawChunk(raw_chunk)
         # Check consistency
         old_i, old_j = old_range
         new_i, new_j = new_range
@@ -214,7 +237,7 @@ def ParsePatchToChunks(lines, name="<patch>"):
             print >> sys.stderr, ("%s:%s: last chunk has incorrect length" %
                                   (name, lineno))
             return None
-        chunks.append((old_range, new_range, old_chunk, new_chunk))
+        chunks.append((old_range, new_range, old_chunk, new_chunk, opcodes))
         raw_chunk = []
     return chunks
 
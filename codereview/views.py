@@ -25,8 +25,6 @@ import os
 import random
 import re
 import urllib
-from cStringIO import StringIO
-from lxml import etree as ElementTree
 import mimetypes
 
 from google.appengine.api import mail
@@ -36,7 +34,6 @@ from google.appengine.api import urlfetch
 from google.appengine.api import xmpp
 from google.appengine.ext import db
 from google.appengine.ext.db import djangoforms
-from google.appengine.runtime import DeadlineExceededError
 from google.appengine.runtime import apiproxy_errors
 
 # TODO(guido): Don't import classes/functions directly.
@@ -47,16 +44,19 @@ from django.http import HttpResponse, HttpResponseRedirect
 from django.http import HttpResponseForbidden, HttpResponseNotFound
 from django.http import HttpResponseBadRequest
 from django.contrib.auth.decorators import permission_required
+from django.db.models import Count
 from django.shortcuts import render_to_response
 import django.template
 from django.template import RequestContext
 from django.utils import simplejson
+from django.utils.encoding import smart_str
 from django.utils.safestring import mark_safe
 from django.core.urlresolvers import reverse
 from django.contrib.staticfiles.views import serve  # NOQA
 
 import engine
 import library
+import linediff
 import models
 import patching
 from paylogic import measurements
@@ -538,6 +538,57 @@ def respond(request, template, params=None):
         library.user_cache.clear()  # don't want this sticking around
 
 
+# Placeholder of the rows in the pages rendered by respond_rows(). The
+# template variables are escaped, so they can't contain it.
+_ROWS_PLACEHOLDER = '<!--rows-%s-->' % binascii.hexlify(os.urandom(8))
+# Minimum size of the chunks of rows sent by respond_rows().
+ROWS_CHUNK_SIZE = 64 * 1024
+
+
+def respond_rows(request, template, params, rows):
+    """Helper to render a response streaming the table rows of a diff.
+
+    The page is rendered by respond() around a placeholder of the rows. The
+    part of the page before the rows is sent first, then the rows in chunks
+    as they are generated and the rest of the page.
+
+    Args:
+      request: The request object.
+      template: The template name, rendering the rows by a
+        {%for row in rows%}{{row|safe}}{%endfor%} loop.
+      params: A dict giving the template parameters; modified in-place.
+      rows: An iterable of the html table rows.
+
+    Returns:
+      An HttpResponse iterating over the page, or whatever respond() returns
+      if the template doesn't render the rows.
+    """
+    params['rows'] = [_ROWS_PLACEHOLDER]
+    response = respond(request, template, params)
+    if _ROWS_PLACEHOLDER not in response.content:
+        return response
+    head, tail = response.content.split(_ROWS_PLACEHOLDER, 1)
+    return HttpResponse(_rows_chunks(head, rows, tail),
+                        content_type=response['Content-Type'])
+
+
+def _rows_chunks(head, rows, tail):
+    """Helper for respond_rows() yielding the page in chunks."""
+    yield head
+    chunk = []
+    size = 0
+    for row in rows:
+        row = smart_str(row)
+        chunk.append(row)
+        size += len(row)
+        if size >= ROWS_CHUNK_SIZE:
+            yield ''.join(chunk)
+            chunk = []
+            size = 0
+    chunk.append(tail)
+    yield ''.join(chunk)
+
+
 def _random_bytes(n):
     """Helper returning a string of random bytes of given length."""
     return ''.join(map(chr, (random.randrange(256) for i in xrange(n))))
@@ -1377,6 +1428,9 @@ def upload(request):
                         id_string = "nobase_" + str(id_string)
                     msg += "\n%s %s" % (id_string, patch.filename)
                 db.put(patches)
+                # The statuses are taken from the previous patch set.
+                patchset.update_manifest(patches)
+                patchset.put()
     return HttpResponse(msg, content_type='text/plain')
 
 
@@ -1405,6 +1459,9 @@ def upload_content(request):
         return HttpResponse('ERROR: You (%s) don\'t own this issue (%s).' %
                             (request.user, request.issue.key().id()))
     patch = request.patch
+    if (patch.status, patch.is_binary) != (form.cleaned_data['status'],
+                                           form.cleaned_data['is_binary']):
+        request.patchset.clear_manifest()
     patch.status = form.cleaned_data['status']
     patch.is_binary = form.cleaned_data['is_binary']
     patch.put()
@@ -1421,6 +1478,10 @@ def upload_content(request):
 
     if form.cleaned_data['file_too_large']:
         content.file_too_large = True
+        # Without the base file there are no delta links.
+        if patch.delta:
+            patch.delta = []
+            patch.put()
     else:
         data = form.get_uploaded_content()
         checksum = md5.new(data).hexdigest()
@@ -1472,7 +1533,10 @@ def upload_patch(request):
     patch = models.Patch(patchset=patchset,
                          text=text,
                          filename=form.cleaned_data['filename'], parent=patchset)
+    patch.update_stats()
+    _calculate_deltas(patchset, [patch])
     patch.put()
+    patchset.clear_manifest()
     if form.cleaned_data.get('content_upload'):
         content = models.Content(is_uploaded=True, parent=patch)
         content.put()
@@ -1535,7 +1599,10 @@ def _make_new(request, form):
             patches = engine.ParsePatchSet(patchset)
             if not patches:
                 raise EmptyPatchSet  # Abort the transaction
+            _calculate_deltas(patchset, patches)
             db.put(patches)
+            patchset.update_manifest(patches)
+            patchset.put()
         return issue, patchset
 
     try:
@@ -1644,7 +1711,10 @@ def _add_patchset_from_form(request, issue, form, message_key='message',
             form.errors[errkey] = [
                 'Patch set contains no recognizable patches']
             return None
+        _calculate_deltas(patchset, patches)
         db.put(patches)
+        patchset.update_manifest(patches)
+        patchset.put()
 
     if emails_add_only:
         emails = _get_emails(form, 'reviewers')
@@ -1707,6 +1777,9 @@ def _get_emails_from_raw(raw_emails, form=None, label=None):
 def _calculate_delta(patch, patchset_id, patchsets):
     """Calculates which files in earlier patchsets this file differs from.
 
+    The checksum of the text is compared with the manifests of the earlier
+    patchsets, their patches and data aren't loaded.
+
     Args:
       patch: The file to compare.
       patchset_id: The file's patchset's key id.
@@ -1718,165 +1791,97 @@ def _calculate_delta(patch, patchset_id, patchsets):
     delta = []
     if patch.no_base_file:
         return delta
+    if patch.text_checksum is None:
+        patch.update_stats()
     for other in patchsets:
         if patchset_id == other.key().id():
             break
-        if other.data or other.parsed_patches:
-            # Loading all the Patch entities in every PatchSet takes too long
-            # (DeadLineExceeded) and consumes a lot of memory (MemoryError) so instead
-            # just parse the patchset's data.  Note we can only do this if the
-            # patchset was small enough to fit in the data property.
-            if other.parsed_patches is None:
-                # PatchSet.data is stored as db.Blob (str). Try to convert it
-                # to unicode so that Python doesn't need to do this conversion
-                # when comparing text and patch.text, which is db.Text
-                # (unicode).
-                other.parsed_patches = engine.SplitPatch(other.data)
-                other.data = None  # Reduce memory usage.
-            for filename, old_filename, text, is_binary in other.parsed_patches:
-                if filename == patch.filename:
-                    if text != patch.text:
-                        delta.append(other.key().id())
-                    break
-            else:
-                # We could not find the file in the previous patchset. It must
-                # be new wrt that patchset.
-                delta.append(other.key().id())
-        else:
-            # other (patchset) is too big to hold all the patches inside itself, so
-            # we need to go to the datastore.  Use the index to see if there's a
-            # patch against our current file in other.
-            query = models.Patch.all()
-            query.filter("filename =", patch.filename)
-            query.filter("patchset =", other.key())
-            other_patches = query.fetch(100)
-            if other_patches and len(other_patches) > 1:
-                logging.info(
-                    "Got %s patches with the same filename for a patchset",
-                    len(other_patches))
-            for op in other_patches:
-                if op.text != patch.text:
-                    delta.append(other.key().id())
-                    break
-            else:
-                # We could not find the file in the previous patchset. It must
-                # be new wrt that patchset.
-                delta.append(other.key().id())
-
+        other_file = other.get_file(patch.filename)
+        # A file not found in the other patchset is new wrt that patchset.
+        if other_file is None or other_file.text_checksum != patch.text_checksum:
+            delta.append(other.key().id())
     return delta
 
 
+def _calculate_deltas(patchset, patches):
+    """Calculates the delta of the new patches of a patchset.
+
+    It's done when the patches are created, before they are put, so the
+    issue page doesn't calculate and store it.
+
+    Args:
+      patchset: The patches' patchset, already put.
+      patches: A list of its new patches.
+    """
+    patchsets = list(models.patchset_headers(patchset.issue))
+    for patch in patches:
+        patch.delta = _calculate_delta(patch, patchset.key().id(), patchsets)
+        patch.delta_calculated = True
+
+
 def _get_patchset_info(request, patchset_id):
     """ Returns a list of patchsets for the issue.
 
     Args:
       request: Django Request object.
       patchset_id: The id of the patchset that the caller is interested in.  This
-        is the one that we generate delta links to if they're not available.  We
-        can't generate for all patchsets because it would take too long on issues
-        with many patchsets.  Passing in None is equivalent to doing it for the
-        last patchset.
+        is the one whose patches are listed with their delta links.  Passing in
+        None is equivalent to doing it for the last patchset.
 
     Returns:
-      A 3-tuple of (issue, patchsets, HttpResponse).
-      If HttpResponse is not None, further processing should stop and it should be
-      returned.
+      A 2-tuple of (issue, patchsets).
     """
     issue = request.issue
-    patchsets = list(issue.patchset_set.order('created'))
-    response = None
+    patchsets = list(models.patchset_headers(issue))
     if not patchset_id and patchsets:
         patchset_id = patchsets[-1].key().id()
 
+    # The comments are counted by the database, in one query for the comments
+    # and one for the drafts of the user.
+    comments = models.Comment.objects.filter(patch__patchset__issue=issue)
+    comments_by_patch = _count_comments(comments.filter(draft=False), 'patch')
+    drafts_by_patch = {}
+    drafts_by_patchset = {}
     if request.user:
-        drafts = list(models.Comment.gql('WHERE ANCESTOR IS :1 AND draft = TRUE'
-                                         '  AND author = :2',
-                                         issue, request.user))
-    else:
-        drafts = []
-    comments = list(
-        models.Comment.gql('WHERE ANCESTOR IS :1 AND draft = FALSE',
-                           issue))
-    issue.draft_count = len(drafts)
-    for c in drafts:
-        c.ps_key = c.patch.patchset.key()
+        drafts = comments.filter(draft=True, author=request.user)
+        for row in drafts.order_by().values('patch', 'patch__patchset').annotate(
+                count=Count('id')):
+            drafts_by_patch[row['patch']] = row['count']
+            drafts_by_patchset[row['patch__patchset']] = drafts_by_patchset.get(
+                row['patch__patchset'], 0) + row['count']
+    issue.draft_count = sum(drafts_by_patch.itervalues())
     patchset_id_mapping = {}  # Maps from patchset id to its ordering number.
     for i, patchset in enumerate(patchsets):
         patchset_id_mapping[patchset.key().id()] = len(patchset_id_mapping) + 1
-        patchset.n_drafts = sum(c.ps_key == patchset.key() for c in drafts)
+        patchset.n_drafts = drafts_by_patchset.get(patchset.key().id(), 0)
         patchset.patches = None
-        patchset.parsed_patches = None
         file_set_prev = set() if i == 0 else set(
-            [patch.filename for patch in patchsets[i - 1].patch_set])
+            [manifest_file.filename for manifest_file in patchsets[i - 1].files])
         if patchset_id == patchset.key().id():
-            patchset.patches = list(patchset.patch_set.order('filename'))
-            try:
-                attempt = _clean_int(request.GET.get('attempt'), 0, 0)
-                if attempt < 0:
-                    response = HttpResponse('Invalid parameter', status=404)
-                    break
-                for patch in patchset.patches:
-                    pkey = patch.key()
-                    patch._num_comments = sum(
-                        c.parent_key() == pkey for c in comments)
-                    patch._num_drafts = sum(
-                        c.parent_key() == pkey for c in drafts)
-                    if not patch.delta_calculated:
-                        if attempt > 2:
-                            # Too many patchsets or files and we're not able to generate the
-                            # delta links.  Instead of giving a 500, try to render the page
-                            # without them.
-                            patch.delta = []
-                        else:
-                            # Compare each patch to the same file in earlier patchsets to see
-                            # if they differ, so that we can generate the delta patch urls.
-                            # We do this once and cache it after.  It's specifically not done
-                            # on upload because we're already doing too much processing there.
-                            # NOTE: this function will clear out patchset.data to reduce
-                            # memory so don't ever call patchset.put() after
-                            # calling it.
-                            patch.delta = _calculate_delta(
-                                patch, patchset_id, patchsets)
-                            patch.delta_calculated = True
-                            # A multi-entity put would be quicker, but it fails when the
-                            # patches have content that is large.  App Engine throws
-                            # RequestTooLarge.  This way, although not as efficient, allows
-                            # multiple refreshes on an issue to get things done, as opposed to
-                            # an all-or-nothing approach.
-                            patch.put()
-                    # Reduce memory usage: if this patchset has lots of added/removed
-                    # files (i.e. > 100) then we'll get MemoryError when rendering the
-                    # response.  Each Patch entity is using a lot of memory if the files
-                    # are large, since it holds the entire contents.  Call num_chunks and
-                    # num_drafts first though since they depend on text.
-                    # These are 'active' properties and have side-effects when looked up.
-                    # pylint: disable=W0104
-                    patch.num_chunks
-                    patch.num_drafts
-                    patch.num_added
-                    patch.num_removed
-                    patch.text = None
-                    patch._lines = None
-                    patch.parsed_deltas = []
-                    for delta in patch.delta:
-                        if delta in patchset_id_mapping:
-                            patch.parsed_deltas.append(
-                                [patchset_id_mapping[delta], delta])
-                    patch.is_new = patch.filename not in file_set_prev
-            except DeadlineExceededError:
-                logging.exception(
-                    'DeadlineExceededError in _get_patchset_info')
-                if attempt > 2:
-                    response = HttpResponse(
-                        'DeadlineExceededError - create a new issue.')
-                else:
-                    response = HttpResponseRedirect('%s?attempt=%d' %
-                                                    (request.path, attempt + 1))
-                break
-    # Reduce memory usage (see above comment).
-    for patchset in patchsets:
-        patchset.parsed_patches = None
-    return issue, patchsets, response
+            patchset.patches = list(models.patch_headers(patchset))
+            for patch in patchset.patches:
+                patch._num_comments = comments_by_patch.get(patch.key().id(), 0)
+                patch._num_drafts = drafts_by_patch.get(patch.key().id(), 0)
+                if not patch.delta_calculated:
+                    # The delta of the patches created before it was calculated
+                    # with them isn't stored here, see update_patch_stats.
+                    patch.delta = _calculate_delta(patch, patchset_id, patchsets)
+                # Reduce memory usage: if this patchset has lots of added/removed
+                # files (i.e. > 100) then we'll get MemoryError when rendering the
+                # response.  Each Patch entity is using a lot of memory if the files
+                # are large, since it holds the entire contents.  The statistics
+                # of the patches created before they were stored depend on text.
+                if patch.added_count is None:
+                    patch.update_stats()
+                patch.text = None
+                patch._lines = None
+                patch.parsed_deltas = []
+                for delta in patch.delta:
+                    if delta in patchset_id_mapping:
+                        patch.parsed_deltas.append(
+                            [patchset_id_mapping[delta], delta])
+                patch.is_new = patch.filename not in file_set_prev
+    return issue, patchsets
 
 
 @issue_required
@@ -1884,9 +1889,7 @@ def _get_patchset_info(request, patchset_id):
 @permission_required('codereview.view_issue')
 def show(request, form=None):
     """/<issue> - Show an issue."""
-    issue, patchsets, response = _get_patchset_info(request, None)
-    if response:
-        return response
+    issue, patchsets = _get_patchset_info(request, None)
     if not form:
         form = AddForm(initial={'reviewers': ', '.join(issue.reviewers)})
     last_patchset = first_patch = None
@@ -1918,10 +1921,7 @@ def show(request, form=None):
 def patchset(request):
     """/patchset/<key> - Returns patchset information."""
     patchset = request.patchset
-    issue, patchsets, response = _get_patchset_info(
-        request, patchset.key().id())
-    if response:
-        return response
+    issue, patchsets = _get_patchset_info(request, patchset.key().id())
     for ps in patchsets:
         if ps.key().id() == patchset.key().id():
             patchset = ps
@@ -2075,12 +2075,13 @@ def _delete_cached_contents(patch_set):
         patch.content = None
         patch.patched_content = None
         patches.append(patch)
-    if contents:
-        logging.info("Deleting %d contents", len(contents))
-        db.delete(contents)
     if patches:
         logging.info("Updating %d patches", len(patches))
         db.put(patches)
+    # Contents are shared between patches with identical files, keep the ones
+    # still used by other patches.
+    deleted = models.delete_unused_contents([cached.id for cached in contents])
+    logging.info("Deleted %d contents", deleted)
 
 
 @post_required
@@ -2279,16 +2280,15 @@ def patch_helper(request, nav_type='patch'):
     if parsed_lines is None:
         return HttpResponseNotFound('Can\'t parse the patch to lines')
     rows = engine.RenderUnifiedTableRows(request, parsed_lines)
-    return respond(request, 'patch.html',
-                   {'patch': request.patch,
-                    'patchset': request.patchset,
-                    'view_style': 'patch',
-                    'rows': rows,
-                    'issue': request.issue,
-                    'context': _clean_int(request.GET.get('context'), -1),
-                    'column_width': _clean_int(request.GET.get('column_width'),
-                                               None),
-                    })
+    return respond_rows(request, 'patch.html',
+                        {'patch': request.patch,
+                         'patchset': request.patchset,
+                         'view_style': 'patch',
+                         'issue': request.issue,
+                         'context': _clean_int(request.GET.get('context'), -1),
+                         'column_width': _clean_int(
+                             request.GET.get('column_width'), None),
+                         }, rows)
 
 
 @image_required
@@ -2313,7 +2313,7 @@ def _issue_as_dict(issue, messages, request=None):
         'closed': issue.closed,
         'cc': issue.cc,
         'reviewers': issue.reviewers,
-        'patchsets': [p.key().id() for p in issue.patchset_set.order('created')],
+        'patchsets': [p.key().id() for p in models.patchset_headers(issue)],
         'description': issue.description,
         'subject': issue.subject,
         'issue': issue.key().id(),
@@ -2433,7 +2433,7 @@ def diff(request):
     patchset = request.patchset
     patch = request.patch
 
-    patchsets = list(request.issue.patchset_set.order('created'))
+    patchsets = list(models.patchset_headers(request.issue))
 
     context = _get_context_for_user(request)
     column_width = _get_column_width_for_user(request)
@@ -2446,51 +2446,98 @@ def diff(request):
             return HttpResponseNotFound(str(err))
 
     _add_next_prev(patchset, patch)
-    return respond(request, 'diff.html',
-                   {'issue': request.issue,
-                    'patchset': patchset,
-                    'patch': patch,
-                    'view_style': 'diff',
-                    'rows': rows,
-                    'context': context,
-                    'context_values': models.CONTEXT_CHOICES,
-                    'column_width': column_width,
-                    'patchsets': patchsets,
-                    })
+    return respond_rows(request, 'diff.html',
+                        {'issue': request.issue,
+                         'patchset': patchset,
+                         'patch': patch,
+                         'view_style': 'diff',
+                         'context': context,
+                         'context_values': models.CONTEXT_CHOICES,
+                         'column_width': column_width,
+                         'patchsets': patchsets,
+                         }, rows)
+
+
+def _get_code_rows_key(view, column_width, *patches):
+    """Helper function that returns the key of the cached code rows of patches.
+
+    Patches are identified by their ids, text checksums and the ids of their
+    contents, which change when the base file is fetched again or replaced, so
+    the contents used by the rendering have to be stored before. Missing
+    patches are identified by None.
+    """
+    key = [view, column_width]
+    for patch in patches:
+        if patch is None:
+            key.append(None)
+            continue
+        if patch.text_checksum is None:
+            # Patches created before the checksums were stored.
+            patch.update_stats()
+        key.append((patch.key().id(), patch.text_checksum,
+                    patch.content_id, patch.patched_content_id))
+    return tuple(key)
 
 
 def _get_diff_table_rows(request, patch, context, column_width):
-    """Helper function that returns rendered rows for a patch.
+    """Helper function that returns an iterator over the rendered rows for a patch.
+
+    The comment independent code rows are cached, the comments are merged into
+    them on every call. The patch and its base file are fetched up front, the
+    rows are rendered as they are iterated.
 
     Raises:
       engine.FetchError if patch parsing or download of base files fails.
     """
-    chunks = patching.ParsePatchToChunks(patch.lines, patch.filename)
-    if chunks is None:
-        raise engine.FetchError('Can\'t parse the patch to chunks')
-
-    # Possible engine.FetchErrors are handled in diff() and
-    # diff_skipped_lines().
-    content = request.patch.get_content()
-    rows = list(engine.RenderDiffTableRows(request, content.lines,
-                                           chunks, patch,
-                                           context=context,
-                                           colwidth=column_width))
-    if rows and rows[-1] is None:
-        del rows[-1]
-        # Get rid of content, which may be bad
-        if content.is_uploaded and content.text is not None:
-            # Don't delete uploaded content, otherwise get_content()
-            # will fetch it.
-            content.is_bad = True
-            content.text = None
-            content.put()
-        else:
-            content.delete()
-            request.patch.content = None
-            request.patch.put()
+    def render():
+        chunks = patching.ParsePatchToChunks(patch.lines, patch.filename)
+        if chunks is None:
+            raise engine.FetchError('Can\'t parse the patch to chunks')
+
+        # Possible engine.FetchErrors are handled in diff() and
+        # diff_skipped_lines().
+        content = request.patch.get_content()
+        lines = content.lines
+        # Get rid of content, which may be bad. This is done before the rows
+        # are streamed, the transaction of the request is over by then.
+        if any(tag.startswith('error')
+               for tag, _, _ in patching.PatchChunks(lines, chunks)):
+            _discard_bad_content(request.patch, content)
+        return engine.RenderDiffCodeRows(lines, chunks, patch,
+                                         colwidth=column_width)
+
+    if patch.content_id is None:
+        # The key identifies the base file, fetch it first.
+        patch.get_content()
+    code_rows = engine.GetCachedCodeRows(
+        _get_code_rows_key('diff', column_width, patch), render)
+    rows = engine.RenderDiffCommentRows(request, code_rows, patch,
+                                        context=context)
+
+    # The rows are rendered as they are iterated, the last one is None after
+    # an error.
+    return (row for row in rows if row is not None)
+
+
+def _discard_bad_content(patch, content):
+    """Stop using the content of a patch which doesn't apply to it.
+
+    Contents are shared by checksum between the patches of all issues, a
+    content used by other patches is left as is and only this patch is
+    detached from it.
 
-    return rows
+    Args:
+      patch: The models.Patch instance.
+      content: Its models.Content instance.
+    """
+    if (content.is_uploaded and content.text is not None and
+            models.mark_content_bad(content, patch)):
+        # Don't delete uploaded content, otherwise get_content()
+        # will fetch it.
+        return
+    patch.content = None
+    patch.put()
+    models.delete_unused_contents([content.id])
 
 
 @patch_required
@@ -2514,73 +2561,35 @@ def diff_skipped_lines(request, id_before, id_after, where, column_width):
     column_width = _clean_int(column_width, engine.DEFAULT_COLUMN_WIDTH,
                               engine.MIN_COLUMN_WIDTH, engine.MAX_COLUMN_WIDTH)
 
+    first, last = _get_skipped_lines_range(id_before, id_after, where, context)
     try:
-        rows = _get_diff_table_rows(request, patch, None, column_width)
+        chunks = patching.ParsePatchToChunks(patch.lines, patch.filename)
+        if chunks is None:
+            raise engine.FetchError('Can\'t parse the patch to chunks')
+        content = request.patch.get_content()
+        return engine.RenderDiffRowRange(request, content.lines, chunks, patch,
+                                         first, last, colwidth=column_width)
     except engine.FetchError as err:
         return HttpResponse('Error: %s; please report!' % err, status=500)
-    return _get_skipped_lines_response(rows, id_before, id_after, where, context)
-
-
-# there's no easy way to put a control character into a regex, so brute-force it
-# this is all control characters except \r, \n, and \t
-_badchars_re = re.compile(
-    r'[\000\001\002\003\004\005\006\007\010\013\014\016\017'
-    r'\020\021\022\023\024\025\026\027\030\031\032\033\034\035\036\037]')
-
-
-def _strip_invalid_xml(s):
-    """Remove control chars other than \r\n\t from a string to be put in XML."""
-    if _badchars_re.search(s):
-        return ''.join(c for c in s if c >= ' ' or c in '\r\n\t')
-    else:
-        return s
-
 
-def _get_skipped_lines_response(rows, id_before, id_after, where, context):
-    """Helper function that returns response data for skipped lines"""
-    response_rows = []
-    id_before_start = int(id_before)
-    id_after_end = int(id_after)
-    if context is not None:
-        id_after_start = id_after_end - context
-        id_before_end = id_before_start + context
-    else:
-        id_before_end = id_after_start = None
-
-    for row in rows:
-        m = re.match('^<tr( name="hook")? id="pair-(?P<rowcount>\d+)">', row)
-        if m:
-            curr_id = int(m.groupdict().get("rowcount"))
-            # expand below marker line
-            if (where == 'b' and
-                    curr_id > id_after_start and curr_id <= id_after_end):
-                response_rows.append(row)
-            # expand above marker line
-            elif (where == 't' and
-                    curr_id >= id_before_start and curr_id < id_before_end):
-                response_rows.append(row)
-            # expand all skipped lines
-            elif (where == 'a' and
-                    curr_id >= id_before_start and curr_id <= id_after_end):
-                response_rows.append(row)
-            if context is not None and len(response_rows) >= 2 * context:
-                break
 
-    # Create a usable structure for the JS part
-    response = []
-    response_rows = (_strip_invalid_xml(r) for r in response_rows)
-    dom = ElementTree.parse(StringIO('<div>%s</div>' % "".join(response_rows)))
-    for node in dom.getroot().iterchildren():
-        content = [
-            [x.items(), (x.text or '') + ''.join([ElementTree.tostring(y) for y in x.iterchildren()])]
-            for x in node.iterchildren()]
-        response.append([node.items(), content])
-    return response
+def _get_skipped_lines_range(id_before, id_after, where, context):
+    """Helper function that returns the ids of the first and last rows to expand"""
+    id_before = int(id_before)
+    id_after = int(id_after)
+    # expand below marker line
+    if where == 'b':
+        return max(id_after - context + 1, id_before), id_after
+    # expand above marker line
+    elif where == 't':
+        return id_before, min(id_before + context - 1, id_after)
+    # expand all skipped lines
+    return id_before, id_after
 
 
-def _get_diff2_data(request, ps_left_id, ps_right_id, patch_id, context,
-                    column_width, patch_filename=None):
-    """Helper function that returns objects for diff2 views"""
+def _get_diff2_patches(request, ps_left_id, ps_right_id, patch_id,
+                       patch_filename=None):
+    """Helper function that returns the patch sets and patches of diff2 views"""
     ps_left = models.PatchSet.get_by_id(int(ps_left_id), parent=request.issue)
     if ps_left is None:
         return HttpResponseNotFound('No patch set exists with that id (%s)' %
@@ -2603,40 +2612,79 @@ def _get_diff2_data(request, ps_left_id, ps_right_id, patch_id, context,
     # Now find the corresponding patch in ps_left
     patch_left = models.Patch.gql('WHERE patchset = :1 AND filename = :2',
                                   ps_left, patch_filename).get()
+    return dict(patch_left=patch_left, patch_right=patch_right,
+                ps_left=ps_left, ps_right=ps_right)
+
 
+def _get_diff2_lines(patch_left, patch_right):
+    """Helper function that returns the lines of both sides of diff2 views.
+
+    Raises:
+      engine.FetchError if download of base files fails.
+    """
     if patch_left:
-        try:
-            new_content_left = patch_left.get_patched_content()
-        except engine.FetchError as err:
-            return HttpResponseNotFound(str(err))
-        lines_left = new_content_left.lines
+        lines_left = patch_left.get_patched_content().lines
     elif patch_right:
         lines_left = patch_right.get_content().lines
     else:
         lines_left = []
 
     if patch_right:
-        try:
-            new_content_right = patch_right.get_patched_content()
-        except engine.FetchError as err:
-            return HttpResponseNotFound(str(err))
-        lines_right = new_content_right.lines
+        lines_right = patch_right.get_patched_content().lines
     elif patch_left:
         lines_right = patch_left.get_content().lines
     else:
         lines_right = []
+    return lines_left, lines_right
 
-    rows = engine.RenderDiff2TableRows(request,
-                                       lines_left, patch_left,
-                                       lines_right, patch_right,
-                                       context=context,
-                                       colwidth=column_width)
-    rows = list(rows)
-    if rows and rows[-1] is None:
-        del rows[-1]
 
-    return dict(patch_left=patch_left, patch_right=patch_right,
-                ps_left=ps_left, ps_right=ps_right, rows=rows)
+def _get_diff2_key(patch_left, patch_right):
+    """Helper function that returns the key of the cached diff of two patches.
+
+    The contents of the patches have to be fetched before, as for
+    _get_code_rows_key().
+    """
+    return _get_code_rows_key(('diff2', linediff.GetAlgorithm()), None,
+                              patch_left, patch_right)
+
+
+def _get_diff2_data(request, ps_left_id, ps_right_id, patch_id, context,
+                    column_width, patch_filename=None):
+    """Helper function that returns objects for diff2 views"""
+    data = _get_diff2_patches(request, ps_left_id, ps_right_id, patch_id,
+                              patch_filename)
+    if isinstance(data, HttpResponseNotFound):
+        return data
+    patch_left = data['patch_left']
+    patch_right = data['patch_right']
+
+    def render():
+        lines_left, lines_right = _get_diff2_lines(patch_left, patch_right)
+        return engine.RenderDiff2CodeRows(
+            lines_left, patch_left, lines_right, patch_right,
+            colwidth=column_width,
+            diff_key=_get_diff2_key(patch_left, patch_right))
+
+    try:
+        if any(patch is not None and (patch.content_id is None or
+                                      patch.patched_content_id is None)
+               for patch in (patch_left, patch_right)):
+            # The key identifies the contents, fetch them first.
+            _get_diff2_lines(patch_left, patch_right)
+        code_rows = engine.GetCachedCodeRows(
+            _get_code_rows_key(('diff2', linediff.GetAlgorithm()), column_width,
+                               patch_left, patch_right),
+            render)
+    except engine.FetchError as err:
+        return HttpResponseNotFound(str(err))
+
+    rows = engine.RenderDiff2CommentRows(request, code_rows,
+                                         patch_left, patch_right,
+                                         context=context)
+    # The rows are rendered as they are iterated, the last one is None after
+    # an error.
+    data['rows'] = (row for row in rows if row is not None)
+    return data
 
 
 @issue_required
@@ -2668,24 +2716,23 @@ def diff2(request, ps_left_id, ps_right_id, patch_filename):
     if isinstance(data, HttpResponseNotFound):
         return data
 
-    patchsets = list(request.issue.patchset_set.order('created'))
+    patchsets = list(models.patchset_headers(request.issue))
 
     if data["patch_right"]:
         _add_next_prev2(data["ps_left"], data["ps_right"], data["patch_right"])
-    return respond(request, 'diff2.html',
-                   {'issue': request.issue,
-                    'ps_left': data["ps_left"],
-                    'patch_left': data["patch_left"],
-                    'ps_right': data["ps_right"],
-                    'patch_right': data["patch_right"],
-                    'rows': data["rows"],
-                    'patch_id': patch_id,
-                    'context': context,
-                    'context_values': models.CONTEXT_CHOICES,
-                    'column_width': column_width,
-                    'patchsets': patchsets,
-                    'filename': patch_filename,
-                    })
+    return respond_rows(request, 'diff2.html',
+                        {'issue': request.issue,
+                         'ps_left': data["ps_left"],
+                         'patch_left': data["patch_left"],
+                         'ps_right': data["ps_right"],
+                         'patch_right': data["patch_right"],
+                         'patch_id': patch_id,
+                         'context': context,
+                         'context_values': models.CONTEXT_CHOICES,
+                         'column_width': column_width,
+                         'patchsets': patchsets,
+                         'filename': patch_filename,
+                         }, data["rows"])
 
 
 @issue_required
@@ -2703,45 +2750,59 @@ def diff2_skipped_lines(request, ps_left_id, ps_right_id, patch_id,
     else:
         context = _get_context_for_user(request) or 100
 
-    data = _get_diff2_data(request, ps_left_id, ps_right_id, patch_id, 10000,
-                           column_width)
+    data = _get_diff2_patches(request, ps_left_id, ps_right_id, patch_id)
     if isinstance(data, HttpResponseNotFound):
         return data
-    return _get_skipped_lines_response(data["rows"], id_before, id_after,
-                                       where, context)
+    first, last = _get_skipped_lines_range(id_before, id_after, where, context)
+    try:
+        lines_left, lines_right = _get_diff2_lines(data['patch_left'],
+                                                   data['patch_right'])
+    except engine.FetchError as err:
+        return HttpResponseNotFound(str(err))
+    return engine.RenderDiff2RowRange(
+        request, lines_left, data['patch_left'], lines_right,
+        data['patch_right'], first, last, colwidth=column_width,
+        diff_key=_get_diff2_key(data['patch_left'], data['patch_right']))
+
+
+def _count_comments(query, column):
+    """Helper to count the comments of a query grouped by a column.
+
+    The comments are counted by the database in a single query.
+
+    Args:
+      query: A query of Comment instances.
+      column: The name of the column to group the comments by, e.g. 'patch'.
+
+    Returns:
+      A dictionary with the values of the column as keys and the comment
+      counts as values. Values without comments are not present.
+    """
+    rows = query.order_by().values(column).annotate(count=Count('id'))
+    return dict((row[column], row['count']) for row in rows)
 
 
 def _get_comment_counts(account, patchset):
-    """Helper to get comment counts for all patches in a single query.
+    """Helper to get comment counts for all patches in grouped queries.
 
     The helper returns two dictionaries comments_by_patch and
-    drafts_by_patch with patch key as key and comment count as
+    drafts_by_patch with patch id as key and comment count as
     value. Patches without comments or drafts are not present in those
     dictionaries.
     """
-    # A key-only query won't work because we need to fetch the patch key
-    # in the for loop further down.
-    comment_query = models.Comment.all()
-    comment_query.ancestor(patchset)
-
-    # Get all comment counts with one query rather than one per patch.
-    comments_by_patch = {}
+    comments = models.Comment.objects.filter(patch__patchset=patchset)
+    comments_by_patch = _count_comments(comments.filter(draft=False), 'patch')
     drafts_by_patch = {}
-    for c in comment_query:
-        pkey = models.Comment.patch.get_value_for_datastore(c)
-        if not c.draft:
-            comments_by_patch[pkey] = comments_by_patch.setdefault(pkey, 0) + 1
-        elif account and c.author == account.user:
-            drafts_by_patch[pkey] = drafts_by_patch.setdefault(pkey, 0) + 1
-
+    if account:
+        drafts_by_patch = _count_comments(
+            comments.filter(draft=True, author=account.user), 'patch')
     return comments_by_patch, drafts_by_patch
 
 
 def _add_next_prev(patchset, patch):
     """Helper to add .next and .prev attributes to a patch object."""
     patch.prev = patch.next = None
-    patches = list(models.Patch.gql("WHERE patchset = :1 ORDER BY filename",
-                                    patchset))
+    patches = patchset.files
     patchset.patches = patches  # Required to render the jump to select.
 
     comments_by_patch, drafts_by_patch = _get_comment_counts(
@@ -2758,8 +2819,8 @@ def _add_next_prev(patchset, patch):
             found_patch = True
             continue
 
-        p._num_comments = comments_by_patch.get(p.key(), 0)
-        p._num_drafts = drafts_by_patch.get(p.key(), 0)
+        p.num_comments = comments_by_patch.get(p.id, 0)
+        p.num_drafts = drafts_by_patch.get(p.id, 0)
 
         if not found_patch:
             last_patch = p
@@ -2783,8 +2844,7 @@ def _add_next_prev(patchset, patch):
 def _add_next_prev2(ps_left, ps_right, patch_right):
     """Helper to add .next and .prev attributes to a patch object."""
     patch_right.prev = patch_right.next = None
-    patches = list(models.Patch.gql("WHERE patchset = :1 ORDER BY filename",
-                                    ps_right))
+    patches = ps_right.files
     ps_right.patches = patches  # Required to render the jump to select.
 
     n_comments, n_drafts = _get_comment_counts(
@@ -2801,19 +2861,20 @@ def _add_next_prev2(ps_left, ps_right, patch_right):
             found_patch = True
             continue
 
-        p._num_comments = n_comments.get(p.key(), 0)
-        p._num_drafts = n_drafts.get(p.key(), 0)
+        p.num_comments = n_comments.get(p.id, 0)
+        p.num_drafts = n_drafts.get(p.id, 0)
+        # The file differs from the one of the left patchset.
+        left_file = ps_left.get_file(p.filename)
+        in_delta = left_file is None or left_file.text_checksum != p.text_checksum
 
         if not found_patch:
             last_patch = p
-            if ((p.num_comments > 0 or p.num_drafts > 0) and
-                    ps_left.key().id() in p.delta):
+            if (p.num_comments > 0 or p.num_drafts > 0) and in_delta:
                 last_patch_with_comment = p
         else:
             if next_patch is None:
                 next_patch = p
-            if ((p.num_comments > 0 or p.num_drafts > 0) and
-                    ps_left.key().id() in p.delta):
+            if (p.num_comments > 0 or p.num_drafts > 0) and in_delta:
                 next_patch_with_comment = p
                 # safe to stop scanning now because the next with out a comment
                 # will already have been filled in by some earlier patch
@@ -2946,10 +3007,10 @@ def _get_affected_files(issue, full_diff=False):
     files = []
     modified_count = 0
     diff = ''
-    patchsets = list(issue.patchset_set.order('created'))
+    patchsets = list(models.patchset_headers(issue))
     if len(patchsets):
         patchset = patchsets[-1]
-        for patch in patchset.patch_set.order('filename'):
+        for patch in models.patch_headers(patchset):
             file_str = ''
             if patch.status:
                 file_str += patch.status + ' '
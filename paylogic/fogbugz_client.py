@@ -0,0 +1,208 @@
+"""Shared FogBugz API client.
+
+Clients are pooled per token and keep their HTTP connections alive, identical queries running at the same
+time are made only once and the results of read-only commands are cached for a short time.
+"""
+import httplib
+import socket
+import threading
+import time
+import urllib2
+from StringIO import StringIO
+
+import fogbugz
+
+from django.conf import settings
+
+READ_ONLY_COMMANDS = frozenset(['search', 'listPeople', 'listTags', 'viewPerson', 'listProjects'])
+"""FogBugz API commands not changing anything, which results can be cached."""
+
+MAX_CACHED_RESULTS = 1000
+"""Number of the cached results after which the expired ones are removed."""
+
+
+class KeepAliveHandler(urllib2.HTTPHandler, urllib2.HTTPSHandler):
+
+    """Urllib2 handler reusing the HTTP(S) connection between the requests of the same opener."""
+
+    def __init__(self):
+        urllib2.HTTPHandler.__init__(self)
+        self.connections = {}
+        # whether the request can be sent again when it's not known if the server has handled it
+        self.idempotent = False
+
+    def get_connection(self, connection_class, host, timeout):
+        """Get the open connection to the host, create it if needed."""
+        key = (connection_class, host)
+        if key not in self.connections:
+            self.connections[key] = connection_class(host, timeout=timeout)
+        return self.connections[key]
+
+    def open_request(self, connection_class, req):
+        """Send the request over the kept alive connection, reconnect once if the server has closed it.
+
+        The request which was already sent is sent again only if it's idempotent.
+        """
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError('no host given')
+        headers = dict(req.unredirected_hdrs)
+        headers.update(req.headers)
+        headers['Connection'] = 'keep-alive'
+        while True:
+            reused = (connection_class, host) in self.connections
+            connection = self.get_connection(connection_class, host, req.timeout)
+            sent = False
+            try:
+                connection.request(req.get_method(), req.get_selector(), req.data, headers)
+                sent = True
+                response = connection.getresponse()
+                break
+            except (httplib.HTTPException, socket.error) as e:
+                connection.close()
+                del self.connections[(connection_class, host)]
+                # the new connection isn't retried, the sent change could be applied by the server twice
+                if not reused or (sent and not self.idempotent):
+                    raise urllib2.URLError(e)
+        # the whole body is read before the next request, otherwise the connection can't be reused
+        result = urllib2.addinfourl(StringIO(response.read()), response.msg, req.get_full_url(), response.status)
+        result.msg = response.reason
+        return result
+
+    def http_open(self, req):
+        return self.open_request(httplib.HTTPConnection, req)
+
+    def https_open(self, req):
+        return self.open_request(httplib.HTTPSConnection, req)
+
+    def close(self):
+        """Close all the connections."""
+        for connection in self.connections.values():
+            connection.close()
+        self.connections.clear()
+
+
+class InFlightQuery(object):
+
+    """Query being made by one of the threads, others wait for its result."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+pool_lock = threading.Lock()
+idle_clients = {}
+in_flight = {}
+results = {}
+
+
+def acquire_client(token):
+    """Get an idle FogBugz client for the token from the pool, create a new one if there are none.
+
+    :param token: `str` FogBugz API token
+
+    :return: `fogbugz.FogBugz` object.
+    """
+    with pool_lock:
+        clients = idle_clients.get(token)
+        if clients:
+            return clients.pop()
+    client = fogbugz.FogBugz(settings.FOGBUGZ_URL, token=token)
+    client._keep_alive_handler = KeepAliveHandler()
+    client._opener = urllib2.build_opener(client._keep_alive_handler)
+    return client
+
+
+def release_client(token, client):
+    """Return the client to the pool."""
+    with pool_lock:
+        clients = idle_clients.setdefault(token, [])
+        if len(clients) < settings.FOGBUGZ_POOL_SIZE:
+            clients.append(client)
+
+
+def clear():
+    """Forget the pooled clients and the cached results."""
+    with pool_lock:
+        idle_clients.clear()
+        results.clear()
+
+
+def call(token, command, **kwargs):
+    """Make the FogBugz API call.
+
+    :param token: `str` FogBugz API token
+    :param command: `str` FogBugz API command name
+
+    :return: `BeautifulSoup` response.
+    """
+    read_only = command in READ_ONLY_COMMANDS
+    key = (token, command, tuple(sorted(kwargs.items())))
+    with pool_lock:
+        if read_only:
+            cached = results.get(key)
+            if cached is not None and cached[0] > time.time():
+                return cached[1]
+            query = in_flight.get(key)
+            is_owner = query is None
+            if is_owner:
+                query = in_flight[key] = InFlightQuery()
+        else:
+            # the case could be changed, so nothing cached is up to date anymore
+            results.clear()
+            query, is_owner = InFlightQuery(), True
+
+    if not is_owner:
+        query.done.wait()
+        if query.error is not None:
+            raise query.error
+        return query.result
+
+    try:
+        client = acquire_client(token)
+        client._keep_alive_handler.idempotent = read_only
+        query.result = getattr(client, command)(**kwargs)
+        release_client(token, client)
+        return query.result
+    except Exception as e:
+        query.error = e
+        raise
+    finally:
+        if read_only:
+            with pool_lock:
+                if query.error is None:
+                    now = time.time()
+                    if len(results) >= MAX_CACHED_RESULTS:
+                        for expired_key in [k for k, (expires, _) in results.items() if expires <= now]:
+                            del results[expired_key]
+                    results[key] = (now + settings.FOGBUGZ_CACHE_TIMEOUT, query.result)
+                del in_flight[key]
+        query.done.set()
+
+
+class FogBugzClient(object):
+
+    """FogBugz API client for the given token, making the calls through the shared client layer.
+
+    >>> get_client(token).search(q='ixBug:"1"', cols='sTitle')
+    """
+
+    def __init__(self, token):
+        self.token = token
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return lambda **kwargs: call(self.token, name, **kwargs)
+
+
+def get_client(token):
+    """Get the shared FogBugz API client for the token.
+
+    :param token: `str` FogBugz API token
+
+    :return: `FogBugzClient` object.
+    """
+    return FogBugzClient(token)
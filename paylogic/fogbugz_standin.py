@@ -0,0 +1,207 @@
+"""Local stand-in of the FogBugz XML API.
+
+Implements the API commands used by codereview on in-memory cases, with a configurable latency, so the
+complete review flow can be run and measured offline.
+"""
+import BaseHTTPServer
+import cgi
+import re
+import SocketServer
+import threading
+import time
+from xml.sax.saxutils import quoteattr
+
+from django.conf import settings
+
+CASE_NUMBER_RE = re.compile(r'\d+')
+
+
+def cdata(value):
+    """Wrap the value into the XML CDATA section."""
+    return u'<![CDATA[{0}]]>'.format(unicode(value).replace(u']]>', u']]]]><![CDATA[>'))
+
+
+class Case(object):
+
+    """FogBugz case of the stand-in."""
+
+    def __init__(self, case_id, title, original_branch, feature_branch, ci_project, target_branch):
+        self.case_id = case_id
+        self.fields = {
+            'sTitle': title,
+            settings.FOGBUGZ_ORIGINAL_BRANCH_FIELD_ID: original_branch,
+            settings.FOGBUGZ_FEATURE_BRANCH_FIELD_ID: feature_branch,
+            settings.FOGBUGZ_CI_PROJECT_FIELD_ID: ci_project,
+            settings.FOGBUGZ_TARGET_BRANCH_FIELD_ID: target_branch,
+        }
+        self.tags = []
+        #: ids of the people the case was assigned to, the oldest first
+        self.assignees = []
+
+    def to_xml(self, cols):
+        """Get the XML of the case with the given columns."""
+        xml = []
+        for col in cols:
+            if col == 'events':
+                xml.append(u'<events>{0}</events>'.format(u''.join(
+                    u'<event ixBugEvent="{0}" ixBug="{1}"><ixPersonAssignedTo>{2}</ixPersonAssignedTo>'
+                    u'<evt>3</evt></event>'.format(index + 1, self.case_id, person_id)
+                    for index, person_id in enumerate(self.assignees))))
+            elif col == 'tags':
+                xml.append(u'<tags>{0}</tags>'.format(u''.join(
+                    u'<tag>{0}</tag>'.format(cdata(tag)) for tag in self.tags)))
+            elif col in self.fields:
+                xml.append(u'<{0}>{1}</{0}>'.format(col, cdata(self.fields[col] or '')))
+        return u'<case ixBug="{0}">{1}</case>'.format(self.case_id, u''.join(xml))
+
+
+class FogBugzAPIHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    """Handler of the FogBugz API requests."""
+
+    protocol_version = 'HTTP/1.1'
+    # send the whole response at once, otherwise the delayed acknowledgement is measured as the latency
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def respond(self, xml):
+        time.sleep(self.server.standin.latency)
+        body = u'<?xml version="1.0" encoding="UTF-8"?><response>{0}</response>'.format(xml).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.startswith('/api.xml'):
+            self.respond(u'<version>8</version><minversion>1</minversion><url>api.asp?</url>')
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        form = cgi.FieldStorage(
+            fp=self.rfile, headers=self.headers,
+            environ={'REQUEST_METHOD': 'POST', 'CONTENT_TYPE': self.headers['Content-Type']})
+        params = dict((key, form.getfirst(key).decode('utf-8')) for key in form.keys())
+        command = getattr(self.server.standin, 'cmd_' + params.pop('cmd', ''), None)
+        if command is None:
+            self.respond(u'<error code="3">Unknown command</error>')
+            return
+        try:
+            self.respond(command(**params))
+        except KeyError as e:
+            self.respond(u'<error code="3">{0} not found</error>'.format(cgi.escape(unicode(e))))
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    """HTTP server handling every connection in its own thread."""
+
+    daemon_threads = True
+
+
+class FogBugzStandIn(object):
+
+    """FogBugz API stand-in server running in a background thread.
+
+    >>> standin = FogBugzStandIn(latency=0.05)
+    >>> standin.add_case(1, 'Title', 'git+/repos/target#master', 'git+/repos/source#feature', 'project', '')
+    >>> standin.start()
+    >>> settings.FOGBUGZ_URL = standin.url
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0):
+        """Constructor.
+
+        :param host: `str` address to listen on
+        :param port: `int` port to listen on, any free one by default
+        :param latency: `float` seconds to wait before every response
+        """
+        self.latency = latency
+        self.cases = {}
+        self.people = {}
+        self.all_tags = set()
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), FogBugzAPIHandler)
+        self.server.standin = self
+        self.thread = None
+
+    @property
+    def url(self):
+        """Url of the stand-in, to be used as FOGBUGZ_URL setting."""
+        return 'http://{0}:{1}/'.format(*self.server.server_address)
+
+    def add_case(self, case_id, title, original_branch, feature_branch, ci_project, target_branch):
+        """Add the case."""
+        self.cases[int(case_id)] = Case(
+            int(case_id), title, original_branch, feature_branch, ci_project, target_branch)
+        return self.cases[int(case_id)]
+
+    def add_person(self, person_id, full_name, email):
+        """Add the person."""
+        self.people[int(person_id)] = (full_name, email)
+
+    def start(self):
+        """Start serving the requests in the background thread."""
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def serve_forever(self):
+        """Serve the requests in the current thread."""
+        self.server.serve_forever()
+
+    def stop(self):
+        """Stop the server."""
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get_case(self, ixBug):
+        return self.cases[int(CASE_NUMBER_RE.search(ixBug).group())]
+
+    def cmd_logon(self, email, **params):
+        return u'<token>{0}</token>'.format(cdata(email))
+
+    def cmd_logoff(self, **params):
+        return u''
+
+    def cmd_search(self, q, cols='', **params):
+        match = CASE_NUMBER_RE.search(q)
+        cases = [self.cases[int(match.group())]] if match and int(match.group()) in self.cases else []
+        cols = cols.split(',')
+        return u'<cases count="{0}">{1}</cases>'.format(len(cases), u''.join(case.to_xml(cols) for case in cases))
+
+    def person_xml(self, person_id):
+        full_name, email = self.people[person_id]
+        return u'<person><ixPerson>{0}</ixPerson><sFullName>{1}</sFullName><sEmail>{2}</sEmail></person>'.format(
+            person_id, cdata(full_name), cdata(email))
+
+    def cmd_viewPerson(self, ixPerson, **params):
+        return self.person_xml(int(ixPerson))
+
+    def cmd_listPeople(self, **params):
+        return u'<people>{0}</people>'.format(u''.join(self.person_xml(person_id) for person_id in self.people))
+
+    def cmd_listTags(self, **params):
+        return u'<tags>{0}</tags>'.format(u''.join(
+            u'<tag><ixTag>{0}</ixTag><sTag>{1}</sTag><cTagUses>1</cTagUses></tag>'.format(index + 1, cdata(tag))
+            for index, tag in enumerate(sorted(self.all_tags))))
+
+    def cmd_edit(self, ixBug, **params):
+        with self.lock:
+            case = self.get_case(ixBug)
+            if params.get('ixPersonAssignedTo'):
+                case.assignees.append(int(params['ixPersonAssignedTo']))
+            if 'sTags' in params:
+                case.tags = [tag for tag in params['sTags'].split(',') if tag]
+                self.all_tags.update(case.tags)
+            for field in case.fields:
+                if field in params:
+                    case.fields[field] = params[field]
+        return u'<case ixBug={0} operations="edit,assign"></case>'.format(quoteattr(unicode(case.case_id)))
+
+    cmd_assign = cmd_edit
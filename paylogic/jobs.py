@@ -0,0 +1,197 @@
+"""Background processing of the codereview jobs and the FogBugz operations."""
+import contextlib
+import datetime
+import logging
+import os
+import socket
+import threading
+
+from django import db as django_db
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Min, Q
+
+from codereview import models
+
+from paylogic import views
+
+
+def get_worker_name():
+    """Get the name of the current worker process.
+
+    :return: `str` in form 'host:pid'.
+    """
+    return '{0}:{1}'.format(socket.gethostname(), os.getpid())
+
+
+def get_lease_expiry():
+    """Get the time before which the running jobs and operations of a worker are considered abandoned.
+
+    :return: `datetime` object.
+    """
+    return datetime.datetime.now() - datetime.timedelta(seconds=settings.CODEREVIEW_PROCESSING_LEASE_TIMEOUT)
+
+
+@contextlib.contextmanager
+def heartbeat(model, id):
+    """Record that the worker running the job or operation is alive, in a background thread.
+
+    :param model: `ProcessingJob` or `FogBugzOperation` class
+    :param id: `int` id of the running job or operation
+    """
+    stop = threading.Event()
+
+    def beat():
+        try:
+            while not stop.wait(settings.CODEREVIEW_PROCESSING_LEASE_TIMEOUT / 4.0):
+                model.objects.filter(id=id, status='running').update(heartbeat=datetime.datetime.now())
+        except Exception:
+            logging.exception('Heartbeat of %s %s failed', model.__name__, id)
+        finally:
+            django_db.close_connection()
+
+    thread = threading.Thread(target=beat)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def requeue_abandoned_jobs():
+    """Queue again the running jobs of the workers which stopped.
+
+    The jobs which stopped their workers CODEREVIEW_PROCESSING_MAX_ATTEMPTS times are marked as failed and
+    the processing flag of their issues is cleared, the queued ones keep it.
+
+    :return: `int` number of jobs queued again or marked as failed.
+    """
+    count = 0
+    # jobs started before the heartbeats were recorded don't have one
+    abandoned = models.ProcessingJob.objects.filter(
+        Q(heartbeat__lt=get_lease_expiry()) | Q(heartbeat=None), status='running')
+    for job in abandoned:
+        attempts = job.attempts + 1
+        if attempts >= settings.CODEREVIEW_PROCESSING_MAX_ATTEMPTS:
+            values = dict(status='failed', error='The worker stopped {0} times while running the job'.format(attempts))
+        else:
+            values = dict(status='queued', progress='Queued again, the worker stopped')
+        if models.ProcessingJob.objects.filter(id=job.id, status='running', heartbeat=job.heartbeat).update(
+                worker=None, attempts=attempts, **values):
+            logging.warning('Job %s of the stopped worker %s is %s', job.id, job.worker, values['status'])
+            if values['status'] == 'failed':
+                models.Issue.objects.filter(id=job.issue_id).update(processing=False)
+            count += 1
+    return count
+
+
+def claim_job(worker):
+    """Claim the oldest queued job for the worker.
+
+    Claiming is a conditional update, so the same job is never claimed by two workers. The jobs abandoned by
+    the stopped workers are queued again first.
+
+    :param worker: `str` name of the worker
+
+    :return: `ProcessingJob` object or `None` if there are no queued jobs.
+    """
+    requeue_abandoned_jobs()
+    for job in models.ProcessingJob.objects.filter(status='queued').order_by('created')[:10]:
+        now = datetime.datetime.now()
+        if models.ProcessingJob.objects.filter(id=job.id, status='queued').update(
+                status='running', worker=worker, started=now, heartbeat=now):
+            return models.ProcessingJob.objects.get(id=job.id)
+    return None
+
+
+def requeue_abandoned_fogbugz_operations():
+    """Queue again the running FogBugz operations of the workers which stopped, counting it as a failed attempt.
+
+    The operation could have been made before the worker stopped, it's made again then.
+
+    :return: `int` number of operations queued again or marked as failed.
+    """
+    count = 0
+    abandoned = models.FogBugzOperation.objects.filter(
+        Q(heartbeat__lt=get_lease_expiry()) | Q(heartbeat=None), status='running')
+    for operation in abandoned:
+        attempts = operation.attempts + 1
+        status = 'failed' if attempts >= settings.FOGBUGZ_OUTBOX_MAX_ATTEMPTS else 'queued'
+        if models.FogBugzOperation.objects.filter(
+                id=operation.id, status='running', heartbeat=operation.heartbeat).update(
+                status=status, worker=None, attempts=attempts, next_attempt=datetime.datetime.now(),
+                error='The worker stopped while making the operation'):
+            logging.warning(
+                'FogBugz operation %s of the stopped worker %s is %s', operation.id, operation.worker,
+                'queued again' if status == 'queued' else 'failed')
+            count += 1
+    return count
+
+
+def claim_fogbugz_operation(worker):
+    """Claim the oldest queued FogBugz operation due to be made for the worker.
+
+    Operations of the same case are claimed in the order of their creation, one at a time, so only the first
+    unfinished operation of every case can be claimed. The operations abandoned by the stopped workers are
+    queued again first.
+
+    :param worker: `str` name of the worker
+
+    :return: `FogBugzOperation` object or `None` if there are no operations to make.
+    """
+    requeue_abandoned_fogbugz_operations()
+    first_ids = [
+        row['first_id'] for row in models.FogBugzOperation.objects.filter(
+            status__in=('queued', 'running')).order_by().values('case_id').annotate(first_id=Min('id'))]
+    if not first_ids:
+        return None
+    operations = models.FogBugzOperation.objects.filter(
+        id__in=first_ids, status='queued', next_attempt__lte=datetime.datetime.now()).order_by('id')
+    for operation in operations:
+        now = datetime.datetime.now()
+        if models.FogBugzOperation.objects.filter(id=operation.id, status='queued').update(
+                status='running', worker=worker, started=now, heartbeat=now):
+            return models.FogBugzOperation.objects.get(id=operation.id)
+    return None
+
+
+def run_worker(poll_interval=None, once=False, stop=None):
+    """Run the queued FogBugz operations and jobs one by one, the operations first.
+
+    :param poll_interval: `float` seconds to wait for new jobs when the queue is empty
+    :param once: `bool` exit when the queue is empty instead of waiting for new jobs
+    :param stop: `multiprocessing.Event` object, the worker exits when it's set, after the current job
+    """
+    if poll_interval is None:
+        poll_interval = settings.CODEREVIEW_PROCESSING_POLL_INTERVAL
+    if stop is None:
+        stop = threading.Event()
+    worker = get_worker_name()
+    while not stop.is_set():
+        # end the current transaction, otherwise the jobs queued after it has started are not visible
+        transaction.commit_unless_managed()
+        operation = claim_fogbugz_operation(worker)
+        if operation is not None:
+            logging.info('Worker %s is making FogBugz %s of case %s', worker, operation.command, operation.case_id)
+            try:
+                with heartbeat(models.FogBugzOperation, operation.id):
+                    views.run_fogbugz_operation(operation)
+            except Exception:
+                logging.exception('FogBugz operation %s failed', operation.id)
+            continue
+        job = claim_job(worker)
+        if job is None:
+            if once:
+                return
+            stop.wait(poll_interval)
+            continue
+        logging.info('Worker %s is processing job %s of issue %s', worker, job.id, job.issue.id)
+        try:
+            with heartbeat(models.ProcessingJob, job.id):
+                views.run_processing_job(job)
+        except Exception:
+            logging.exception('Processing job %s failed', job.id)
+        finally:
+            django_db.reset_queries()
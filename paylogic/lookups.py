@@ -1,5 +1,7 @@
 """Lookups for paylogic customizations."""
+import bisect
 import os.path
+from hashlib import md5
 
 from django_select2 import Select2View, NO_ERR_RESP
 from django.conf import settings
@@ -8,35 +10,90 @@ from paylogic import views
 from paylogic.vcs import GuessVCS
 
 
+def build_prefix_index(choices):
+    """Build the prefix index of the lookup choices.
+
+    Choices are indexed by their lower cased id, text and the parts of them after the slashes.
+
+    :param choices: `list` of (id, text) tuples
+
+    :return: sorted `list` of (prefix, choice position) tuples.
+    """
+    index = set()
+    for position, choice in enumerate(choices):
+        for value in choice:
+            value = unicode(value).lower()
+            index.add((value, position))
+            parts = value.split('/')
+            for i in range(1, len(parts)):
+                index.add(('/'.join(parts[i:]), position))
+    return sorted(index)
+
+
+def filter_choices(choices, index, term):
+    """Filter the lookup choices by the term using the prefix index.
+
+    :param choices: `list` of (id, text) tuples
+    :param index: prefix index built by `build_prefix_index`
+    :param term: `unicode` term typed by the user
+
+    :return: `list` of the choices starting with the term, in their original order.
+    """
+    term = (term or u'').strip().lower()
+    if not term:
+        return choices
+    positions = set()
+    for prefix, position in index[bisect.bisect_left(index, (term,)):]:
+        if not prefix.startswith(term):
+            break
+        positions.add(position)
+    return [choice for position, choice in enumerate(choices) if position in positions]
+
+
 class TargetBranchesView(Select2View):
 
     """Lookup for target branch field."""
 
-    def get_results(self, request, term, page, context):
-        """Get the list of possible target branch(es)."""
-        case_id = self.kwargs['case_id']
-        _, case_title, original_branch, feature_branch, ci_project, target_branch = views.get_fogbugz_case_info(
-            request, case_id)
+    def get_choices(self, request, case_id):
+        """Get the list of possible target branch(es) with their prefix index."""
+        # the token is taken here, the case info can be got in the background after the request has finished
+        token = views.get_fogbugz_token(request)
+        case_key = 'lookups:case:{0}:{1}'.format(case_id, md5(token or '').hexdigest())
+        _, case_title, original_branch, feature_branch, ci_project, target_branch = views.get_cached(
+            case_key, lambda: views.get_fogbugz_case_info_by_token(token, case_id))
 
         target_vcs, target_url, target_revision, target_branch_is_local, _ = views.parse_branch_vcs_info(
             original_branch, settings.ORIGINAL_BRANCH_DEFAULT_PREFIX)
 
-        branches = []
-        if os.path.isdir(target_url):
-            target = GuessVCS(
-                views.attrdict({'revision': target_revision, 'vcs': target_vcs}), target_url)
-            try:
-                branches = target.GetBranches()
-            except Exception:
-                # could be not yet supported by VCS
-                pass
-
-        if settings.CODEREVIEW_TARGET_BRANCH_CHOICES_GETTER:
-            choices = settings.CODEREVIEW_TARGET_BRANCH_CHOICES_GETTER(
-                ci_project, target_revision, target_branch, branches)
-        else:
-            choices = []
-        return (NO_ERR_RESP, False, choices)  # Any error response, Has more results, options list
+        def get_choices():
+            branches = []
+            if os.path.isdir(target_url):
+                target = GuessVCS(
+                    views.attrdict({'revision': target_revision, 'vcs': target_vcs}), target_url)
+                try:
+                    branches = target.GetBranches()
+                except Exception:
+                    # could be not yet supported by VCS
+                    pass
+
+            if settings.CODEREVIEW_TARGET_BRANCH_CHOICES_GETTER:
+                choices = settings.CODEREVIEW_TARGET_BRANCH_CHOICES_GETTER(
+                    ci_project, target_revision, target_branch, branches)
+            else:
+                choices = []
+            return choices, build_prefix_index(choices)
+
+        # the branches are listed from the local repository, which is not updated by the reviews, so the
+        # LOOKUP_CACHE_TIMEOUT is the only refresh of the listed branches
+        choices_key = 'lookups:target_branches:' + md5(':'.join([
+            case_key, target_url or '', target_revision or ''])).hexdigest()
+        return views.get_cached(choices_key, get_choices)
+
+    def get_results(self, request, term, page, context):
+        """Get the list of possible target branch(es)."""
+        choices, index = self.get_choices(request, self.kwargs['case_id'])
+        # Any error response, Has more results, options list
+        return (NO_ERR_RESP, False, filter_choices(choices, index, term))
 
 
 class CaseAssignedView(Select2View):
@@ -0,0 +1,264 @@
+import math
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+from optparse import make_option
+
+from django.conf import settings
+from django.contrib.auth import models as auth_models
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.client import Client
+
+from django_auth_fogbugz.models import FogBugzProfile
+
+from codereview import models
+
+from paylogic import fogbugz_client
+from paylogic.fogbugz_standin import FogBugzStandIn
+
+VCS_COMMANDS = {
+    'git': {
+        'init': ['git', 'init', '-q'],
+        'config': [['git', 'config', 'user.name', 'benchmark'], ['git', 'config', 'user.email', 'benchmark@localhost']],
+        'add': ['git', 'add', '.'],
+        'commit': ['git', 'commit', '-q', '-m', 'benchmark commit'],
+        'clone': ['git', 'clone', '-q'],
+        'branch': ['git', 'checkout', '-q', '-b'],
+        'bare': ['git', 'config', 'core.bare', 'true'],
+        'default_branch': 'master',
+    },
+    'hg': {
+        'init': ['hg', 'init'],
+        'config': [],
+        'add': ['hg', 'add', '-q', '.'],
+        'commit': ['hg', 'commit', '-m', 'benchmark commit', '--user', 'benchmark'],
+        'clone': ['hg', 'clone', '-q'],
+        'branch': ['hg', 'branch', '-q'],
+        'default_branch': 'default',
+    },
+    'bzr': {
+        'init': ['bzr', 'init-repo', '-q'],
+        'config': [['bzr', 'whoami', 'benchmark <benchmark@localhost>']],
+        'init_branch': ['bzr', 'init', '-q'],
+        'add': ['bzr', 'add', '-q', '.'],
+        'commit': ['bzr', 'commit', '-q', '-m', 'benchmark commit'],
+        'clone': ['bzr', 'branch', '-q'],
+        'default_branch': 'trunk',
+    },
+}
+"""Commands to create the synthetic repositories."""
+
+PHASES = (
+    'fogbugz', 'show', 'lookup_target_branches', 'lookup_case_assigned', 'lookup_tags', 'publish_form', 'publish')
+"""Measured steps of the review flow, in the order they are made."""
+
+XSRF_TOKEN_RE = re.compile(r'name="xsrf_token" value="([^"]+)"')
+
+CASE_ID = 1000
+PERSON_ID = 10
+TOKEN = 'benchmark-token'
+
+
+def write_files(path, files, lines, version):
+    """Write the synthetic source files.
+
+    :param path: `str` directory to write the files into
+    :param files: `int` number of files to write
+    :param lines: `int` number of lines per file
+    :param version: `str` marker of the changed lines
+    """
+    for index in range(files):
+        file_dir = os.path.join(path, 'package{0}'.format(index % 10))
+        if not os.path.isdir(file_dir):
+            os.makedirs(file_dir)
+        with open(os.path.join(file_dir, 'module{0}.py'.format(index)), 'w') as fd:
+            for line in range(lines):
+                if version and line % 20 == 0:
+                    fd.write('value_{0} = "{1}"\n'.format(line, version))
+                else:
+                    fd.write('value_{0} = {0}  # line of the module {1}\n'.format(line, index))
+
+
+def create_repositories(vcs, base_dir, files, lines, changed):
+    """Create the target repository and the source one, branched from it with some files changed.
+
+    :return: `tuple` in form (original branch, feature branch).
+    """
+    commands = VCS_COMMANDS[vcs]
+    target = os.path.join(base_dir, 'target')
+    source = os.path.join(base_dir, 'source')
+
+    def call(command, cwd):
+        subprocess.check_call(command, cwd=cwd)
+
+    call(commands['init'] + [target], base_dir)
+    if vcs == 'bzr':
+        target = os.path.join(target, commands['default_branch'])
+        call(commands['init_branch'] + [target], base_dir)
+    for command in commands['config']:
+        call(command, target)
+    write_files(target, files, lines, None)
+    call(commands['add'], target)
+    call(commands['commit'], target)
+
+    if vcs == 'bzr':
+        os.makedirs(source)
+        source = os.path.join(source, 'feature')
+        call(commands['clone'] + [target, source], base_dir)
+    else:
+        call(commands['clone'] + [target, source], base_dir)
+        call(commands['branch'] + ['feature'], source)
+    for command in commands['config']:
+        call(command, source)
+    write_files(source, changed, lines, 'feature')
+    call(commands['add'], source)
+    call(commands['commit'], source)
+    if vcs == 'git':
+        call(commands['bare'], target)
+        call(commands['bare'], source)
+    return (
+        '{0}+{1}#{2}'.format(vcs, target, commands['default_branch']),
+        '{0}+{1}#feature'.format(vcs, source))
+
+
+def percentile(values, percent):
+    """Get the nearest-rank percentile of the values."""
+    values = sorted(values)
+    return values[max(0, int(math.ceil(percent / 100.0 * len(values))) - 1)]
+
+
+class Command(BaseCommand):
+    help = ('measures the latency of the review flow pages against synthetic repositories and a local FogBugz '
+            'stand-in, using a temporary test database')
+    option_list = BaseCommand.option_list + (
+        make_option('--vcs', dest='vcs', default='git,hg,bzr',
+                    help='comma separated version control systems to benchmark'),
+        make_option('--files', type='int', dest='files', default=200, help='number of files in the repository'),
+        make_option('--lines', type='int', dest='lines', default=200, help='number of lines per file'),
+        make_option('--changed', type='int', dest='changed', default=20,
+                    help='number of files changed on the feature branch'),
+        make_option('--iterations', type='int', dest='iterations', default=10,
+                    help='number of times the review flow is repeated'),
+        make_option('--latency', type='float', dest='latency', default=0.05,
+                    help='number of seconds the FogBugz stand-in waits before every response'),
+    )
+
+    def handle(self, *args, **options):
+        vcs_list = options['vcs'].split(',')
+        for vcs in vcs_list:
+            if vcs not in VCS_COMMANDS:
+                raise CommandError('Unsupported version control system: {0}'.format(vcs))
+
+        old_database_name = settings.DATABASES['default'].get('NAME')
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        temp_dir = tempfile.mkdtemp(prefix='codereview-benchmark-')
+        standin = FogBugzStandIn(latency=options['latency'])
+        standin.add_person(PERSON_ID, 'Benchmark User', 'benchmark@example.com')
+        standin.start()
+        try:
+            self.configure(standin, temp_dir)
+            client = self.create_client()
+            for vcs in vcs_list:
+                base_dir = os.path.join(temp_dir, vcs)
+                os.makedirs(base_dir)
+                original_branch, feature_branch = create_repositories(
+                    vcs, base_dir, options['files'], options['lines'], options['changed'])
+                self.configure_vcs(vcs, base_dir)
+                case = standin.add_case(
+                    CASE_ID + vcs_list.index(vcs), '{0} benchmark'.format(vcs), original_branch, feature_branch,
+                    'benchmark', '')
+                case.assignees.append(PERSON_ID)
+                timings = self.run_flow(client, case.case_id, options['iterations'])
+                self.report(vcs, timings)
+        finally:
+            standin.stop()
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            connection.creation.destroy_test_db(old_database_name, verbosity=0)
+
+    def configure(self, standin, temp_dir):
+        """Point the settings to the FogBugz stand-in and the temporary directories."""
+        settings.FOGBUGZ_URL = settings.AUTH_FOGBUGZ_SERVER = standin.url
+        settings.TEMP_FOLDER = os.path.join(temp_dir, 'tmp')
+        settings.MIRROR_FOLDER = os.path.join(temp_dir, 'mirrors')
+        settings.CODEREVIEW_PROCESSING_ASYNC = False
+        settings.FOGBUGZ_OUTBOX_ASYNC = False
+        settings.CODEREVIEW_VALIDATORS = []
+        settings.EMAIL_BACKEND = 'django.core.mail.backends.locmem.EmailBackend'
+        # the benchmark user logs in with the password stored in the test database
+        settings.AUTHENTICATION_BACKENDS = ('django.contrib.auth.backends.ModelBackend',)
+        cache.clear()
+        fogbugz_client.clear()
+
+    def configure_vcs(self, vcs, base_dir):
+        """Configure the version control system of the synthetic repositories."""
+        settings.VCS = {
+            vcs: {
+                'base_dir': base_dir,
+                'regex': re.compile('^({0}/|{1}\+)(.+)$'.format(re.escape(base_dir), vcs)),
+                'supports_direct_export': vcs != 'git',
+                'supports_simple_cloning': vcs != 'bzr',
+                'default_branch': VCS_COMMANDS[vcs]['default_branch'],
+            },
+        }
+
+    def create_client(self):
+        """Create the benchmark user and log in with it."""
+        user = auth_models.User.objects.create_user('benchmark', 'benchmark@example.com', 'benchmark')
+        for permission in auth_models.Permission.objects.filter(content_type__app_label='codereview'):
+            user.user_permissions.add(permission)
+        fogbugzprofile = FogBugzProfile(token=TOKEN, ixPerson=PERSON_ID)
+        fogbugzprofile.save()
+        user.fogbugzprofile = fogbugzprofile
+        user.save()
+        client = Client()
+        if not client.login(username='benchmark', password='benchmark'):
+            raise CommandError('Could not log in with the benchmark user.')
+        return client
+
+    def request(self, client, timings, phase, method, url, data=None, status=(200, 302)):
+        """Make the request, record its duration."""
+        start = time.time()
+        response = getattr(client, method)(url, data or {})
+        timings[phase].append(time.time() - start)
+        if response.status_code not in status:
+            raise CommandError('{0} {1} failed with status {2}:\n{3}'.format(
+                method.upper(), url, response.status_code, response.content[:2000]))
+        return response
+
+    def run_flow(self, client, case_id, iterations):
+        """Run the review flow of the case.
+
+        :return: `dict` in form {phase: [seconds]}.
+        """
+        timings = dict((phase, []) for phase in PHASES)
+        for _ in range(iterations):
+            self.request(client, timings, 'fogbugz', 'get', '/fogbugz', {'case': case_id})
+            issue = models.Issue.objects.filter(subject__startswith='(Case {0}) '.format(case_id)).get()
+            self.request(client, timings, 'show', 'get', '/{0}/show'.format(issue.id))
+            for phase, url in [
+                    ('lookup_target_branches', '/lookup/target_branches/{0}'),
+                    ('lookup_case_assigned', '/lookup/case_assigned/{0}'),
+                    ('lookup_tags', '/lookup/tags/{0}')]:
+                self.request(client, timings, phase, 'get', url.format(case_id), {'term': '', 'page': 1})
+            response = self.request(client, timings, 'publish_form', 'get', '/{0}/publish'.format(issue.id))
+            self.request(client, timings, 'publish', 'post', '/{0}/publish'.format(issue.id), {
+                'xsrf_token': XSRF_TOKEN_RE.search(response.content).group(1),
+                'subject': issue.subject,
+                'message': 'Benchmark message',
+                'send_mail': '',
+                'assign_to': PERSON_ID,
+                'tags': 'benchmark',
+            })
+        return timings
+
+    def report(self, vcs, timings):
+        """Write the percentiles of the phase timings."""
+        self.stdout.write('\n{0}\n{1:<24}{2:>10}{3:>10}{4:>10}\n'.format(vcs, 'phase, ms', 'p50', 'p95', 'p99'))
+        for phase in PHASES:
+            self.stdout.write('{0:<24}{1:>10.1f}{2:>10.1f}{3:>10.1f}\n'.format(
+                phase, *[percentile(timings[phase], percent) * 1000 for percent in (50, 95, 99)]))
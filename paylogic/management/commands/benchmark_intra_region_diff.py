@@ -0,0 +1,127 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from codereview import engine, intra_region_diff, linediff
+
+
+def renamed_attribute(version):
+    """Generate code with an attribute renamed in every function, identical regions repeated a lot."""
+    lines = []
+    for index in range(2000):
+        lines.extend([
+            'def get_{0}(self):\n'.format(index),
+            '    if self.{0} is None:\n'.format('_store' if version else '_cache'),
+            '        self._load()\n',
+            '    return self.{0}.get({1})\n'.format('_store' if version else '_cache', index),
+            '\n',
+        ])
+    return lines
+
+
+def version_bump(version):
+    """Generate a lock file with a part of the package versions changed, similar regions."""
+    lines = ['{\n']
+    for index in range(4000):
+        lines.extend([
+            '  "package-{0}": {{\n'.format(index),
+            '    "version": "1.{0}.{1}",\n'.format(1 if version and index % 4 == 0 else 0, index % 10),
+            '    "dev": false\n',
+            '  },\n',
+        ])
+    return lines + ['}\n']
+
+
+def unique_changes(version):
+    """Generate source code with unique changed lines, nothing to reuse."""
+    lines = []
+    for index in range(8000):
+        if version and index % 8 == 0:
+            lines.append('value_{0} = compute({0}, "changed {0}")\n'.format(index))
+        else:
+            lines.append('value_{0} = compute({0})\n'.format(index))
+    return lines
+
+
+SYNTHETIC_CORPUS = (
+    ('renamed_attribute', renamed_attribute),
+    ('version_bump', version_bump),
+    ('unique_changes', unique_changes),
+)
+"""Files generated when no file pairs are given, in the original and the changed version."""
+
+
+def get_regions(old_lines, new_lines):
+    """Get the replace regions of the diff, as they are diffed by the diff views.
+
+    :return: `list` of (old_lines, new_lines) tuples.
+    """
+    regions = []
+    for tag, i1, i2, j1, j2 in linediff.GetOpcodes(old_lines, new_lines):
+        old, new = old_lines[i1:i2], new_lines[j1:j2]
+        if tag == 'replace' and intra_region_diff.CanDoIRDiff(old, new):
+            size = max(len(old), len(new))
+            regions.append((old + [''] * (size - len(old)), new + [''] * (size - len(new))))
+    return regions
+
+
+class Command(BaseCommand):
+    args = '[old_file:new_file ...]'
+    help = ('measures the intra-region word diff of the replaced lines without caching, batched with cold caches '
+            'and batched with warm caches, and its share of the diff rendering, on the given pairs of files or on '
+            'a synthetic corpus')
+    option_list = BaseCommand.option_list + (
+        make_option('--repeat', type='int', dest='repeat', default=3,
+                    help='number of times every measurement is made, the fastest one is reported'),
+    )
+
+    def handle(self, *args, **options):
+        corpus = []
+        for arg in args:
+            if ':' not in arg:
+                raise CommandError('Expected old_file:new_file, got: {0}'.format(arg))
+            old_path, new_path = arg.split(':', 1)
+            with open(old_path) as old_file, open(new_path) as new_file:
+                corpus.append((arg, old_file.readlines(), new_file.readlines()))
+        if not corpus:
+            corpus = [(name, generate(None), generate(1)) for name, generate in SYNTHETIC_CORPUS]
+
+        diff_params = intra_region_diff.GetDiffParams()
+
+        def uncached(regions):
+            for old, new in regions:
+                intra_region_diff.ClearCaches()
+                intra_region_diff.IntraRegionDiff(old, new, diff_params)
+
+        def cold(regions):
+            intra_region_diff.ClearCaches()
+            intra_region_diff.IntraRegionDiffs(regions, diff_params)
+
+        def warm(regions):
+            intra_region_diff.IntraRegionDiffs(regions, diff_params)
+
+        def render(old_lines, new_lines):
+            intra_region_diff.ClearCaches()
+            list(engine.RenderDiff2CodeRows(old_lines, None, new_lines, None))
+
+        self.stdout.write('{0:<30}{1:>10}{2:>12}{3:>12}{4:>12}{5:>12}{6:>10}\n'.format(
+            'file', 'regions', 'uncached ms', 'cold ms', 'warm ms', 'render ms', 'IR share'))
+        for name, old_lines, new_lines in corpus:
+            regions = get_regions(old_lines, new_lines)
+            timings = [
+                self.measure(measured, arguments, options['repeat'])
+                for measured, arguments in [
+                    (uncached, [regions]), (cold, [regions]), (warm, [regions]), (render, [old_lines, new_lines])]]
+            self.stdout.write('{0:<30}{1:>10}{2:>12.1f}{3:>12.1f}{4:>12.1f}{5:>12.1f}{6:>9.0f}%\n'.format(
+                name, len(regions), *([timing * 1000 for timing in timings] + [
+                    timings[1] * 100 / timings[3] if timings[3] else 0])))
+
+    def measure(self, measured, arguments, repeat):
+        """Get the fastest time of the call, in seconds."""
+        timings = []
+        for _ in range(repeat):
+            start = time.time()
+            measured(*arguments)
+            timings.append(time.time() - start)
+        return min(timings)
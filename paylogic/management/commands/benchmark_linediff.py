@@ -0,0 +1,135 @@
+import random
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from codereview import linediff
+
+
+def lockfile(version):
+    """Generate a lock file with a lot of repeated lines."""
+    lines = ['{\n']
+    for index in range(4000):
+        lines.extend([
+            '  "package-{0}": {{\n'.format(index),
+            '    "version": "1.0.{0}",\n'.format(version if index % 50 == 0 else index % 3),
+            '    "dev": false\n',
+            '  },\n',
+        ])
+    return lines + ['}\n']
+
+
+def generated_code(version):
+    """Generate code with the same statements repeated in every function."""
+    lines = []
+    for index in range(2000):
+        lines.extend([
+            'def get_{0}(self):\n'.format(index if index % 40 or not version else 'v{0}_{1}'.format(version, index)),
+            '    if self._cache is None:\n',
+            '        self._load()\n',
+            '    return self._cache.get({0})\n'.format(index),
+            '\n',
+        ])
+    return lines
+
+
+def sql_dump(version):
+    """Generate an SQL dump of identical rows with some changed ones."""
+    lines = ['BEGIN;\n']
+    for index in range(10000):
+        lines.append("INSERT INTO item VALUES (1, 'value');\n" if index % 500 or not version else
+                     "INSERT INTO item VALUES (1, 'value {0}');\n".format(version))
+    return lines + ['COMMIT;\n']
+
+
+def source_code(version):
+    """Generate source code with some blocks moved, removed and added."""
+    rng = random.Random(1)
+    blocks = [
+        ['# block {0}\n'.format(index)] + ['x_{0} = {1}\n'.format(index, line) for line in range(rng.randint(3, 30))]
+        for index in range(300)]
+    if version:
+        rng = random.Random(version)
+        for _ in range(20):
+            blocks.insert(rng.randrange(len(blocks)), blocks.pop(rng.randrange(len(blocks))))
+            blocks[rng.randrange(len(blocks))] = ['# new block\n', 'pass\n']
+    return [line for block in blocks for line in block]
+
+
+SYNTHETIC_CORPUS = (
+    ('lockfile', lockfile),
+    ('generated_code', generated_code),
+    ('sql_dump', sql_dump),
+    ('source_code', source_code),
+)
+"""Files generated when no file pairs are given, in the original and the changed version."""
+
+
+def check_opcodes(old_lines, new_lines, opcodes):
+    """Check that the opcodes transform the old lines into the new ones.
+
+    :return: `int` number of the changed lines.
+    """
+    result = []
+    changed = 0
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag == 'equal':
+            if old_lines[i1:i2] != new_lines[j1:j2]:
+                raise CommandError('Lines {0}:{1} are not equal to {2}:{3}'.format(i1, i2, j1, j2))
+        else:
+            changed += (i2 - i1) + (j2 - j1)
+        result.extend(new_lines[j1:j2])
+    if result != new_lines:
+        raise CommandError('The opcodes do not produce the new lines.')
+    return changed
+
+
+class Command(BaseCommand):
+    args = '[old_file:new_file ...]'
+    help = ('compares the line diff algorithms with difflib on the given pairs of files, or on a synthetic corpus '
+            'of lock files, generated code, SQL dumps and source code')
+    option_list = BaseCommand.option_list + (
+        make_option('--algorithms', dest='algorithms', default=','.join(sorted(linediff.ALGORITHMS)),
+                    help='comma separated algorithms to compare'),
+        make_option('--repeat', type='int', dest='repeat', default=3,
+                    help='number of times every diff is made, the fastest one is reported'),
+        make_option('--timeout', type='float', dest='timeout', default=None,
+                    help='number of seconds after which the diff is not refined anymore'),
+    )
+
+    def handle(self, *args, **options):
+        algorithms = options['algorithms'].split(',')
+        for algorithm in algorithms:
+            if algorithm not in linediff.ALGORITHMS:
+                raise CommandError('Unknown algorithm: {0}'.format(algorithm))
+
+        corpus = []
+        for arg in args:
+            if ':' not in arg:
+                raise CommandError('Expected old_file:new_file, got: {0}'.format(arg))
+            old_path, new_path = arg.split(':', 1)
+            with open(old_path) as old_file, open(new_path) as new_file:
+                corpus.append((arg, old_file.readlines(), new_file.readlines()))
+        if not corpus:
+            corpus = [(name, generate(None), generate(1)) for name, generate in SYNTHETIC_CORPUS]
+
+        self.stdout.write('{0:<30}{1:>10}{2:>12}{3:>12}{4:>12}\n'.format(
+            'file, algorithm', 'lines', 'ms', 'changed', 'vs difflib'))
+        for name, old_lines, new_lines in corpus:
+            self.stdout.write('{0}\n'.format(name))
+            reference = None
+            for algorithm in ['difflib'] + [algorithm for algorithm in algorithms if algorithm != 'difflib']:
+                timings = []
+                for _ in range(options['repeat']):
+                    start = time.time()
+                    opcodes = linediff.GetOpcodes(old_lines, new_lines, algorithm, options['timeout'])
+                    timings.append(time.time() - start)
+                changed = check_opcodes(old_lines, new_lines, opcodes)
+                if reference is None:
+                    reference = opcodes
+                if algorithm not in algorithms:
+                    continue
+                self.stdout.write('  {0:<28}{1:>10}{2:>12.1f}{3:>12}{4:>12}\n'.format(
+                    algorithm, len(old_lines), min(timings) * 1000, changed,
+                    'same' if opcodes == reference else 'different'))
@@ -0,0 +1,40 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import IntegrityError, transaction
+
+from codereview import models
+
+from paylogic.views import BINARY_FILES_PATH
+
+
+class Command(BaseCommand):
+    help = 'deletes the contents and the binary files which are not used by any patch anymore'
+
+    def handle(self, *args, **options):
+        # contents are shared by checksum, a content found by a running job can be unused for a moment
+        if models.Issue.objects.filter(processing=True).exists():
+            raise CommandError('Some issues are being processed, try again later.')
+
+        used = set(models.Patch.objects.values_list('content', flat=True))
+        used.update(models.Patch.objects.values_list('patched_content', flat=True))
+        unused = [
+            content_id for content_id in models.Content.objects.values_list('id', flat=True)
+            if content_id not in used]
+        # the contents used again since they were listed are kept, the deletion checks that they are unused
+        deleted = 0
+        for start in range(0, len(unused), 500):
+            try:
+                deleted += models.delete_unused_contents(unused[start:start + 500])
+            except IntegrityError:
+                # a patch just started to use one of the contents
+                transaction.rollback_unless_managed()
+        self.stdout.write('Deleted {0} unused contents\n'.format(deleted))
+
+        if os.path.isdir(BINARY_FILES_PATH):
+            used_files = set(
+                models.Content.objects.filter(checksum__startswith='binary:').values_list('data', flat=True))
+            unused_files = [name for name in os.listdir(BINARY_FILES_PATH) if name not in used_files]
+            for name in unused_files:
+                os.remove(os.path.join(BINARY_FILES_PATH, name))
+            self.stdout.write('Deleted {0} unused binary files\n'.format(len(unused_files)))
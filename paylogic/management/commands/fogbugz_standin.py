@@ -0,0 +1,32 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from paylogic.fogbugz_standin import FogBugzStandIn
+
+
+class Command(BaseCommand):
+    args = '[<case id>,<original branch>,<feature branch>[,<ci project>] ...]'
+    help = 'runs the local stand-in of the FogBugz API serving the given cases'
+    option_list = BaseCommand.option_list + (
+        make_option('--host', dest='host', default='127.0.0.1', help='address to listen on'),
+        make_option('--port', type='int', dest='port', default=8001, help='port to listen on'),
+        make_option('--latency', type='float', dest='latency', default=0,
+                    help='number of seconds to wait before every response'),
+    )
+
+    def handle(self, *args, **options):
+        standin = FogBugzStandIn(options['host'], options['port'], options['latency'])
+        for arg in args:
+            parts = arg.split(',')
+            if len(parts) not in (3, 4):
+                raise CommandError('Invalid case: {0}'.format(arg))
+            case_id, original_branch, feature_branch = parts[:3]
+            standin.add_case(
+                case_id, 'Case {0}'.format(case_id), original_branch, feature_branch,
+                parts[3] if len(parts) == 4 else '', '')
+        self.stdout.write('Serving the FogBugz API stand-in at {0}\n'.format(standin.url))
+        try:
+            standin.serve_forever()
+        except KeyboardInterrupt:
+            standin.stop()
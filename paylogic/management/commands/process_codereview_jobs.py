@@ -0,0 +1,47 @@
+import multiprocessing
+import signal
+from optparse import make_option
+
+from django import db as django_db
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from paylogic import jobs
+
+
+def run_worker(stop):
+    """Run a worker process, which finishes its current job when the pool is interrupted."""
+    # Ctrl-C is sent to the whole process group, the pool tells the workers to stop instead
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    jobs.run_worker(stop=stop)
+
+
+class Command(BaseCommand):
+    help = 'runs a pool of workers processing the queued codereview jobs'
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', type='int', dest='workers', default=None,
+                    help='number of worker processes, CODEREVIEW_PROCESSING_WORKERS setting by default'),
+        make_option('--once', action='store_true', dest='once', default=False,
+                    help='process the queued jobs in this process and exit'),
+    )
+
+    def handle(self, *args, **options):
+        if options['once']:
+            jobs.run_worker(once=True)
+            return
+        # each worker needs its own database connection
+        django_db.connection.close()
+        stop = multiprocessing.Event()
+        workers = [
+            multiprocessing.Process(target=run_worker, args=(stop,))
+            for _ in range(options['workers'] or settings.CODEREVIEW_PROCESSING_WORKERS)]
+        for worker in workers:
+            worker.start()
+        try:
+            for worker in workers:
+                worker.join()
+        except KeyboardInterrupt:
+            self.stdout.write('Waiting for the workers to finish their current jobs\n')
+            stop.set()
+            for worker in workers:
+                worker.join()
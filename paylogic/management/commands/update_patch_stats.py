@@ -0,0 +1,32 @@
+import itertools
+
+from django.core.management.base import BaseCommand
+
+from codereview import models, views
+
+
+class Command(BaseCommand):
+    help = ('stores the statistics and the deltas of the patches and the manifests of the patch sets created before '
+            'they were computed when a patch set is created')
+
+    def handle(self, *args, **options):
+        count = 0
+        for patch in models.Patch.objects.filter(added_count=None).iterator():
+            patch.update_stats()
+            patch.put()
+            count += 1
+        self.stdout.write('Updated {0} patches\n'.format(count))
+        count = 0
+        for patchset in models.PatchSet.objects.filter(manifest=None).defer('data').iterator():
+            patchset.store_manifest()
+            count += 1
+        self.stdout.write('Updated {0} patch sets\n'.format(count))
+        count = 0
+        patches = models.Patch.objects.filter(delta_calculated=False).order_by('patchset').iterator()
+        for _, patchset_patches in itertools.groupby(patches, key=lambda patch: patch.patchset_id):
+            patchset_patches = list(patchset_patches)
+            views._calculate_deltas(patchset_patches[0].patchset, patchset_patches)
+            for patch in patchset_patches:
+                patch.put()
+            count += len(patchset_patches)
+        self.stdout.write('Calculated the delta of {0} patches\n'.format(count))
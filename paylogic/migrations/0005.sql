@@ -0,0 +1,8 @@
+DELIMITER ;;
+DROP PROCEDURE IF EXISTS migrate;;
+CREATE PROCEDURE migrate ()
+BEGIN
+    DECLARE CONTINUE HANDLER FOR 1061 BEGIN END;
+    ALTER TABLE codereview_content ADD INDEX codereview_content_checksum (checksum(48));
+END;;
+CALL migrate();;
@@ -0,0 +1,11 @@
+DELIMITER ;;
+DROP PROCEDURE IF EXISTS migrate;;
+CREATE PROCEDURE migrate ()
+BEGIN
+    DECLARE CONTINUE HANDLER FOR 1060 BEGIN END;
+    ALTER TABLE codereview_patch ADD COLUMN added_count INTEGER;
+    ALTER TABLE codereview_patch ADD COLUMN removed_count INTEGER;
+    ALTER TABLE codereview_patch ADD COLUMN chunk_count INTEGER;
+    ALTER TABLE codereview_patch ADD COLUMN text_checksum VARCHAR (500);
+END;;
+CALL migrate();;
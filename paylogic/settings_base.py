@@ -173,6 +173,22 @@ ORIGINAL_BRANCH_DEFAULT_PREFIX = 'hg+/var/hg/codereview/example.com#'
 
 TEMP_FOLDER = '/var/tmp/codereview/'
 
+MIRROR_FOLDER = '/var/tmp/codereview/mirrors/'
+
+VCS_REVISION_CACHE_TIMEOUT = 60 * 60 * 24 * 30
+
+VCS_BRANCH_CACHE_TIMEOUT = 60
+
+LOOKUP_CACHE_TIMEOUT = 60
+
+LOOKUP_CACHE_STALE_TIMEOUT = 60 * 10
+
+FOGBUGZ_PEOPLE_CACHE_TIMEOUT = 60 * 60
+
+FOGBUGZ_POOL_SIZE = 4
+
+FOGBUGZ_CACHE_TIMEOUT = 10
+
 AUTH_FOGBUGZ_SERVER = FOGBUGZ_URL = 'https://fogbugz.example.com'
 FOGBUGZ_TOKEN = 'fogbugz-token'
 
@@ -203,6 +219,26 @@ CODEREVIEW_MAX_FILE_SIZE = 1024 * 1024
 CODEREVIEW_VALIDATORS = [
 ]
 
+CODEREVIEW_PROCESSING_ASYNC = True
+
+CODEREVIEW_PROCESSING_WORKERS = 2
+
+CODEREVIEW_PROCESSING_POLL_INTERVAL = 1
+
+CODEREVIEW_PROCESSING_LEASE_TIMEOUT = 10 * 60
+
+CODEREVIEW_PROCESSING_MAX_ATTEMPTS = 3
+
+CODEREVIEW_DIFF_ALGORITHM = 'histogram'
+
+CODEREVIEW_DIFF_TIMEOUT = 5
+
+FOGBUGZ_OUTBOX_ASYNC = True
+
+FOGBUGZ_OUTBOX_MAX_ATTEMPTS = 10
+
+FOGBUGZ_OUTBOX_RETRY_DELAY = 5
+
 
 def CODEREVIEW_TARGET_BRANCH_CHOICES_GETTER(ci_project, original_branch, branches):
     return []
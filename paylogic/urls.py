@@ -26,6 +26,8 @@ urlpatterns = patterns(
     url(r'^(\d+)/publish$', 'paylogic.views.publish'),
     url(r'^fogbugz$', 'paylogic.views.process_codereview_from_fogbugz',
         name='process_from_fogbugz'),
+    url(r'^(\d+)/processing_status$', 'paylogic.views.processing_status',
+        name='processing_status'),
     url(r'^fogbugz_find$', 'paylogic.views.find_codereview_from_fogbugz',
         name='find_from_fogbugz'),
     url(r'^mergekeeper_close/(?P<case_id>\d+)/$',
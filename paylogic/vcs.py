@@ -42,14 +42,21 @@ import optparse
 import os
 import re
 import socket
+import struct
 import subprocess32 as subprocess
 import sys
+import tempfile
+import threading
 import urllib
 import urllib2
 import urlparse
+import uuid
 
 from hashlib import md5
 
+from django.conf import settings
+from django.core.cache import cache
+
 # The logging verbosity:
 #  0: Errors only.
 #  1: Status messages.
@@ -631,6 +638,242 @@ def RunShell(command, silent_ok=False, universal_newlines=True,
     return data
 
 
+def StreamShell(command, env=os.environ, cwd=None, check_returncode=True):
+    """Executes a command and yields the lines of its output without line endings.
+
+    The output is never loaded as a whole, so it's suitable for the large outputs like diffs.
+    Unlike RunShell, stderr is never mixed into the output.
+    """
+    logging.debug("Running %s", command)
+    errout = tempfile.TemporaryFile()
+    p = subprocess.Popen(
+        command, stdout=subprocess.PIPE, stderr=errout,
+        shell=use_shell, universal_newlines=True, env=env, cwd=cwd)
+    try:
+        for line in p.stdout:
+            yield line.rstrip('\n')
+    finally:
+        p.stdout.close()
+        p.wait()
+    if p.returncode and check_returncode:
+        errout.seek(0)
+        ErrorExit("Got error status from %r:\n%s (%s)" %
+                  (' '.join(command), errout.read(), p.returncode))
+
+
+class ContentReader(object):
+
+    """Long-lived process reading file contents of a repository.
+
+    Readers are pooled per repository (see GetPooledContentReader), so the process
+    is started once and reused for all files and requests. Requests to the same
+    reader are serialized. When a request fails the process is killed, as the
+    rest of its response can't be told from the next one, and the pool starts a
+    new one.
+    """
+
+    def __init__(self, repo_dir):
+        self.repo_dir = repo_dir
+        self.lock = threading.Lock()
+        self.process = self.Start()
+
+    def Start(self):
+        """Start the reader process."""
+        raise NotImplementedError()
+
+    def IsAlive(self):
+        """Check if the reader process is still running."""
+        return self.process.poll() is None
+
+    def Close(self):
+        """Stop the reader process, waiting for the request being read."""
+        with self.lock:
+            if self.IsAlive():
+                self.process.stdin.close()
+                self.process.wait()
+
+    def Kill(self):
+        """Kill the reader process, called with the lock held when a request fails."""
+        if self.IsAlive():
+            self.process.kill()
+        self.process.wait()
+
+    def Get(self, path, revision):
+        """Get the content of the file in the given revision, None if it doesn't exist there."""
+        raise NotImplementedError()
+
+    def GetMany(self, paths, revision):
+        """Get the contents of the files in the given revision.
+
+        Returns:
+          A dictionary that maps from path to its content, None for the paths
+          which don't exist in the revision.
+        """
+        return dict((path, self.Get(path, revision)) for path in paths)
+
+
+class GitContentReader(ContentReader):
+
+    """Content reader on top of `git cat-file --batch`."""
+
+    def Start(self):
+        return subprocess.Popen(
+            ['git', 'cat-file', '--batch'], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            cwd=self.repo_dir)
+
+    def ReadObject(self, object_name):
+        """Get the content of the blob identified by the object name, None if there is no such blob."""
+        with self.lock:
+            try:
+                self.process.stdin.write(object_name + '\n')
+                self.process.stdin.flush()
+                header = self.process.stdout.readline()
+                if not header:
+                    raise RuntimeError('%s: git cat-file exited unexpectedly' % self.repo_dir)
+                # either "<sha> <type> <size>" or "<object> missing"
+                parts = header.split()
+                if len(parts) != 3 or parts[2] == 'missing':
+                    return None
+                data = self.process.stdout.read(int(parts[2]))
+                self.process.stdout.read(1)
+            except Exception:
+                self.Kill()
+                raise
+        if parts[1] != 'blob':
+            return None
+        return data
+
+    def Get(self, path, revision):
+        return self.ReadObject('%s:%s' % (revision, path))
+
+
+class MercurialContentReader(ContentReader):
+
+    """Content reader on top of the Mercurial command server (`hg serve --cmdserver pipe`)."""
+
+    def Start(self):
+        env = os.environ.copy()
+        env['HGPLAIN'] = '1'
+        process = subprocess.Popen(
+            ['hg', 'serve', '--cmdserver', 'pipe', '-R', self.repo_dir, '--config', 'ui.interactive=False'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env)
+        self.process = process
+        # skip the hello message announcing the server capabilities
+        self._ReadChannel()
+        return process
+
+    def _ReadChannel(self):
+        header = self.process.stdout.read(5)
+        if len(header) < 5:
+            raise RuntimeError('%s: hg command server exited unexpectedly' % self.repo_dir)
+        channel, length = struct.unpack('>cI', header)
+        if channel in 'IL':
+            # input requests carry the requested size, not the data
+            return channel, length
+        return channel, self.process.stdout.read(length)
+
+    def RunCommand(self, args):
+        """Run hg command in the command server.
+
+        Returns:
+          Tuple (output, return code)
+        """
+        data = '\0'.join(args)
+        output = []
+        with self.lock:
+            try:
+                self.process.stdin.write('runcommand\n' + struct.pack('>I', len(data)) + data)
+                self.process.stdin.flush()
+                while True:
+                    channel, data = self._ReadChannel()
+                    if channel == 'o':
+                        output.append(data)
+                    elif channel == 'r':
+                        return ''.join(output), struct.unpack('>i', data)[0]
+                    elif channel.isupper():
+                        # required channels (input requests) can not be served
+                        raise RuntimeError(
+                            '%s: unexpected hg command server channel %r' % (self.repo_dir, channel))
+            except Exception:
+                self.Kill()
+                raise
+
+    def Get(self, path, revision):
+        content, returncode = self.RunCommand(['cat', '-r', revision, 'path:' + path])
+        if returncode:
+            return None
+        return content
+
+
+content_readers = {}
+content_readers_lock = threading.Lock()
+
+
+def GetPooledContentReader(reader_class, repo_dir):
+    """Get the content reader of the repository, starting it if there is no running one."""
+    key = (reader_class, repo_dir)
+    with content_readers_lock:
+        reader = content_readers.get(key)
+        if reader is None or not reader.IsAlive():
+            reader = content_readers[key] = reader_class(repo_dir)
+    return reader
+
+
+def ClosePooledContentReader(reader_class, repo_dir):
+    """Stop the content reader of the repository, if there is one."""
+    with content_readers_lock:
+        reader = content_readers.pop((reader_class, repo_dir), None)
+    if reader is not None:
+        reader.Close()
+
+
+# Only the full hashes are immutable, a short one can as well be a branch name.
+REVISION_HASH_RE = re.compile(r"^[0-9a-f]{40}$")
+
+
+def GetRevisionCacheGenerationKey(repo_dir):
+    """Get the cache key of the repository generation, changed every time the repository is pulled."""
+    return 'vcs:generation:' + md5(repo_dir).hexdigest()
+
+
+def InvalidateRevisionCache(repo_dir):
+    """Invalidate the cached branch name resolutions of the repository, after it was pulled."""
+    cache.set(GetRevisionCacheGenerationKey(repo_dir), uuid.uuid4().hex, settings.VCS_REVISION_CACHE_TIMEOUT)
+
+
+def CachedRevision(func):
+    """Decorator caching the result of revision resolving method in the Django cache.
+
+    The cache is shared between the processes. Results for the full revision hashes are cached for
+    VCS_REVISION_CACHE_TIMEOUT, for the branch names - for VCS_BRANCH_CACHE_TIMEOUT or until the repository
+    is pulled.
+    """
+    def CachedRevisionWrapper(self, revision=None):
+        base_rev = getattr(self, 'base_rev', None) or ''
+        parts = [self.repo_dir, func.__name__, base_rev, revision or base_rev]
+        is_hash = all(REVISION_HASH_RE.match(part) for part in parts[2:])
+        if not is_hash:
+            parts.append(cache.get(GetRevisionCacheGenerationKey(self.repo_dir)) or '')
+        key = 'vcs:revision:' + md5(':'.join(parts)).hexdigest()
+        result = cache.get(key)
+        if result is None:
+            result = func(self, revision)
+            cache.set(
+                key, result,
+                settings.VCS_REVISION_CACHE_TIMEOUT if is_hash else settings.VCS_BRANCH_CACHE_TIMEOUT)
+        return result
+
+    CachedRevisionWrapper.__name__ = func.__name__
+    CachedRevisionWrapper.__doc__ = func.__doc__
+    return CachedRevisionWrapper
+
+
+DIFF_GIT_RE = re.compile(r"diff --git a?/(.*) b/(.*)$")
+OLD_CONTEXT_RE = re.compile(r"--- a?/(.*)$")
+NEW_CONTEXT_RE = re.compile(r"\+\+\+ b?/(.*)$")
+INDEX_RE = re.compile(r"index (\w+)\.\.(\w+)")
+
+
 class VersionControlSystem(object):
 
     """Abstract base class providing an interface to the VCS."""
@@ -793,15 +1036,41 @@ class VersionControlSystem(object):
             return False
         return not mimetype.startswith("text/")
 
-    def Export(self, revision, path):
-        """Export repository to given directory."""
+    def Export(self, revision, path, paths=None):
+        """Export repository to given directory.
+
+        If paths are given, only those of them which exist in the revision are exported.
+        """
         path = os.path.normpath(path) + os.sep
         os.makedirs(path)
 
+    def GetContentReader(self):
+        """Get pooled content reader of the repository."""
+        raise NotImplementedError()
+
+    def ExportFiles(self, revision, path, paths):
+        """Write the files existing in the revision to the given directory using the content reader."""
+        for filename, content in self.GetContentReader().GetMany(paths, revision).items():
+            if content is None:
+                continue
+            file_path = os.path.join(path, filename)
+            if not os.path.exists(os.path.dirname(file_path)):
+                os.makedirs(os.path.dirname(file_path))
+            with open(file_path, 'wb') as fd:
+                fd.write(content)
+
     def GetBranches(self):
         """Get repository branches."""
         raise NotImplementedError()
 
+    def Mirror(self, dest):
+        """Create a bare mirror of the repository in the given directory."""
+        raise NotImplementedError()
+
+    def UpdateMirror(self):
+        """Incrementally update the mirror from the repository it was created from."""
+        raise NotImplementedError()
+
     def GetCommonAncestor(self, revision):
         """Get common ancestor of base revision and given revision."""
         raise NotImplementedError()
@@ -814,7 +1083,10 @@ class VersionControlSystem(object):
         return True
 
     def FormatDiff(self, gitdiff, source_path=None, files_to_skip=[]):
-        """Format given git diff to svn format."""
+        """Format given git diff to svn format.
+
+        The diff can be given as a string or as an iterable of lines without line endings.
+        """
         NULL_HASH = "0" * 40
 
         def IsFileNew(filename):
@@ -837,11 +1109,14 @@ class VersionControlSystem(object):
         filecount = 0
         filename = None
         skip_until_next_file_name = False
-        for line in gitdiff.splitlines():
-            match = re.match(r"diff --git a?/(.*) b/(.*)$", line)
-            old_context_match = re.match(r"--- a?/(.*)$", line)
-            new_context_match = re.match(r"\+\+\+ b?/(.*)$", line)
-            rename_match = re.match(r"rename from (.*)$", line)
+        if isinstance(gitdiff, basestring):
+            gitdiff = gitdiff.splitlines()
+        for line in gitdiff:
+            # most of the lines are hunk lines, check the prefixes before matching the patterns
+            match = line.startswith('diff --git ') and DIFF_GIT_RE.match(line)
+            old_context_match = line.startswith('--- ') and OLD_CONTEXT_RE.match(line)
+            new_context_match = line.startswith('+++ ') and NEW_CONTEXT_RE.match(line)
+            rename_match = line.startswith('rename from ')
             if match:
                 skip_until_next_file_name = False
                 # Add auto property here for previously seen file.
@@ -881,7 +1156,7 @@ class VersionControlSystem(object):
                 #   index 82c0d44..b2cee3f 100755
                 # We want to save the left hash, as that identifies the base
                 # file.
-                match = re.match(r"index (\w+)\.\.(\w+)", line)
+                match = line.startswith('index ') and INDEX_RE.match(line)
                 if match:
                     before, after = (match.group(1), match.group(2))
                     if before == NULL_HASH:
@@ -1198,7 +1473,7 @@ class GitVCS(VersionControlSystem):
             del env['GIT_EXTERNAL_DIFF']
         if source_path is not None:
             extra_args = ['--no-index', '.', source_path]
-        gitdiff = RunShell(
+        gitdiff = StreamShell(
             ['git', 'diff', '--no-ext-diff', '--full-index', '-M'] +
             extra_args,
             env=env, cwd=self.repo_dir, check_returncode=check_returncode)
@@ -1212,10 +1487,9 @@ class GitVCS(VersionControlSystem):
 
     def GetFileContent(self, file_hash, is_binary):
         """Returns the content of a file identified by its git hash."""
-        data, retcode = RunShellWithReturnCode(["git", "show", file_hash],
-                                               universal_newlines=not is_binary)
-        if retcode:
-            ErrorExit("Got error status from 'git show %s'" % file_hash)
+        data = self.GetContentReader().ReadObject(file_hash)
+        if data is None:
+            ErrorExit("Got error status from 'git cat-file %s'" % file_hash)
         return data
 
     def GetBaseFile(self, filename):
@@ -1267,6 +1541,24 @@ class GitVCS(VersionControlSystem):
             cwd=self.repo_dir,
             silent_ok=True)
 
+    def Mirror(self, dest):
+        RunShell([
+            'git', 'clone', '--mirror', self.repo_dir, dest],
+            silent_ok=True)
+        return GitVCS(self.options, dest)
+
+    def UpdateMirror(self):
+        RunShell([
+            'git', 'fetch', '--prune', 'origin'],
+            cwd=self.repo_dir,
+            silent_ok=True)
+        ClosePooledContentReader(GitContentReader, self.repo_dir)
+        InvalidateRevisionCache(self.repo_dir)
+
+    def GetContentReader(self):
+        return GetPooledContentReader(GitContentReader, self.repo_dir)
+
+    @CachedRevision
     def CheckRevision(self, revision=None):
         revision = revision or self.base_rev
         try:
@@ -1286,9 +1578,13 @@ class GitVCS(VersionControlSystem):
         RunShell(['git', 'remote', 'add', 'source', source.repo_dir],
                  cwd=self.repo_dir, silent_ok=True)
         RunShell(['git', 'fetch', 'source'], cwd=self.repo_dir)
+        InvalidateRevisionCache(self.repo_dir)
 
-    def Export(self, revision, path):
+    def Export(self, revision, path, paths=None):
         super(GitVCS, self).Export(revision, path)
+        if paths is not None:
+            self.ExportFiles(revision, path, paths)
+            return
         RunShell(
             ['sh', '-c', 'git archive --format=tar {revision} | (cd {path} && tar xf -)'.format(
                 path=os.path.normpath(path), revision=revision)],
@@ -1301,6 +1597,7 @@ class GitVCS(VersionControlSystem):
             silent_ok=False, ignore_stderr=True)
         return out.split()
 
+    @CachedRevision
     def GetCommonAncestor(self, revision):
         try:
             out = RunShell(
@@ -1341,12 +1638,28 @@ class MercurialVCS(VersionControlSystem):
         # target.Pull(self, '-B', 'master')
         return target
 
+    def Mirror(self, dest):
+        RunShell([
+            'hg', 'clone', '-U',
+            self.repo_dir, dest],
+            silent_ok=True)
+        return MercurialVCS(self.options, dest)
+
+    def UpdateMirror(self):
+        RunShell([
+            'hg', '-R', self.repo_dir, 'pull'],
+            silent_ok=True)
+        ClosePooledContentReader(MercurialContentReader, self.repo_dir)
+        InvalidateRevisionCache(self.repo_dir)
+
     def Pull(self, target, *args):
         args = list(args) or ['-r', target.base_rev]
         RunShell(['hg', '-R', self.repo_dir,
                   'pull', target.repo_dir] +
                  args)
+        InvalidateRevisionCache(self.repo_dir)
 
+    @CachedRevision
     def CheckRevision(self, revision=None):
         revision = revision or self.base_rev
         out = RunShell([
@@ -1361,7 +1674,7 @@ class MercurialVCS(VersionControlSystem):
         # If no file specified, restrict to the current subdir
         cmd = [
             "hg", "-R", self.repo_dir, "diff", "--git", "-r", target_revision or self.base_rev, "-r", source_revision]
-        gitdiff = RunShell(cmd, silent_ok=True)
+        gitdiff = StreamShell(cmd)
         return self.FormatDiff(gitdiff, source_path, files_to_skip)
 
     def GetUnknownFiles(self):
@@ -1421,22 +1734,20 @@ class MercurialVCS(VersionControlSystem):
     def GetBaseFile2(self, filename):
         if filename.startswith(self.repo_dir.rstrip('/') + '/'):
             filename = filename[len(self.repo_dir.rstrip('/') + '/'):]
-        try:
-            content = RunShell(['hg', '-R', self.repo_dir,
-                                'cat', '-r', self.base_rev, filename],
-                               silent_ok=True, check_returncode=False, cwd=self.repo_dir)
-        except:
-            content = ''
-        if ': no such file in rev ' in content and content.count('\n') < 2:
-            content = ''
-        return content
+        return self.GetContentReader().Get(filename, self.base_rev) or ''
 
-    def Export(self, revision, path):
+    def Export(self, revision, path, paths=None):
         super(MercurialVCS, self).Export(revision, path)
+        if paths is not None:
+            self.ExportFiles(revision, path, paths)
+            return
         RunShell(['hg',
                   'archive', '-r', revision, path],
                  silent_ok=True, check_returncode=True, cwd=self.repo_dir)
 
+    def GetContentReader(self):
+        return GetPooledContentReader(MercurialContentReader, self.repo_dir)
+
     def Checkout(self):
         RunShell([
             'hg', 'update', self.base_rev],
@@ -1450,6 +1761,7 @@ class MercurialVCS(VersionControlSystem):
             silent_ok=False, ignore_stderr=True)
         return out.split()
 
+    @CachedRevision
     def GetCommonAncestor(self, revision):
         out = RunShell([
             'hg', 'debugancestor', revision, self.base_rev],
@@ -1471,9 +1783,9 @@ class BazaarVCS(VersionControlSystem):
 
         # We need check_returncode = False because bzr diff returns 1 if changes
         # are found.
-        gitdiff = RunShell([
+        gitdiff = StreamShell([
             "bzr", "diff", "-F", "git",
-            "-c", target_revision or self.base_rev, "-c", source_revision], silent_ok=True,
+            "-c", target_revision or self.base_rev, "-c", source_revision],
             check_returncode=False, cwd=self.get_cwd())
         return self.FormatDiff(gitdiff, source_path, files_to_skip)
 
@@ -1532,6 +1844,7 @@ class BazaarVCS(VersionControlSystem):
             cwd = self.repo_dir
         return cwd
 
+    @CachedRevision
     def CheckRevision(self, revision=None):
         out = RunShell(
             ['bzr', 'version-info'] + (['-r', revision] if revision else []), cwd=self.get_cwd(),
@@ -1540,7 +1853,8 @@ class BazaarVCS(VersionControlSystem):
             raise RuntimeError('%s: revision %s is not found' % (self.repo_dir, self.base_rev))
         return out.split('revision-id: ')[1].split()[0]
 
-    def Export(self, revision, path):
+    def Export(self, revision, path, paths=None):
+        # bzr export can only export a single subdirectory, so the whole tree is exported
         super(BazaarVCS, self).Export(revision, path)
         RunShell(['bzr', 'export', '-r', revision, os.path.normpath(path) + os.sep],
                  silent_ok=True, check_returncode=True, cwd=self.get_cwd())
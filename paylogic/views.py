@@ -1,15 +1,24 @@
 """Paylogic codereview custom views."""
+import contextlib
+import datetime
+import fcntl
+import json
 import os
 import re
 import shutil
+import socket
+import threading
+import time
 import uuid
 
-import fogbugz
+from hashlib import md5, sha1
+from multiprocessing.pool import ThreadPool
 
 from django import db as django_db
 from django.conf import settings
 from django.contrib.auth.decorators import permission_required, user_passes_test
 from django.contrib.messages import api as messages_api
+from django.core.cache import cache
 from django.core.exceptions import PermissionDenied
 from django.core.urlresolvers import reverse
 from django.http import HttpResponseServerError, HttpResponseRedirect, HttpResponse
@@ -18,9 +27,9 @@ from google.appengine.api import users
 from google.appengine.ext import db
 
 from codereview import models, views
-from codereview.engine import ParsePatchSet
+from codereview.engine import IterSplitPatch, ParsePatchSet
 
-from paylogic import measurements
+from paylogic import fogbugz_client, measurements
 from paylogic.vcs import GuessVCS, GitVCS
 from paylogic.forms import GatekeeperApprove, PublishForm
 
@@ -136,7 +145,122 @@ def parse_branch_vcs_info(branch, default_prefix):
     raise ValueError('Invalid branch format: {0}'.format(branch))
 
 
-def get_complete_diff(target, target_revision, source, source_revision, is_related):
+BLOB_HASHES_RE = re.compile(r'^index \w{40}\.\.\w{40}', re.MULTILINE)
+"""Full blob hashes line of the git style diff, identifying both original and patched file versions."""
+
+
+def get_unchanged_patches(patches, previous_patchset):
+    """Get the patches of the previous patch set which did not change in the new one.
+
+    Patch text carrying full blob hashes identifies both the original and the patched file, so the contents of
+    the previous patch with the same text can be shared instead of exporting and storing the files again.
+    Diffs without the hashes (mercurial or bazaar diffs of related repositories) are never considered unchanged.
+    Neither are the patches whose contents were dropped or marked bad since, their files are exported again.
+
+    :param patches: `list` of (filename, old_filename, text_checksum, has_blob_hashes) `tuple` of the new patch
+        set, see `get_patch_signature`
+    :param previous_patchset: `PatchSet` object created before the new one, or `None`
+
+    :return: `dict` in form {filename: previous `Patch` object}.
+    """
+    if previous_patchset is None:
+        return {}
+    previous_patches = dict(
+        (patch.filename, patch)
+        for patch in previous_patchset.patch_set.all().select_related('content', 'patched_content'))
+    unchanged = {}
+    for filename, old_filename, text_checksum, has_blob_hashes in patches:
+        previous = previous_patches.get(filename)
+        if previous is None or not has_blob_hashes:
+            continue
+        if previous.text_checksum is None:
+            previous.update_stats()
+        if (previous.text_checksum == text_checksum and previous.old_filename == old_filename and
+                has_usable_contents(previous)):
+            unchanged[filename] = previous
+    return unchanged
+
+
+def get_patch_signature(filename, old_filename, text):
+    """Get the signature of the patch text compared by `get_unchanged_patches`.
+
+    :param filename: `str` file name of the patch
+    :param old_filename: `str` old file name of the renamed file, or `None`
+    :param text: `unicode` patch text, or `str` utf-8 encoded one
+
+    :return: `tuple` in form (filename, old_filename, text_checksum, has_blob_hashes).
+    """
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    return filename, old_filename, sha1(text).hexdigest(), bool(BLOB_HASHES_RE.search(text))
+
+
+def has_usable_contents(patch):
+    """Check that both the original and the patched contents of the patch are stored and not bad.
+
+    :param patch: `Patch` object
+
+    :return: `bool` True if the contents can be shared with another patch.
+    """
+    for content in patch.content, patch.patched_content:
+        if content is None or content.is_bad or content.text is None:
+            return False
+    return True
+
+
+def get_diff_unchanged_patches(diff, previous_patchset):
+    """Get the signatures of the patches of the given diff and the ones unchanged since the previous patch set.
+
+    :param diff: `str` diff in svn format
+    :param previous_patchset: `PatchSet` object created before the new one, or `None`
+
+    :return: `tuple` in form (`list` of signatures, see `get_patch_signature`, `dict` as returned by
+        `get_unchanged_patches`).
+    """
+    # only the signatures are kept, not the pieces of the diff
+    signatures = [
+        get_patch_signature(filename, old_filename, text)
+        for filename, old_filename, text, _ in IterSplitPatch(diff)]
+    return signatures, get_unchanged_patches(signatures, previous_patchset)
+
+
+def get_diff_paths(signatures, unchanged):
+    """Get the paths of the files touched by the diff, except the unchanged ones.
+
+    :param signatures: `list` of the signatures of the patches of the diff, see `get_patch_signature`
+    :param unchanged: `dict` of the unchanged patches as returned by `get_unchanged_patches`
+
+    :return: `set` of both old and new file names of the changed files.
+    """
+    paths = set()
+    for filename, old_filename, _, _ in signatures:
+        if filename in unchanged:
+            continue
+        paths.add(filename)
+        if old_filename:
+            paths.add(old_filename)
+    return paths
+
+
+def run_concurrently(*calls):
+    """Run independent calls concurrently, each in its own thread.
+
+    All calls are finished before returning or raising, so the caller can safely clean up after them.
+
+    :param calls: `tuple` of callables without arguments
+
+    :return: `list` of call results in the order of the calls.
+    """
+    pool = ThreadPool(len(calls))
+    try:
+        results = [pool.apply_async(call) for call in calls]
+        return [result.get() for result in results]
+    finally:
+        pool.close()
+        pool.join()
+
+
+def get_complete_diff(target, target_revision, source, source_revision, is_related, previous_patchset=None):
     """Get the complete diff string given 2 repositories and revisions.
 
     :param target: `VersionControlSystem` object of the target repo
@@ -144,30 +268,40 @@ def get_complete_diff(target, target_revision, source, source_revision, is_relat
     :param source: `VersionControlSystem` object of the source repo
     :param source_revision: `str` revision of the target repo to compare
     :param is_related: `bool` if repositories are related between each other (cloned)
+    :param previous_patchset: `PatchSet` object, the files unchanged since it are not exported
 
-    :return: `tuple` in form ('diff string', 'target export path', 'source export path')
+    :return: `tuple` in form ('diff string', 'target export path', 'source export path', unchanged patches)
+        where unchanged patches are as returned by `get_unchanged_patches`, their files are not exported.
     """
     target_export_path = source_export_path = None
     try:
         target_export_path = os.path.join(
             settings.TEMP_FOLDER, uuid.uuid4().hex)
-        log("Exporting target copy to {0}".format(target_export_path))
-        target.Export(target_revision, target_export_path)
-        log("Exported target copy")
-
         source_export_path = os.path.join(
             settings.TEMP_FOLDER, uuid.uuid4().hex)
-        log("Exporting source to {0}".format(source_export_path))
-        source.Export(source_revision, source_export_path)
-        log("Exported source")
         log("Generating diff with target_revision={target_revision}, source_revision={source_revision}".format(
             target_revision=target_revision, source_revision=source_revision))
         if is_related:
+            # related repositories are diffed directly, so only the files touched by the diff are exported
             complete_diff = source.GenerateDiff(
                 target_revision,
                 source_revision,
                 files_to_skip=settings.CODEREVIEW_IGNORED_FILES)
+            signatures, unchanged = get_diff_unchanged_patches(complete_diff, previous_patchset)
+            paths = get_diff_paths(signatures, unchanged)
+            log("Exporting {0} touched files of target copy to {1} and source to {2}".format(
+                len(paths), target_export_path, source_export_path))
+            run_concurrently(
+                lambda: target.Export(target_revision, target_export_path, paths=paths),
+                lambda: source.Export(source_revision, source_export_path, paths=paths))
+            log("Exported target copy and source")
         else:
+            # unrelated repositories are diffed by their exported trees, so they have to be exported completely
+            log("Exporting target copy to {0} and source to {1}".format(target_export_path, source_export_path))
+            run_concurrently(
+                lambda: target.Export(target_revision, target_export_path),
+                lambda: source.Export(source_revision, source_export_path))
+            log("Exported target copy and source")
             complete_diff = (GitVCS(
                 attrdict({'revision': target_revision}),
                 target_export_path)
@@ -175,8 +309,9 @@ def get_complete_diff(target, target_revision, source, source_revision, is_relat
                     target_revision,
                     source_path=source_export_path,
                     files_to_skip=settings.CODEREVIEW_IGNORED_FILES))
+            _, unchanged = get_diff_unchanged_patches(complete_diff, previous_patchset)
         log("Finished generating diff!")
-        return complete_diff, target_export_path, source_export_path
+        return complete_diff, target_export_path, source_export_path, unchanged
     except Exception:
         # on any error, clean up temporary export folders
         for path in target_export_path, source_export_path:
@@ -217,25 +352,110 @@ def get_source_target_revisions(source, source_revision, target, target_revision
         so we can use it to get target revision (hash) from target branch
     :return: `tuple` in form ('source_revision_hash', 'target_revision_hash', 'is_related')
     """
-    source_revision = source.CheckRevision().strip()
-    original_target_revision = target.CheckRevision().strip()
-    is_related = check_repositories_related(source, target, target_revision)
-    try:
-        target_revision = source.GetCommonAncestor(target_revision)
-        if target_revision == source_revision:
-            raise RuntimeError('target and source revisions are same')
-    except RuntimeError:
+    source_revision, original_target_revision = [
+        revision.strip() for revision in run_concurrently(source.CheckRevision, target.CheckRevision)]
+
+    def get_common_ancestor():
+        try:
+            return source.GetCommonAncestor(target_revision)
+        except RuntimeError:
+            return None
+
+    is_related, common_ancestor = run_concurrently(
+        lambda: check_repositories_related(source, target, target_revision), get_common_ancestor)
+    if common_ancestor and common_ancestor != source_revision:
+        target_revision = common_ancestor
+    else:
         target_revision = original_target_revision
         is_related = False
 
     return source_revision, target_revision, is_related
 
 
-def generate_diff(original_branch, feature_branch):
+@contextlib.contextmanager
+def repository_lock(path, shared=False):
+    """Hold an inter-process lock for the given repository path.
+
+    :param path: `str` path of the repository to lock
+    :param shared: `bool` take the shared lock of the reviews reading the repository instead of the
+        exclusive lock of its update
+    """
+    lock_file = open(path.rstrip(os.sep) + '.lock', 'w')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        yield
+    finally:
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+        lock_file.close()
+
+
+@contextlib.contextmanager
+def repository_locks(paths, shared=False):
+    """Hold the inter-process locks of all the given repository paths.
+
+    :param paths: `list` of `str` paths of the repositories to lock
+    :param shared: `bool` take the shared locks instead of the exclusive ones
+    """
+    paths = sorted(set(paths))
+    if not paths:
+        yield
+        return
+    with repository_lock(paths[0], shared):
+        with repository_locks(paths[1:], shared):
+            yield
+
+
+def get_mirror_path(vcs, url):
+    """Get the mirror path of the given repository.
+
+    :param vcs: `str` version control system name of the repository
+    :param url: `str` repository url
+
+    :return: `str` path of the mirror in the settings.MIRROR_FOLDER.
+    """
+    return os.path.join(settings.MIRROR_FOLDER, vcs, md5(url).hexdigest())
+
+
+def get_repository_mirror(repository, vcs, url):
+    """Get up to date mirror of the given repository.
+
+    There is one bare mirror per repository url. It is cloned once, then only updated
+    incrementally with the changes pushed after the previous review. The mirror is updated under its
+    exclusive lock, the caller has to hold its shared lock while reading it.
+
+    :param repository: `VersionControlSystem` object of the remote repository
+    :param vcs: `str` version control system name of the repository
+    :param url: `str` repository url
+
+    :return: `VersionControlSystem` object of the mirror.
+    """
+    mirror_path = get_mirror_path(vcs, url)
+    mirror_dir = os.path.dirname(mirror_path)
+    if not os.path.exists(mirror_dir):
+        os.makedirs(mirror_dir)
+    with repository_lock(mirror_path):
+        if os.path.isdir(mirror_path):
+            log("Updating mirror {0} of {1}".format(mirror_path, url))
+            mirror = repository.__class__(repository.options, mirror_path)
+            mirror.UpdateMirror()
+        else:
+            # clone to the temporary location first, so interrupted clone never looks like a valid mirror
+            clone_path = mirror_path + '.clone'
+            shutil.rmtree(clone_path, ignore_errors=True)
+            log("Creating mirror {0} of {1}".format(mirror_path, url))
+            repository.Mirror(clone_path)
+            os.rename(clone_path, mirror_path)
+            mirror = repository.__class__(repository.options, mirror_path)
+        log("Finished updating mirror {0}".format(mirror_path))
+    return mirror
+
+
+def generate_diff(original_branch, feature_branch, previous_patchset=None):
     """Get full diff between given original and feature branches.
 
     :param original_branch: branch definition string, deferred by settings
     :param feature_branch:  branch definition string, deferred by settings
+    :param previous_patchset: `PatchSet` object, the files unchanged since it are not exported
 
     :return: string diff in svn format
     """
@@ -252,35 +472,80 @@ def generate_diff(original_branch, feature_branch):
         attrdict({'revision': target_revision, 'vcs': target_vcs}), target_url)
     source = GuessVCS(
         attrdict({'revision': source_revision, 'vcs': source_vcs}), source_url)
-    target_path = source_path = None
-    try:
-        if not target_branch_is_local:
-            target_path = os.path.join(settings.TEMP_FOLDER, uuid.uuid4().hex)
-            if not os.path.exists(target_path):
-                os.makedirs(target_path)
-            target = target.Clone(target_path)
-            target.Checkout()
-
-        if not source_branch_is_local:
-            source_path = os.path.join(settings.TEMP_FOLDER, uuid.uuid4().hex)
-            if not os.path.exists(source_path):
-                os.makedirs(source_path)
-            source = source.Clone(source_path)
-            source.Checkout()
 
+    def get_target():
+        if target_branch_is_local:
+            return target
+        return get_repository_mirror(target, target_vcs, target_url)
+
+    def get_source():
+        if source_branch_is_local:
+            return source
+        return get_repository_mirror(source, source_vcs, source_url)
+
+    if (not target_branch_is_local and not source_branch_is_local and
+            get_mirror_path(target_vcs, target_url) == get_mirror_path(source_vcs, source_url)):
+        # both branches are in the same repository, its mirror is updated once and used for both sides
+        target = get_target()
+        source = source.__class__(source.options, target.repo_dir)
+    else:
+        target, source = run_concurrently(get_target, get_source)
+
+    # The updates of the mirrors by the other reviews wait for the shared locks, so they can't move or prune
+    # the refs while the revisions are resolved and the files are exported.
+    mirror_paths = [
+        get_mirror_path(vcs, url) for vcs, url, is_local in (
+            (target_vcs, target_url, target_branch_is_local), (source_vcs, source_url, source_branch_is_local))
+        if not is_local]
+    with repository_locks(mirror_paths, shared=True):
         source_revision, target_revision, is_related = get_source_target_revisions(
             source, source_revision, target, target_revision, supports_simple_cloning)
-        complete_diff, target_export_path, source_export_path = get_complete_diff(
-            target, target_revision, source, source_revision, is_related)
-        return (
-            source_url, target_url, complete_diff, target, target_export_path,
-            source_revision, source_export_path)
-    finally:
-        for path in target_path, source_path:
-            if path and not settings.DEBUG:
-                log("Cleaning up temporary clone {0}".format(path))
-                shutil.rmtree(path, ignore_errors=True)
-                log("Finished cleaning up temporary clone {0}".format(path))
+        complete_diff, target_export_path, source_export_path, unchanged = get_complete_diff(
+            target, target_revision, source, source_revision, is_related, previous_patchset)
+    return (
+        source_url, target_url, complete_diff, target, target_export_path,
+        source_revision, source_export_path, unchanged)
+
+
+def get_cached(key, getter, timeout=None):
+    """Get the value from the cache, refreshing it in the background when it becomes stale.
+
+    Stale values are returned for up to LOOKUP_CACHE_STALE_TIMEOUT seconds, while a single background
+    thread gets the new value. The getter may run after the request has finished, so it must not use the request.
+
+    :param key: `str` cache key
+    :param getter: callable without arguments returning the value
+    :param timeout: `int` number of seconds the value is fresh, LOOKUP_CACHE_TIMEOUT setting by default
+
+    :return: cached or just got value.
+    """
+    if timeout is None:
+        timeout = settings.LOOKUP_CACHE_TIMEOUT
+
+    def refresh():
+        value = getter()
+        cache.set(key, (time.time() + timeout, value), timeout + settings.LOOKUP_CACHE_STALE_TIMEOUT)
+        return value
+
+    def refresh_in_background():
+        try:
+            refresh()
+        except Exception:
+            logging.exception('Refreshing the cached value of %s failed', key)
+        finally:
+            cache.delete(key + ':refresh')
+            # the connections are per thread, the one opened by this thread is never closed otherwise
+            django_db.close_connection()
+
+    cached = cache.get(key)
+    if cached is None:
+        return refresh()
+    fresh_until, value = cached
+    if fresh_until < time.time() and cache.add(key + ':refresh', True, timeout):
+        thread = threading.Thread(target=refresh_in_background)
+        thread.daemon = True
+        thread.start()
+    return value
 
 
 def get_fogbugz_case_info(request, case_number):
@@ -291,11 +556,31 @@ def get_fogbugz_case_info(request, case_number):
     :return: `tuple` in form
         ('case_number', 'case_title', 'original_branch', 'feature_branch', 'ci_project', 'target_branch')
     """
+    return get_fogbugz_case_info_by_token(get_fogbugz_token(request), case_number)
+
+
+def get_fogbugz_token(request):
+    """Get the Fogbugz token of the request user.
+
+    :return: `str` token, or `None` if the user has no Fogbugz profile.
+    """
     try:
-        token = request.user.fogbugzprofile.token
+        return request.user.fogbugzprofile.token
     except Exception:
+        return None
+
+
+def get_fogbugz_case_info_by_token(token, case_number):
+    """Get Fogbugz case information using the given token, see `get_fogbugz_case_info`.
+
+    Unlike `get_fogbugz_case_info`, it doesn't use the request, so it can be run in the background.
+
+    :param token: `str` Fogbugz token, or `None`
+    :param case_number: `int` Fogbugz case number
+    """
+    if token is None:
         return (None, None, None, None, None, None)
-    fogbugz_instance = fogbugz.FogBugz(settings.FOGBUGZ_URL, token=token)
+    fogbugz_instance = fogbugz_client.get_client(token)
     resp = fogbugz_instance.search(
         q='ixBug:"{0}"'.format(case_number),
         cols=','.join([
@@ -322,12 +607,35 @@ def get_fogbugz_case_info(request, case_number):
     )
 
 
-def get_fogbugz_assignees(request, case_number):
-    """Get a list of people that a given case has been assigned to."""
-    fogbugz_instance = fogbugz.FogBugz(settings.FOGBUGZ_URL, token=request.user.fogbugzprofile.token)
+FOGBUGZ_PEOPLE_CACHE_KEY = 'fogbugz:people'
+
+
+def get_fogbugz_people(fogbugz_instance):
+    """Get the directory of FogBugz people, loaded in bulk and refreshed periodically.
+
+    :param fogbugz_instance: `FogBugz` client used to load the directory
+
+    :return: `dict` in form {person_id: full_name}.
+    """
+    def load_people():
+        resp = fogbugz_instance.listPeople(
+            fIncludeActive=1, fIncludeNormal=1, fIncludeDeleted=1, fIncludeVirtual=1)
+        return dict(
+            (int(person.find('ixperson').text), person.find('sfullname').text)
+            for person in resp.findAll('person'))
+    return get_cached(FOGBUGZ_PEOPLE_CACHE_KEY, load_people, settings.FOGBUGZ_PEOPLE_CACHE_TIMEOUT)
+
+
+def get_fogbugz_case_assignee_ids(fogbugz_instance, case_number):
+    """Get ids of the people a given case has been assigned to.
+
+    :param fogbugz_instance: `FogBugz` client
+    :param case_number: `str` Fogbugz case number
+
+    :return: `list` of distinct person ids, the most recent assignee first.
+    """
     resp = fogbugz_instance.search(q=case_number, cols='events')
-    possible_assignees = []
-    fetched_person_ids = set()
+    person_ids = []
     events = resp.findAll('event')
     events.reverse()
     for event in events:
@@ -338,14 +646,43 @@ def get_fogbugz_assignees(request, case_number):
         except ValueError:
             continue
 
-        if person_id in fetched_person_ids:
-            # Already added this person.
-            continue
+        if person_id not in person_ids:
+            person_ids.append(person_id)
+    return person_ids
+
 
-        person_name = fogbugz_instance.viewPerson(ixPerson=person_id).find('sfullname').text
-        fetched_person_ids.add(person_id)
-        if request.REQUEST.get('term', '').lower() in person_name.lower():
-            possible_assignees.append((person_id, person_name))
+FOGBUGZ_ASSIGNEES_GENERATION_KEY = 'fogbugz:assignees:{0}:generation'
+
+
+def invalidate_fogbugz_assignees(case_number):
+    """Make the cached assignees of the case, of all the users, be loaded again.
+
+    :param case_number: `int` Fogbugz case number
+    """
+    # the generation outlives the cached assignees, including the stale ones
+    cache.set(
+        FOGBUGZ_ASSIGNEES_GENERATION_KEY.format(int(case_number)), uuid.uuid4().hex,
+        settings.LOOKUP_CACHE_TIMEOUT + settings.LOOKUP_CACHE_STALE_TIMEOUT)
+
+
+def get_fogbugz_assignees(request, case_number):
+    """Get a list of people that a given case has been assigned to."""
+    token = request.user.fogbugzprofile.token
+    fogbugz_instance = fogbugz_client.get_client(token)
+    generation = cache.get(FOGBUGZ_ASSIGNEES_GENERATION_KEY.format(int(case_number))) or ''
+    person_ids = get_cached(
+        'fogbugz:assignees:{0}:{1}:{2}'.format(case_number, generation, md5(token or '').hexdigest()),
+        lambda: get_fogbugz_case_assignee_ids(fogbugz_instance, case_number))
+    people = get_fogbugz_people(fogbugz_instance)
+    if not set(person_ids).issubset(people):
+        # somebody was added after the directory was loaded
+        cache.delete(FOGBUGZ_PEOPLE_CACHE_KEY)
+        people = get_fogbugz_people(fogbugz_instance)
+
+    term = request.REQUEST.get('term', '').lower()
+    possible_assignees = [
+        (person_id, people[person_id]) for person_id in person_ids
+        if person_id in people and term in people[person_id].lower()]
 
     if len(possible_assignees) >= 2:
         return (
@@ -360,15 +697,109 @@ def get_fogbugz_assignees(request, case_number):
         return possible_assignees
 
 
+def queue_fogbugz_operation(request, case_number, command, **params):
+    """Queue the FogBugz API write of the case to be made by the background workers.
+
+    The operation is saved in the transaction of the request, so it's only made if the request succeeds.
+    Unless FOGBUGZ_OUTBOX_ASYNC is set, the request transaction is committed and the operation is made right away.
+
+    :param case_number: `int` Fogbugz case number
+    :param command: `str` FogBugz API command
+    :param params: keyword arguments of the command
+
+    :return: `FogBugzOperation` object.
+    :raises RuntimeError: if the operation couldn't be made right away, it's left for the background workers.
+    """
+    operation = models.FogBugzOperation(
+        case_id=int(case_number), token=request.user.fogbugzprofile.token, command=command,
+        params=json.dumps(params))
+    operation.put()
+    if command == 'assign':
+        invalidate_fogbugz_assignees(case_number)
+    if not settings.FOGBUGZ_OUTBOX_ASYNC:
+        run_fogbugz_case_operations(operation.case_id)
+    return operation
+
+
+def commit_transaction():
+    """Commit the current transaction, managed by the request or not."""
+    if django_db.transaction.is_managed():
+        django_db.transaction.commit()
+    else:
+        django_db.transaction.commit_unless_managed()
+
+
+def run_fogbugz_case_operations(case_id):
+    """Make the unfinished FogBugz operations of the case right away, in the order of their creation.
+
+    The current transaction is committed first, so the case is never changed for the changes which are rolled back.
+
+    :param case_id: `int` Fogbugz case number
+
+    :raises RuntimeError: if an operation is being made by a background worker or it failed, the rest of the
+        operations are left for the background workers then.
+    """
+    commit_transaction()
+    worker = '{0}:{1}'.format(socket.gethostname(), os.getpid())
+    for operation in models.FogBugzOperation.objects.filter(
+            case_id=case_id, status__in=('queued', 'running')).order_by('id'):
+        now = datetime.datetime.now()
+        if operation.status != 'queued' or not models.FogBugzOperation.objects.filter(
+                id=operation.id, status='queued').update(status='running', worker=worker, started=now, heartbeat=now):
+            raise RuntimeError(
+                'Fogbugz case {0} is being changed in the background, your changes will be made after it.'.format(
+                    case_id))
+        commit_transaction()
+        try:
+            run_fogbugz_operation(operation)
+        except Exception as exc:
+            logging.exception('FogBugz operation %s failed, it will be retried', operation.id)
+            raise RuntimeError(
+                'Failed to change Fogbugz case {0}, it will be retried by the background workers: {1}'.format(
+                    case_id, get_error_message(exc)))
+        finally:
+            commit_transaction()
+
+
+def run_fogbugz_operation(operation):
+    """Make the queued FogBugz API write.
+
+    Failed operations are queued again with an exponential backoff, until FOGBUGZ_OUTBOX_MAX_ATTEMPTS
+    is reached. The exceptions are re-raised.
+
+    :param operation: `FogBugzOperation` object to run
+    """
+    fogbugz_instance = fogbugz_client.get_client(operation.token)
+    try:
+        getattr(fogbugz_instance, operation.command)(ixBug=str(operation.case_id), **json.loads(operation.params))
+        if operation.command == 'assign':
+            # the assignees could be loaded again before the case was assigned
+            invalidate_fogbugz_assignees(operation.case_id)
+        operation.status = 'done'
+        operation.error = None
+    except Exception as exc:
+        operation.attempts += 1
+        operation.error = get_error_message(exc)
+        if operation.attempts >= settings.FOGBUGZ_OUTBOX_MAX_ATTEMPTS:
+            operation.status = 'failed'
+        else:
+            operation.status = 'queued'
+            operation.next_attempt = datetime.datetime.now() + datetime.timedelta(
+                seconds=settings.FOGBUGZ_OUTBOX_RETRY_DELAY * 2 ** (operation.attempts - 1))
+        raise
+    finally:
+        operation.put()
+
+
 def fogbugz_assign_case(request, case_number, target, message, tags):
     """Assign a fogbugz case."""
-    fogbugz_instance = fogbugz.FogBugz(settings.FOGBUGZ_URL, token=request.user.fogbugzprofile.token)
-    fogbugz_instance.assign(ixBug=case_number, ixPersonAssignedTo=target, sEvent=message, sTags=','.join(tags))
+    queue_fogbugz_operation(
+        request, case_number, 'assign', ixPersonAssignedTo=target, sEvent=message, sTags=','.join(tags))
 
 
 def get_fogbugz_tags(request, case_number=None):
     """Get a list of all available or just case's tags."""
-    fogbugz_instance = fogbugz.FogBugz(settings.FOGBUGZ_URL, token=request.user.fogbugzprofile.token)
+    fogbugz_instance = fogbugz_client.get_client(request.user.fogbugzprofile.token)
     if case_number:
         resp = fogbugz_instance.search(q=case_number, cols='tags')
         resp = (tg.text.strip() for tg in resp.find('tags').findAll('tag'))
@@ -437,37 +868,94 @@ def create_file_content(patch, exp_path, filename):
     :return: `Patch` object with the content read from given filename.
     """
     file_path = os.path.join(exp_path, filename).encode('utf-8')
-    args = {'text': ''}
 
+    if os.path.exists(file_path) and patch.is_binary:
+        return get_or_create_binary_content(file_path)
+
+    text = ''
     if os.path.exists(file_path):
-        if patch.is_binary:
-            storage_name = uuid.uuid4().hex
-            if not os.path.exists(BINARY_FILES_PATH):
-                os.makedirs(BINARY_FILES_PATH)
-            shutil.copy2(
-                file_path, os.path.join(BINARY_FILES_PATH, storage_name))
-            args['data'] = storage_name
-        else:
-            try:
-                with open(file_path) as fd:
-                    text = fd.read()
-            except IOError:
-                text = ''
-            args['text'] = text
-    content = models.Content(is_uploaded=True, **args)
+        try:
+            with open(file_path) as fd:
+                text = fd.read()
+        except IOError:
+            pass
+    return get_or_create_content(sha1(text).hexdigest(), text=text)
+
+
+def get_or_create_content(checksum, **kwargs):
+    """Get the content with given checksum, creating it if it's not stored yet.
+
+    Contents are addressed by the sha1 checksum of the file, so identical files of all patch sets and issues
+    are stored once and shared by the patches. Contents uploaded by upload.py have md5 checksums, so they are
+    never shared.
+
+    :param checksum: `str` sha1 hex digest of the file
+    :param kwargs: `dict` of the `Content` properties to create it with
+
+    :return: `Content` object.
+    """
+    # contents marked bad keep their checksum, but they are not used anymore
+    for content in models.Content.objects.filter(checksum=checksum, is_bad=False).exclude(text=None)[:1]:
+        return content
+    content = models.Content(is_uploaded=True, checksum=checksum, **kwargs)
     content.put()
     return content
 
 
-def fill_original_files(patches, target_export_path, source_export_path):
+def get_or_create_binary_content(file_path):
+    """Get the content of the binary file, storing the file if it's not stored yet.
+
+    Binary files are stored in the BINARY_FILES_PATH under their checksum, so identical files are stored once.
+
+    :param file_path: `str` path of the binary file
+
+    :return: `Content` object.
+    """
+    checksum = sha1()
+    with open(file_path, 'rb') as fd:
+        for chunk in iter(lambda: fd.read(65536), ''):
+            checksum.update(chunk)
+    storage_name = checksum.hexdigest()
+    storage_path = os.path.join(BINARY_FILES_PATH, storage_name)
+    if not os.path.exists(storage_path):
+        if not os.path.exists(BINARY_FILES_PATH):
+            os.makedirs(BINARY_FILES_PATH)
+        # copy under the temporary name first, so a partially copied file is never used
+        temp_path = '{0}.{1}'.format(storage_path, uuid.uuid4().hex)
+        shutil.copy2(file_path, temp_path)
+        os.rename(temp_path, storage_path)
+    return get_or_create_content('binary:' + storage_name, text='', data=storage_name)
+
+
+def reuse_unchanged_contents(patches, unchanged):
+    """Share the contents of the patches which did not change since the previous patch set.
+
+    :param patches: `list` of `Patch` objects of the new patch set
+    :param unchanged: `dict` of the unchanged patches as returned by `get_unchanged_patches` when the diff was
+        generated
+
+    :return: `int` number of patches which got the contents of the previous patch set.
+    """
+    for patch in patches:
+        previous = unchanged.get(patch.filename)
+        if previous is not None:
+            patch.content = previous.content
+            patch.patched_content = previous.patched_content
+    return len(unchanged)
+
+
+def fill_original_files(patches, target_export_path, source_export_path, job=None):
     """Fill patches with original files.
 
     :param patches: `list` of `Patch` objects to fill file content into
     :param target_export_path: `str` path of the exported target repository to get file content from
     :param source_export_path `str` path of the exported source repository to get file content from
+    :param job: `ProcessingJob` object to report the progress to
     """
     for index, patch in enumerate(patches):
         log("process_codereview_from_fogbugz(): Munging patch set #{0}".format(index))
+        if job and not index % 10:
+            set_job_progress(job, 'Storing files ({0} of {1})'.format(index + 1, len(patches)))
         for attr, exp_path, filename in [
                 ('content', target_export_path, patch.old_filename or patch.filename),
                 ('patched_content', source_export_path, patch.filename)]:
@@ -493,11 +981,58 @@ def process_codereview_from_fogbugz(request):
     # get codereview issue
     issue = get_issue(request, case_number, case_title)
 
+    job = models.ProcessingJob(issue=issue, original_branch=original_branch, feature_branch=feature_branch)
+    job.put()
+
+    if not settings.CODEREVIEW_PROCESSING_ASYNC:
+        run_processing_job(job)
+        if job.status == 'failed':
+            return HttpResponseServerError(job.error)
+
+    return HttpResponseRedirect('/%s/show' % issue.id)
+
+
+def get_error_message(exc):
+    """Get the message of the exception, whether it was raised with a byte string or a unicode message.
+
+    :param exc: `Exception` object
+
+    :return: `unicode` message.
+    """
+    try:
+        return unicode(exc)
+    except UnicodeError:
+        return str(exc).decode('utf-8', 'replace')
+
+
+def set_job_progress(job, progress):
+    """Record the current processing step of the job.
+
+    :param job: `ProcessingJob` object
+    :param progress: `str` human readable description of the step
+    """
+    log(progress)
+    job.progress = progress
+    job.heartbeat = datetime.datetime.now()
+    job.put()
+
+
+def run_processing_job(job):
+    """Create the issue patch set for the processing job.
+
+    Job status is set to `done` or `failed` accordingly, the exceptions are re-raised after that.
+
+    :param job: `ProcessingJob` object to run
+    """
+    issue = job.issue
+    previous_patchset = issue.latest_patchset
     source_export_path = target_export_path = None
     try:
-        # get the diff
+        job.status = 'running'
+        set_job_progress(job, 'Generating diff')
         (source_url, target_url, complete_diff, vcs, target_export_path,
-            source_revision, source_export_path) = generate_diff(original_branch, feature_branch)
+            source_revision, source_export_path, unchanged) = generate_diff(
+                job.original_branch, job.feature_branch, previous_patchset)
 
         # validate the diff
         for validator in settings.CODEREVIEW_VALIDATORS:
@@ -505,32 +1040,67 @@ def process_codereview_from_fogbugz(request):
 
         complete_diff = unicode(complete_diff, 'utf-8', 'replace')
 
+        # the issue could be edited since the job was queued, only the processing columns are written
         issue.latest_patch_rev = source_revision
         issue.base = source_url
-        issue.put()
+        models.Issue.objects.filter(id=issue.id).update(
+            latest_patch_rev=source_revision, base=source_url, modified=datetime.datetime.now())
 
-        log("Creating patch set instance")
+        set_job_progress(job, 'Creating patch set')
         patchset = models.PatchSet(
             issue=issue, data=complete_diff, parent=issue, revision=source_revision)
         patchset.put()
-        log("Created patch set instance!")
 
-        log("Parsing patch set")
+        set_job_progress(job, 'Parsing patch set')
         patches = ParsePatchSet(patchset)
-        log("Parsed patch set")
 
         if not patches:
-            return HttpResponseServerError('Looks like there is no difference between provided branches.')
+            job.status = 'failed'
+            job.error = 'Looks like there is no difference between provided branches.'
+            job.put()
+            return
 
+        views._calculate_deltas(patchset, patches)
         db.put(patches)
-        fill_original_files(patches, target_export_path, source_export_path)
-        return HttpResponseRedirect('/%s/show' % issue.id)
+        patchset.update_manifest(patches)
+        patchset.put()
+        # the files of the unchanged patches were not exported, so exactly these patches have to reuse the contents
+        reused = reuse_unchanged_contents(patches, unchanged)
+        log("Reused contents of {0} unchanged patches".format(reused))
+        fill_original_files(patches, target_export_path, source_export_path, job=job)
+        job.status = 'done'
+        set_job_progress(job, 'Done')
+    except Exception as exc:
+        job.status = 'failed'
+        job.error = get_error_message(exc)
+        job.put()
+        raise
     finally:
         for path in target_export_path, source_export_path:
             if path and not settings.DEBUG:
                 shutil.rmtree(path, ignore_errors=True)
         issue.processing = False
-        issue.save()
+        models.Issue.objects.filter(id=issue.id).update(processing=False)
+
+
+@views.issue_required
+@views.login_required
+@permission_required('codereview.view_issue')
+@views.json_response
+def processing_status(request):
+    """Get the status of the latest processing job of the issue.
+
+    :param request: HTTP request.
+    """
+    jobs = models.ProcessingJob.objects.filter(issue=request.issue).order_by('-created')[:1]
+    if not jobs:
+        return {'processing': request.issue.processing}
+    return {
+        'processing': request.issue.processing,
+        'status': jobs[0].status,
+        'progress': jobs[0].progress,
+        'error': jobs[0].error,
+    }
 
 
 @views.login_required
@@ -567,8 +1137,6 @@ def mark_issue_approved(request, issue, case_id, target_branch):
     :param case_id: `str` id of the Fogbugz case to assign the case to Mergekeepers user
     :param target_branch: `str` target branch to merge approved revision into.
     """
-    fogbugz_instance = fogbugz.FogBugz(settings.FOGBUGZ_URL, token=request.user.fogbugzprofile.token)
-
     # get information from the fogbugz case
     _, _, _, _, ci_project, _ = get_fogbugz_case_info(request, case_id)
 
@@ -591,8 +1159,7 @@ def mark_issue_approved(request, issue, case_id, target_branch):
     tags = set(get_fogbugz_tags(request, case_id))
     tags.add(settings.FOGBUGZ_APPROVED_TAG)
 
-    fogbugz_instance.edit(**{
-        "ixBug": str(case_id),
+    queue_fogbugz_operation(request, case_id, 'edit', **{
         "ixPersonAssignedTo": str(settings.FOGBUGZ_MERGEKEEPER_USER_ID),
         settings.FOGBUGZ_APPROVED_REVISION_FIELD_ID: issue.latest_reviewed_rev,
         settings.FOGBUGZ_TARGET_BRANCH_FIELD_ID: target_branch,
@@ -786,7 +1353,10 @@ def publish(request):
     views._notify_issue(request, issue, 'Comments published')
 
     if assign_to:
-        fogbugz_assign_case(request, case_id, assign_to, msg.text, form.cleaned_data['tags'])
+        try:
+            fogbugz_assign_case(request, case_id, assign_to, msg.text, form.cleaned_data['tags'])
+        except RuntimeError as exc:
+            messages_api.error(request, unicode(exc))
 
     # There are now no comments here (modulo race conditions)
     models.Account.current_user_account.update_drafts(issue, 0)
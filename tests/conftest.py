@@ -23,10 +23,11 @@ import django_webtest  # NOQA
 from django.core import urlresolvers  # NOQA
 from django.contrib.auth import models as auth_models  # NOQA
 from django.conf import settings  # NOQA
+from django.core.cache import cache  # NOQA
 
 from django_auth_fogbugz.models import FogBugzProfile  # NOQA
 
-from paylogic import patches  # NOQA
+from paylogic import fogbugz_client, patches  # NOQA
 from codereview import models  # NOQA
 from paylogic import views  # NOQA
 
@@ -43,7 +44,7 @@ def app(user, user_name, user_password):
 
 
 @pytest.fixture(autouse=True)
-def django_settings(repo_base_dir, target_repo_name, source_repo_name, vcs):
+def django_settings(tmpdir, repo_base_dir, target_repo_name, source_repo_name, vcs):
     """Override django settings for tests purpose."""
     default_branches = {
         'hg': 'default',
@@ -66,6 +67,11 @@ def django_settings(repo_base_dir, target_repo_name, source_repo_name, vcs):
         vcs=vcs, path=repo_base_dir.join(source_repo_name).strpath)
     settings.ORIGINAL_BRANCH_DEFAULT_PREFIX = '{vcs}+{path}#'.format(
         vcs=vcs, path=repo_base_dir.join(target_repo_name).strpath)
+    settings.MIRROR_FOLDER = tmpdir.join('mirrors').strpath
+    settings.CODEREVIEW_PROCESSING_ASYNC = False
+    settings.FOGBUGZ_OUTBOX_ASYNC = False
+    cache.clear()
+    fogbugz_client.clear()
 
 
 @pytest.fixture
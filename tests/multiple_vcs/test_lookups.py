@@ -18,3 +18,16 @@ def test_target_branches(app, case_id, taget_branch_getter_settings, mocked_fogb
     response = app.get('/lookup/target_branches/{case_id}?term=test&page=1'.format(**locals()))
     content = json.loads(response.content)
     assert content == {'results': [{'id': 'test-branch', 'text': 'test-branch-title'}], u'err': u'nil', u'more': False}
+
+
+def test_target_branches_filter(app, case_id, mocked_fogbugz_info):
+    """Test filtering the target branches lookup results by the term."""
+    settings.CODEREVIEW_TARGET_BRANCH_CHOICES_GETTER = lambda *args: [
+        ('default', 'default'), ('release/1.2', 'release/1.2'), ('1.3', 'Release 1.3')]
+    response = app.get('/lookup/target_branches/{case_id}?term=1.&page=1'.format(**locals()))
+    content = json.loads(response.content)
+    assert content['results'] == [{'id': 'release/1.2', 'text': 'release/1.2'}, {'id': '1.3', 'text': 'Release 1.3'}]
+
+    response = app.get('/lookup/target_branches/{case_id}?term=Rel&page=1'.format(**locals()))
+    content = json.loads(response.content)
+    assert content['results'] == [{'id': 'release/1.2', 'text': 'release/1.2'}, {'id': '1.3', 'text': 'Release 1.3'}]
@@ -0,0 +1,69 @@
+"""Line diff algorithms tests."""
+import random
+
+import pytest
+
+from codereview import linediff
+
+
+def get_lcs_length(old, new):
+    """Get the length of the longest common subsequence of two lists."""
+    lengths = [0] * (len(new) + 1)
+    for old_item in old:
+        previous = 0
+        for j, new_item in enumerate(new):
+            current = lengths[j + 1]
+            lengths[j + 1] = previous + 1 if old_item == new_item else max(lengths[j + 1], lengths[j])
+            previous = current
+    return lengths[-1]
+
+
+def get_random_lines(rnd):
+    """Get random lines, repeating a lot like the lines of the real files do."""
+    return ['line {0}\n'.format(rnd.randint(0, 5)) for _ in range(rnd.randint(0, 40))]
+
+
+def check_opcodes(opcodes, old, new):
+    """Check that the opcodes cover both sides and rebuild the new lines from the old ones.
+
+    :return: `int` number of the equal lines.
+    """
+    rebuilt = []
+    i = j = equal = 0
+    for tag, i1, i2, j1, j2 in opcodes:
+        assert (i1, j1) == (i, j)
+        if tag == 'equal':
+            assert old[i1:i2] == new[j1:j2]
+            rebuilt.extend(old[i1:i2])
+            equal += i2 - i1
+        else:
+            assert tag in ('replace', 'delete', 'insert')
+            rebuilt.extend(new[j1:j2])
+        i, j = i2, j2
+    assert (i, j) == (len(old), len(new))
+    assert rebuilt == new
+    return equal
+
+
+@pytest.mark.parametrize('algorithm', ['myers', 'histogram'])
+@pytest.mark.parametrize('seed', range(100))
+def test_opcodes(algorithm, seed):
+    """Test that the opcodes of the random lines are valid and the myers diff is minimal."""
+    rnd = random.Random(seed)
+    old = get_random_lines(rnd)
+    new = get_random_lines(rnd) if seed % 2 else [line for line in old if rnd.random() < 0.8] + get_random_lines(rnd)
+    opcodes, timed_out = linediff.Diff(old, new, algorithm, timeout=60)
+    assert not timed_out
+    equal = check_opcodes(opcodes, old, new)
+    if algorithm == 'myers':
+        assert equal == get_lcs_length(old, new)
+
+
+@pytest.mark.parametrize('algorithm', ['myers', 'histogram'])
+def test_opcodes_timeout(algorithm):
+    """Test that a timed out diff is reported and its opcodes are still valid."""
+    old = ['a\n', 'b\n', 'same\n']
+    new = ['b\n', 'c\n', 'same\n']
+    opcodes, timed_out = linediff.Diff(old, new, algorithm, timeout=-1)
+    assert timed_out
+    check_opcodes(opcodes, old, new)
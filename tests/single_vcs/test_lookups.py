@@ -20,10 +20,15 @@ def test_case_assigned(app, case_id, mocked_fogbugz):
     </events>
     """.format(case_id=case_id))
 
-    mocked_fogbugz_instance.viewPerson.return_value = BeautifulSoup.BeautifulSoup("""
+    mocked_fogbugz_instance.listPeople.return_value = BeautifulSoup.BeautifulSoup("""
     <people>
       <person>
         <ixPerson>3</ixPerson>
+        <sFullName>Mikey</sFullName>
+        <sEmail>mikey@oldmacdonald.com</sEmail>
+      </person>
+      <person>
+        <ixPerson>4</ixPerson>
         <sFullName>Old MacDonald</sFullName>
         <sEmail>grandpa@oldmacdonald.com</sEmail>
       </person>
@@ -34,6 +39,12 @@ def test_case_assigned(app, case_id, mocked_fogbugz):
     content = json.loads(response.content)
     assert content == {'results': [{'id': 4, 'text': 'Old MacDonald'}], u'err': u'nil', u'more': False}
 
+    response = app.get('/lookup/case_assigned/{case_id}?term=mac&page=1'.format(**locals()))
+    content = json.loads(response.content)
+    assert content == {'results': [{'id': 4, 'text': 'Old MacDonald'}], u'err': u'nil', u'more': False}
+    assert mocked_fogbugz_instance.search.call_count == 1
+    assert mocked_fogbugz_instance.listPeople.call_count == 1
+
 
 def test_case_tags(app, case_id, mocked_fogbugz):
     """Test case tags lookup used for gatekeeper approval form."""
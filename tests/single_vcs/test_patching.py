@@ -0,0 +1,62 @@
+"""Patch parsing tests."""
+import pytest
+
+from codereview import patching
+
+
+def parse_chunk(hunk):
+    """Parse the patch of a single hunk.
+
+    :return: `tuple` of the old lines, the new lines and the opcodes of the chunk.
+    """
+    chunks = patching.ParsePatchToChunks(['--- a/file\n', '+++ b/file\n'] + hunk)
+    assert len(chunks) == 1
+    _, _, old_chunk, new_chunk, opcodes = chunks[0]
+    return old_chunk, new_chunk, opcodes
+
+
+def test_interleaved_changes():
+    """Test that the interleaved removed and added lines between the context lines make one replace."""
+    old_chunk, new_chunk, opcodes = parse_chunk(
+        ['@@ -1,5 +1,5 @@\n', ' a\n', '-b\n', '+B\n', '-c\n', '+C\n', ' d\n', '-e\n', '+E\n'])
+    assert old_chunk == ['a\n', 'b\n', 'c\n', 'd\n', 'e\n']
+    assert new_chunk == ['a\n', 'B\n', 'C\n', 'd\n', 'E\n']
+    assert opcodes == [('equal', 0, 1, 0, 1), ('replace', 1, 3, 1, 3), ('equal', 3, 4, 3, 4), ('replace', 4, 5, 4, 5)]
+
+
+@pytest.mark.parametrize(('hunk', 'expected_opcodes'), [
+    (['@@ -1,2 +1,3 @@\n', ' a\n', '+b\n', ' c\n'],
+     [('equal', 0, 1, 0, 1), ('insert', 1, 1, 1, 2), ('equal', 1, 2, 2, 3)]),
+    (['@@ -1,3 +1,2 @@\n', ' a\n', '-b\n', ' c\n'],
+     [('equal', 0, 1, 0, 1), ('delete', 1, 2, 1, 1), ('equal', 2, 3, 1, 2)]),
+    (['@@ -0,0 +1,2 @@\n', '+a\n', '+b\n'], [('insert', 0, 0, 0, 2)]),
+    (['@@ -1,2 +0,0 @@\n', '-a\n', '-b\n'], [('delete', 0, 2, 0, 0)]),
+])
+def test_insert_delete(hunk, expected_opcodes):
+    """Test that the only added or only removed lines make an insert or a delete."""
+    assert parse_chunk(hunk)[2] == expected_opcodes
+
+
+@pytest.mark.parametrize(('hunk', 'expected_old', 'expected_new'), [
+    (['@@ -1,2 +1,2 @@\n', ' a\n', '-b\n', '+c\n', '\\ No newline at end of file\n'], ['a\n', 'b\n'], ['a\n', 'c']),
+    (['@@ -1,2 +1,2 @@\n', ' a\n', '-b\n', '\\ No newline at end of file\n', '+b\n'], ['a\n', 'b'], ['a\n', 'b\n']),
+])
+def test_no_newline_at_end_of_file(hunk, expected_old, expected_new):
+    """Test that the missing newline at the end of the file changes only the last line of its side."""
+    old_chunk, new_chunk, opcodes = parse_chunk(hunk)
+    assert (old_chunk, new_chunk) == (expected_old, expected_new)
+    assert opcodes == [('equal', 0, 1, 0, 1), ('replace', 1, 2, 1, 2)]
+
+
+def test_patch_chunks():
+    """Test that the patched file is built from the opcodes of the chunks."""
+    old_lines = ['{0}\n'.format(i) for i in range(10)]
+    chunks = patching.ParsePatchToChunks([
+        '--- a/file\n', '+++ b/file\n',
+        '@@ -2,3 +2,3 @@\n', ' 1\n', '-2\n', '+two\n', ' 3\n',
+        '@@ -7,3 +7,4 @@\n', ' 6\n', '+6.5\n', ' 7\n', '-8\n', '+eight\n'])
+    new_lines = []
+    for tag, old, new in patching.PatchChunks(old_lines, chunks):
+        assert tag in ('equal', 'insert', 'delete', 'replace')
+        new_lines.extend(new)
+    assert new_lines == ['0\n', '1\n', 'two\n', '3\n', '4\n', '5\n', '6\n', '6.5\n', '7\n', 'eight\n', '9\n']
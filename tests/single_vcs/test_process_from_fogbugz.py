@@ -1,12 +1,17 @@
 """Codereview paylogic custom views tests."""
+import os.path
+import subprocess
 import urllib
 
 import pytest
 
 from django import db
+from django.conf import settings
 from django.core import urlresolvers
 
-from paylogic import views
+from codereview import models
+
+from paylogic import jobs, views
 
 
 def test_process_codereview_from_fogbugz_processing(
@@ -30,3 +35,88 @@ def test_process_codereview_from_fogbugz_processing(
     with pytest.raises(RuntimeError) as exc_info:
         views.process_codereview_from_fogbugz(request)
     assert exc_info.value.args == ('Cannot handle multiple submit requests for the same Fogbugz case.',)
+
+
+def test_process_codereview_from_fogbugz_mirror(
+        user, rf, vcs, vcs_commands, source_repo, source_test_file_name, mocked_fogbugz_info, case_id):
+    """Test that remote repositories are mirrored once and then updated incrementally."""
+    request = rf.get(urlresolvers.reverse('process_from_fogbugz') + '?' + urllib.urlencode(dict(case=case_id)))
+    request.user = user
+    views.process_codereview_from_fogbugz(request)
+    mirror_path = views.get_mirror_path(vcs, source_repo.strpath)
+    assert os.path.isdir(mirror_path)
+
+    # commit new changes to the source repository after the first review
+    subprocess.check_call(['git', 'config', 'core.bare', 'false'], cwd=source_repo.strpath)
+    source_repo.join(source_test_file_name).write('updated feature content')
+    subprocess.check_call(vcs_commands['commit'], cwd=source_repo.strpath)
+    subprocess.check_call(vcs_commands['bare'], cwd=source_repo.strpath)
+
+    response = views.process_codereview_from_fogbugz(request)
+    url = response._headers['location'][1]
+    issue = models.Issue.objects.get(id=urlresolvers.resolve(url).args[0])
+    assert len(issue.patchsets) == 2
+    patch = issue.latest_patchset.patch_set.get(filename=source_test_file_name)
+    assert patch.patched_content.text == 'updated feature content'
+
+
+def test_process_codereview_from_fogbugz_async(
+        user, rf, app, source_test_file_name, source_test_file_content, mocked_fogbugz_info, case_id):
+    """Test creating issue using the data from fogbugz case in the background job."""
+    settings.CODEREVIEW_PROCESSING_ASYNC = True
+    request = rf.get(urlresolvers.reverse('process_from_fogbugz') + '?' + urllib.urlencode(dict(case=case_id)))
+    request.user = user
+    response = views.process_codereview_from_fogbugz(request)
+    assert response.status_code == 302
+    url = response._headers['location'][1]
+    issue_id = urlresolvers.resolve(url).args[0]
+    issue = models.Issue.objects.get(id=issue_id)
+    assert issue.processing
+    assert len(issue.patchsets) == 0
+
+    status_url = urlresolvers.reverse('processing_status', args=[issue_id])
+    assert app.get(status_url).json == {
+        'processing': True, 'status': 'queued', 'progress': None, 'error': None}
+
+    jobs.run_worker(once=True)
+
+    issue = models.Issue.objects.get(id=issue_id)
+    assert not issue.processing
+    assert len(issue.patchsets) == 1
+    patch = issue.latest_patchset.patch_set.get(filename=source_test_file_name)
+    assert patch.patched_content.text == source_test_file_content
+    assert app.get(status_url).json == {
+        'processing': False, 'status': 'done', 'progress': 'Done', 'error': None}
+
+
+def test_process_codereview_from_fogbugz_reuse_unchanged(user, rf, mocked_fogbugz_info, case_id):
+    """Test that the contents of the files unchanged since the previous patch set are reused."""
+    request = rf.get(urlresolvers.reverse('process_from_fogbugz') + '?' + urllib.urlencode(dict(case=case_id)))
+    request.user = user
+    views.process_codereview_from_fogbugz(request)
+    response = views.process_codereview_from_fogbugz(request)
+    url = response._headers['location'][1]
+    issue = models.Issue.objects.get(id=urlresolvers.resolve(url).args[0])
+    first_patchset, second_patchset = issue.patchsets
+    first_patches = dict((patch.filename, patch) for patch in first_patchset.patch_set.all())
+    second_patches = list(second_patchset.patch_set.all())
+    assert len(second_patches) == len(first_patches)
+    for patch in second_patches:
+        assert patch.content.id == first_patches[patch.filename].content.id
+        assert patch.patched_content.id == first_patches[patch.filename].patched_content.id
+        assert patch.delta_calculated
+        assert patch.delta == []
+
+
+def test_process_codereview_from_fogbugz_dropped_content(user, rf, mocked_fogbugz_info, case_id):
+    """Test that the files of the unchanged patches without contents are exported again, not reused."""
+    request = rf.get(urlresolvers.reverse('process_from_fogbugz') + '?' + urllib.urlencode(dict(case=case_id)))
+    request.user = user
+    response = views.process_codereview_from_fogbugz(request)
+    issue = models.Issue.objects.get(id=urlresolvers.resolve(response._headers['location'][1]).args[0])
+    first_patch = issue.latest_patchset.patch_set.all()[0]
+    text = first_patch.content.text
+    models.Patch.objects.filter(id=first_patch.id).update(content=None)
+    views.process_codereview_from_fogbugz(request)
+    patch = issue.latest_patchset.patch_set.get(filename=first_patch.filename)
+    assert patch.content.text == text
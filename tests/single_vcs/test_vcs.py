@@ -0,0 +1,92 @@
+"""Version control system helpers tests."""
+import subprocess
+
+import mock
+import pytest
+
+from paylogic import views
+from paylogic.vcs import CachedRevision, GitVCS, InvalidateRevisionCache
+
+
+def test_export_paths(target_repo, target_repo_branch, target_test_file_name, target_test_file_content, tmpdir):
+    """Test exporting only given paths of the repository."""
+    repo = GitVCS(views.attrdict({'revision': target_repo_branch}), target_repo.strpath)
+    export_path = tmpdir.join('export')
+    repo.Export(target_repo_branch, export_path.strpath, paths=[target_test_file_name, 'missing.txt'])
+    assert export_path.listdir() == [export_path.join(target_test_file_name)]
+    assert export_path.join(target_test_file_name).read() == target_test_file_content
+
+    empty_export_path = tmpdir.join('empty_export')
+    repo.Export(target_repo_branch, empty_export_path.strpath, paths=['missing.txt'])
+    assert empty_export_path.listdir() == []
+
+
+def test_content_reader(target_repo, target_repo_branch, target_test_file_name, target_test_file_content):
+    """Test reading file contents with the pooled content reader."""
+    repo = GitVCS(views.attrdict({'revision': target_repo_branch}), target_repo.strpath)
+    reader = repo.GetContentReader()
+    assert reader is repo.GetContentReader()
+    assert reader.GetMany([target_test_file_name, 'missing.txt'], target_repo_branch) == {
+        target_test_file_name: target_test_file_content,
+        'missing.txt': None,
+    }
+
+
+def test_content_reader_failure(target_repo, target_repo_branch, target_test_file_name, target_test_file_content,
+                                monkeypatch):
+    """Test that the content reader is restarted after a failed request, instead of reading the rest of it."""
+    repo = GitVCS(views.attrdict({'revision': target_repo_branch}), target_repo.strpath)
+    reader = repo.GetContentReader()
+    monkeypatch.setattr(reader.process, 'stdout', mock.Mock(readline=mock.Mock(side_effect=IOError('broken pipe'))))
+    with pytest.raises(IOError):
+        reader.Get(target_test_file_name, target_repo_branch)
+    assert not reader.IsAlive()
+    assert repo.GetContentReader() is not reader
+    assert repo.GetContentReader().Get(target_test_file_name, target_repo_branch) == target_test_file_content
+
+
+class CountingVCS(object):
+
+    """Repository counting the revision resolutions."""
+
+    def __init__(self, repo_dir, base_rev):
+        self.repo_dir = repo_dir
+        self.base_rev = base_rev
+        self.calls = 0
+
+    @CachedRevision
+    def CheckRevision(self, revision=None):
+        self.calls += 1
+        return revision or self.base_rev
+
+
+@pytest.mark.parametrize(['revision', 'is_hash'], [
+    ('a' * 40, True),
+    ('master', False),
+    # a branch name which looks like a short hash
+    ('deadbeefcafe', False),
+])
+def test_cached_revision(tmpdir, revision, is_hash):
+    """Test that the full hashes are cached for good and the branch names until the repository is updated."""
+    repo = CountingVCS(tmpdir.strpath, 'b' * 40)
+    assert repo.CheckRevision(revision) == revision
+    assert repo.CheckRevision(revision) == revision
+    assert repo.calls == 1
+    InvalidateRevisionCache(repo.repo_dir)
+    repo.CheckRevision(revision)
+    assert repo.calls == (1 if is_hash else 2)
+
+
+def test_cached_revision_update_mirror(target_repo, target_repo_branch, tmpdir):
+    """Test that the branches of a mirror are resolved again after it's updated."""
+    repo = GitVCS(views.attrdict({'revision': target_repo_branch}), target_repo.strpath)
+    mirror = repo.Mirror(tmpdir.join('mirror').strpath)
+    old_revision = mirror.CheckRevision(target_repo_branch)
+
+    new_revision = subprocess.check_output(
+        ['git', 'commit-tree', 'HEAD^{tree}', '-p', 'HEAD', '-m', 'New commit'], cwd=target_repo.strpath).strip()
+    subprocess.check_call(
+        ['git', 'update-ref', 'refs/heads/{0}'.format(target_repo_branch), new_revision], cwd=target_repo.strpath)
+    assert mirror.CheckRevision(target_repo_branch) == old_revision
+    mirror.UpdateMirror()
+    assert mirror.CheckRevision(target_repo_branch) == new_revision
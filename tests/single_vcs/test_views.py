@@ -1,7 +1,15 @@
 """Codereview views tests."""
+import datetime
+
+import mock
 import pytest
 
-from paylogic import views
+from django.conf import settings
+
+from codereview import engine, models
+from codereview import views as codereview_views
+
+from paylogic import jobs, views
 
 
 @pytest.mark.parametrize('user_permissions', ([],))
@@ -40,6 +48,26 @@ def test_diff(app, issue, patchset, patch, patch_filename, patch_text, patch_con
         patch_content=patch_content) in response.pyquery('#thecode').text()
 
 
+def test_diff_cached(app, issue, patchset, patch, patch_filename, patch_content, monkeypatch):
+    """Test that the code rows of the diff are rendered once."""
+    url = '/{issue.id}/diff/{patchset.id}/{patch_filename}'.format(**locals())
+    first = app.get(url).pyquery('#thecode').text()
+    monkeypatch.setattr(engine, 'RenderDiffCodeRows', mock.Mock(side_effect=AssertionError('not cached')))
+    assert app.get(url).pyquery('#thecode').text() == first
+
+
+def test_diff_skipped_lines(app, issue, patchset, patch, patch_content):
+    """Test that the rows in the range are returned as cells."""
+    url = '/{issue.id}/diff_skipped_lines/{patchset.id}/{patch.id}/{{0}}/{{1}}/a/80'.format(**locals())
+    code_row, comments_row = app.get(url.format(1, 1)).json
+    assert code_row[0] == [['name', 'hook'], ['id', 'pair-1']]
+    assert code_row[1][0] == [[['class', 'oldblank']], '']
+    assert code_row[1][1][0] == [['class', 'newinsert'], ['id', 'newcode1']]
+    assert patch_content in code_row[1][1][1]
+    assert comments_row[0] == [['class', 'inline-comments']]
+    assert app.get(url.format(2, 10)).json == []
+
+
 def test_diff2(app, issue, patchset, patch, patch_filename, patch_text, patch_content):
     """Test delta diff view."""
     response = app.get('/{issue.id}/diff2/{patchset.id}:{patchset.id}/{patch_filename}'.format(**locals()))
@@ -48,6 +76,22 @@ def test_diff2(app, issue, patchset, patch, patch_filename, patch_text, patch_co
         patch_content=patch_content) in response.pyquery('#thecode').text()
 
 
+def test_rows_chunks(monkeypatch):
+    """Test that the beginning of the page is sent before the rows are rendered, then the rows in chunks."""
+    monkeypatch.setattr(codereview_views, 'ROWS_CHUNK_SIZE', 10)
+    rendered = []
+
+    def rows():
+        for row in ['1', '2', u'\xe9']:
+            rendered.append(row)
+            yield u'<tr>{0}</tr>'.format(row)
+
+    chunks = codereview_views._rows_chunks('<table>', rows(), '</table>')
+    assert next(chunks) == '<table>'
+    assert not rendered
+    assert list(chunks) == ['<tr>1</tr>', '<tr>2</tr>', '<tr>\xc3\xa9</tr>', '</table>']
+
+
 def test_publish(app, issue2, monkeypatch):
     """Test publishing comments.
 
@@ -113,3 +157,234 @@ def test_gatekeepers_approve_no_ci_project(app, issue, patch, ci_project):
     issue = issue.objects.get(id=issue.id)
     assert not issue.latest_reviewed_rev
     assert 'You need to set CI Project field' in response.content
+
+
+def test_patch_stats(patch, patch_text):
+    """Test that the statistics of the patch text are stored."""
+    patch.update_stats()
+    patch.put()
+    patch = models.Patch.objects.get(id=patch.id)
+    assert (patch.added_count, patch.removed_count, patch.chunk_count) == (1, 0, 1)
+    assert patch.text_checksum == views.sha1(patch_text).hexdigest()
+
+
+def test_patch_headers(patchset, patch, patch_text):
+    """Test that the listed patches load their text when it's accessed."""
+    header, = models.patch_headers(patchset)
+    assert header._deferred
+    assert header.filename == patch.filename
+    assert header.text == patch_text
+
+
+def test_patchset_manifest(patchset, patch, patch_text):
+    """Test that the manifest of a patch set created without it is built from the patches, stored only on demand."""
+    assert patchset.manifest is None
+    manifest_file, = patchset.files
+    assert (manifest_file.id, manifest_file.filename) == (patch.id, patch.filename)
+    assert manifest_file.text_checksum == views.sha1(patch_text).hexdigest()
+    assert models.PatchSet.objects.get(id=patchset.id).manifest is None
+    patchset.store_manifest()
+    patchset = models.PatchSet.objects.get(id=patchset.id)
+    assert patchset.manifest is not None
+    assert patchset.get_file(patch.filename).added_count == 1
+    assert patchset.get_file('missing') is None
+
+
+def test_calculate_deltas(issue, patchset, patch, patch_text):
+    """Test that the delta of the new patches is calculated from the checksums of the earlier patch sets."""
+    new_patchset = models.PatchSet(issue=issue)
+    new_patchset.put()
+    unchanged = models.Patch(patchset=new_patchset, filename=patch.filename, text=patch_text)
+    added = models.Patch(patchset=new_patchset, filename='added', text=patch_text)
+    for new_patch in unchanged, added:
+        new_patch.update_stats()
+    codereview_views._calculate_deltas(new_patchset, [unchanged, added])
+    assert unchanged.delta_calculated and added.delta_calculated
+    assert (unchanged.delta, added.delta) == ([], [patchset.id])
+
+
+def test_get_comment_counts(user, patchset, patch):
+    """Test that the comments and the drafts of the user are counted per patch."""
+    for draft in (False, False, True):
+        models.Comment(patch=patch, parent=patch, text='comment', lineno=1, left=False, author=user, draft=draft).put()
+    account = mock.Mock(user=user)
+    assert codereview_views._get_comment_counts(account, patchset) == ({patch.id: 2}, {patch.id: 1})
+    assert codereview_views._get_comment_counts(None, patchset) == ({patch.id: 2}, {})
+
+
+def test_discard_shared_bad_content(patchset, patch, patch_text):
+    """Test that a bad content shared with other patches is only detached from the patch it doesn't apply to."""
+    content = views.get_or_create_content(views.sha1('base').hexdigest(), text='base')
+    other = models.Patch(patchset=patchset, filename='other', text=patch_text, content=content)
+    other.put()
+    patch.content = content
+    patch.put()
+    codereview_views._discard_bad_content(patch, content)
+    assert models.Patch.objects.get(id=patch.id).content is None
+    assert models.Patch.objects.get(id=other.id).content.id == content.id
+    assert not models.Content.objects.get(id=content.id).is_bad
+
+
+def test_delete_unused_contents(patch):
+    """Test that only the unused contents are deleted, never the patches using them."""
+    used = views.get_or_create_content(views.sha1('used').hexdigest(), text='used')
+    unused = views.get_or_create_content(views.sha1('unused').hexdigest(), text='unused')
+    patch.patched_content = used
+    patch.put()
+    assert models.delete_unused_contents([used.id, unused.id]) == 1
+    assert list(models.Content.objects.values_list('id', flat=True)) == [used.id]
+    assert models.Patch.objects.get(id=patch.id).patched_content.id == used.id
+
+
+def test_discard_bad_content_before_streaming(patch, monkeypatch):
+    """Test that the content the patch doesn't apply to is discarded before the diff rows are streamed."""
+    patch.content = views.get_or_create_content(views.sha1('base').hexdigest(), text='base')
+    patch.put()
+    monkeypatch.setattr(
+        codereview_views.patching, 'PatchChunks', lambda old_lines, chunks: iter([('error: mismatch', [], [])]))
+    codereview_views._get_diff_table_rows(mock.Mock(patch=patch), patch, 10, 80)
+    assert models.Patch.objects.get(id=patch.id).content is None
+
+
+def test_get_or_create_content(db, tmpdir, monkeypatch):
+    """Test that identical files are stored once."""
+    text = 'some file text'
+    content = views.get_or_create_content(views.sha1(text).hexdigest(), text=text)
+    assert views.get_or_create_content(views.sha1(text).hexdigest(), text=text).id == content.id
+    models.Content.objects.filter(id=content.id).update(is_bad=True, text=None)
+    assert views.get_or_create_content(views.sha1(text).hexdigest(), text=text).id != content.id
+
+    monkeypatch.setattr(views, 'BINARY_FILES_PATH', tmpdir.join('binary_files').strpath)
+    binary_file = tmpdir.join('image.png')
+    binary_file.write(text)
+    binary_content = views.get_or_create_binary_content(binary_file.strpath)
+    assert binary_content.id != content.id
+    assert views.get_or_create_binary_content(binary_file.strpath).id == binary_content.id
+    assert tmpdir.join('binary_files').listdir() == [tmpdir.join('binary_files', binary_content.data)]
+
+
+def test_claim_abandoned_job(issue):
+    """Test that the running job of a stopped worker is queued again and claimed, but not the one of a live worker."""
+    now = datetime.datetime.now()
+    abandoned = models.ProcessingJob(issue=issue, status='running', worker='stopped')
+    abandoned.put()
+    models.ProcessingJob.objects.filter(id=abandoned.id).update(heartbeat=now - datetime.timedelta(days=1))
+    models.ProcessingJob(issue=issue, status='running', worker='alive', heartbeat=now).put()
+    models.Issue.objects.filter(id=issue.id).update(processing=True)
+
+    job = jobs.claim_job('worker')
+    assert (job.id, job.worker, job.attempts) == (abandoned.id, 'worker', 1)
+    # the job is processed again, the issue is still being processed
+    assert models.Issue.objects.get(id=issue.id).processing
+    assert jobs.claim_job('worker') is None
+
+
+def test_abandoned_job_attempts(issue):
+    """Test that a job whose workers keep stopping is marked as failed and the issue is not processed anymore."""
+    job = models.ProcessingJob(
+        issue=issue, status='running', worker='stopped', attempts=settings.CODEREVIEW_PROCESSING_MAX_ATTEMPTS - 1)
+    job.put()
+    models.Issue.objects.filter(id=issue.id).update(processing=True)
+
+    assert jobs.claim_job('worker') is None
+    assert models.ProcessingJob.objects.get(id=job.id).status == 'failed'
+    assert not models.Issue.objects.get(id=issue.id).processing
+
+
+def test_job_error_message(issue, monkeypatch):
+    """Test that the error of a failed job is stored whatever the encoding of the exception message is."""
+    monkeypatch.setattr(views, 'generate_diff', mock.Mock(side_effect=RuntimeError('caf\xc3\xa9')))
+    job = models.ProcessingJob(issue=issue, original_branch='original', feature_branch='feature')
+    job.put()
+    with pytest.raises(RuntimeError):
+        views.run_processing_job(job)
+    assert models.ProcessingJob.objects.get(id=job.id).error == u'caf\xe9'
+
+
+def test_fogbugz_client(mocked_fogbugz):
+    """Test that identical FogBugz queries are made once and the clients are reused."""
+    mocked_fogbugz_instance = mocked_fogbugz.return_value
+    for _ in range(3):
+        assert views.fogbugz_client.get_client('token').search(q='1') == mocked_fogbugz_instance.search.return_value
+    assert mocked_fogbugz_instance.search.call_count == 1
+
+    views.fogbugz_client.get_client('token').edit(ixBug='1')
+    views.fogbugz_client.get_client('token').search(q='1')
+    assert mocked_fogbugz_instance.search.call_count == 2
+    assert mocked_fogbugz.call_count == 1
+
+
+def test_fogbugz_operations(db, mocked_fogbugz):
+    """Test that queued FogBugz operations are made in order per case and retried."""
+    mocked_fogbugz_instance = mocked_fogbugz.return_value
+    mocked_fogbugz_instance.edit.side_effect = Exception('FogBugz is down')
+    edit = models.FogBugzOperation(case_id=1, token='token', command='edit', params='{"sTags": "approved"}')
+    edit.put()
+    assign = models.FogBugzOperation(case_id=1, token='token', command='assign', params='{"ixPersonAssignedTo": 5}')
+    assign.put()
+
+    operation = jobs.claim_fogbugz_operation('worker')
+    assert operation.id == edit.id
+    assert jobs.claim_fogbugz_operation('worker') is None
+    with pytest.raises(Exception):
+        views.run_fogbugz_operation(operation)
+    assert operation.status == 'queued'
+    assert operation.attempts == 1
+    # the edit is not due yet and the assignment waits for it
+    assert jobs.claim_fogbugz_operation('worker') is None
+
+    mocked_fogbugz_instance.edit.side_effect = None
+    models.FogBugzOperation.objects.filter(id=edit.id).update(next_attempt=edit.created)
+    views.run_fogbugz_operation(jobs.claim_fogbugz_operation('worker'))
+    mocked_fogbugz_instance.edit.assert_called_with(ixBug='1', sTags='approved')
+
+    views.run_fogbugz_operation(jobs.claim_fogbugz_operation('worker'))
+    mocked_fogbugz_instance.assign.assert_called_with(ixBug='1', ixPersonAssignedTo=5)
+    assert not models.FogBugzOperation.objects.exclude(status='done').exists()
+
+
+def test_claim_fogbugz_operation_not_blocked(db):
+    """Test that the operations waiting for an earlier one of their case don't block the other cases."""
+    for _ in range(20):
+        models.FogBugzOperation(case_id=1, token='token', command='edit', params='{}').put()
+    models.FogBugzOperation.objects.filter(case_id=1).update(
+        next_attempt=datetime.datetime.now() + datetime.timedelta(days=1))
+    other = models.FogBugzOperation(case_id=2, token='token', command='edit', params='{}')
+    other.put()
+
+    assert jobs.claim_fogbugz_operation('worker').id == other.id
+    assert jobs.claim_fogbugz_operation('worker') is None
+
+
+def test_claim_abandoned_fogbugz_operation(db):
+    """Test that the running operation of a stopped worker is queued again and claimed."""
+    abandoned = models.FogBugzOperation(case_id=1, token='token', command='edit', params='{}', status='running')
+    abandoned.put()
+    models.FogBugzOperation.objects.filter(id=abandoned.id).update(
+        heartbeat=datetime.datetime.now() - datetime.timedelta(days=1))
+    models.FogBugzOperation(case_id=1, token='token', command='assign', params='{}').put()
+
+    operation = jobs.claim_fogbugz_operation('worker')
+    assert (operation.id, operation.worker, operation.attempts) == (abandoned.id, 'worker', 1)
+    assert jobs.claim_fogbugz_operation('worker') is None
+
+
+def test_fogbugz_case_operations(db, mocked_fogbugz):
+    """Test that the FogBugz operations made right away are made in order per case and the failures are reported."""
+    mocked_fogbugz_instance = mocked_fogbugz.return_value
+    mocked_fogbugz_instance.edit.side_effect = Exception('FogBugz is down')
+    edit = models.FogBugzOperation(case_id=1, token='token', command='edit', params='{"sTags": "approved"}')
+    edit.put()
+    assign = models.FogBugzOperation(case_id=1, token='token', command='assign', params='{"ixPersonAssignedTo": 5}')
+    assign.put()
+
+    with pytest.raises(RuntimeError):
+        views.run_fogbugz_case_operations(1)
+    assert models.FogBugzOperation.objects.get(id=edit.id).attempts == 1
+    # the assignment waits for the edit
+    assert not mocked_fogbugz_instance.assign.called
+
+    mocked_fogbugz_instance.edit.side_effect = None
+    views.run_fogbugz_case_operations(1)
+    mocked_fogbugz_instance.assign.assert_called_with(ixBug='1', ixPersonAssignedTo=5)
+    assert not models.FogBugzOperation.objects.exclude(status='done').exists()